@@ -34,6 +34,7 @@ import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
 import matplotlib.colors as mplcol
+from itertools import zip_longest
 
 
 def get_cmap(n, name='hsv'):
@@ -59,8 +60,9 @@ def get_model_names(args):
     """This function finds and return all the trained model file names that meet the criteria in args
     (ignoring model id).
     """
-    # included factors in name from get_dataset_name()  (excluding random id for model instance)
-    str_args = '_bs'+ str(args.batch_size_multi[0]) + '_lr' + str(args.lr_multi[0]) + '_ep' + str(args.epochs) + '_r' + str(args.recurrent_size) + '_h' + str(args.hidden_size) + '_bpl' + str(args.BPTT_len) + '_trlf' + str(args.train_lesion_freq)
+    # included factors in name from get_dataset_name()  (excluding random id for model instance, but up to the '_id', so that
+    # models with non-default dataset sizes are told apart from the default ones)
+    str_args = '_bs'+ str(args.batch_size_multi[0]) + '_lr' + str(args.lr_multi[0]) + '_ep' + str(args.epochs) + '_r' + str(args.recurrent_size) + '_h' + str(args.hidden_size) + '_bpl' + str(args.BPTT_len) + mnet.get_bptt_window_text(args) + '_trlf' + str(args.train_lesion_freq) + mnet.get_dataset_size_text(args) + '_id'
     networkTxt = 'RNN' if args.network_style == 'recurrent' else 'MLP'
     contextlabelledtext = '_'+args.label_context+'contextlabel'
     hiddenstate = '_retainstate' if args.retain_hidden_state else '_resetstate'
@@ -373,15 +375,71 @@ def model_behaviour_vs_theory(args, device):
     print('Tstat: {}  p-value: {}'.format(Tstat, pvalue))
 
 
+def bf16_parity_report(args, device):
+    """Compare the test set performance of every trained model matching args in float32 and in bfloat16 autocast (--bf16),
+    to check that reduced precision doesnt change the behaviour of the networks.
+    - prints the accuracy and loss of each model both ways, and the mean and largest absolute accuracy difference over the models.
+    - returns a dict of the float32 and bfloat16 accuracies and losses (one per model).
+    """
+    allmodels = get_model_names(args)
+    report = {'fp32_accuracy':[], 'bf16_accuracy':[], 'fp32_loss':[], 'bf16_loss':[]}
+
+    for ind, m in enumerate(allmodels):
+        args.model_id = get_id_from_name(m)
+        testParams = setup_test_parameters(args, device)
+        for precision in ['fp32', 'bf16']:
+            testargs = copy.copy(args)
+            testargs.bf16 = (precision == 'bf16')
+            loss, accuracy = mnet.recurrent_test(testargs, *testParams[1:5], False)
+            report[precision+'_accuracy'].append(accuracy)
+            report[precision+'_loss'].append(loss)
+        print('model {}: float32 {:.2f}% (loss {:.4f}), bfloat16 {:.2f}% (loss {:.4f})'.format(args.model_id, report['fp32_accuracy'][-1], report['fp32_loss'][-1], report['bf16_accuracy'][-1], report['bf16_loss'][-1]))
+
+    differences = np.abs(np.asarray(report['bf16_accuracy']) - np.asarray(report['fp32_accuracy']))
+    if len(differences):
+        print('bfloat16 vs float32 test accuracy over {} models: mean abs difference {:.3f}%, largest {:.3f}%'.format(len(differences), np.mean(differences), np.max(differences)))
+    return report
+
+
+def get_test_estimation(record):
+    """Return how the test performance in a training record was estimated at each epoch ('full', 'subsample<N>' or None if not assessed).
+    Records from before evaluation schedules were introduced were always assessed on the full test set."""
+    if "estimation" in record:
+        return record["estimation"]["testPerformance"]
+    return ['full' for i in range(len(record["testPerformance"]))]
+
+
+def pad_performance_curves(curves):
+    """Stack performance curves of different lengths (e.g. runs that stopped early, see --early-stop-patience) into a
+    (n_models, n_epochs) float array, with nan after the end of each curve and for epochs that were not assessed (None)."""
+    n_epochs = max([len(curve) for curve in curves], default=0)
+    padded = np.full((len(curves), n_epochs), np.nan)
+    for i, curve in enumerate(curves):
+        padded[i, :len(curve)] = np.asarray(curve, dtype=float)
+    return padded
+
+
+def last_assessed(performance):
+    """Return the last assessed (not nan) value of each row of a padded performance array (see pad_performance_curves())."""
+    assessed = ~np.isnan(performance)
+    lastepoch = performance.shape[1] - 1 - np.argmax(assessed[:, ::-1], axis=1)
+    return performance[np.arange(performance.shape[0]), lastepoch]
+
+
 def average_perf_across_models(args):
     """Take the training records and determine the average train and test performance
     across all trained models that meet the conditions specified in args.
+    - runs can have different numbers of epochs (e.g. if they stopped early): each epoch is averaged over the runs that reached it,
+      and the final performance is the last assessed performance of each run (of the restored best weights, if training stopped early).
     """
     matched_models = get_model_names(args)
     all_training_records = os.listdir(const.TRAININGRECORDS_DIRECTORY)
     record_name = ''
     train_performance = []
     test_performance = []
+    test_methods = []
+    final_test_performance = []
+    stop_epochs = []
     for ind, m in enumerate(matched_models):
         args.model_id = get_id_from_name(m)
 
@@ -394,23 +452,44 @@ def average_perf_across_models(args):
                         record = json.load(record_file)
                         train_performance.append(record["trainingPerformance"])
                         test_performance.append(record["testPerformance"])
+                        test_methods.append(get_test_estimation(record))
+                        earlystopping = record.get("earlyStopping")
+                        final_test_performance.append(None if earlystopping is None else earlystopping["restoredTestPerformance"])
+                        stop_epochs.append(record.get("stopEpoch", len(record["trainingPerformance"])-1))
                         record_name = training_record[:-5]
 
-    train_performance = np.asarray(train_performance)
-    test_performance = np.asarray(test_performance)
-    n_models = train_performance.shape[0]
-
-    mean_train_performance = np.mean(train_performance, axis=0)
-    std_train_performance = np.std(train_performance, axis=0) / np.sqrt(n_models)
-
-    mean_test_performance = np.mean(test_performance, axis=0)
-    std_test_performance = np.std(test_performance, axis=0) / np.sqrt(n_models)
-
-    print('Final training performance across {} models: {:.3f} +- {:.3f}'.format(n_models, mean_train_performance[-1], std_train_performance[-1]))  # mean +- std
-    print('Final test performance across {} models: {:.3f} +- {:.3f}'.format(n_models, mean_test_performance[-1], std_test_performance[-1]))  # mean +- std
+    # epochs that were not assessed (see --eval-every) or not reached (see --early-stop-patience) are nan,
+    # and only averaged over the models that were assessed then
+    train_performance = pad_performance_curves(train_performance)
+    test_performance = pad_performance_curves(test_performance)
+    n_models, n_epochs = train_performance.shape
+    epochs = np.arange(n_epochs)
+
+    n_trained = np.sum(~np.isnan(train_performance), axis=0)
+    mean_train_performance = np.nanmean(train_performance, axis=0)
+    std_train_performance = np.nanstd(train_performance, axis=0) / np.sqrt(np.maximum(n_trained, 1))
+
+    n_assessed = np.sum(~np.isnan(test_performance), axis=0)
+    mean_test_performance = np.nanmean(test_performance, axis=0)
+    std_test_performance = np.nanstd(test_performance, axis=0) / np.sqrt(np.maximum(n_assessed, 1))
+    for epoch, methods in enumerate(zip_longest(*test_methods)):
+        estimates = sorted(set(m for m in methods if m is not None))
+        if estimates and estimates != ['full']:
+            print('Note: epoch {} test performance estimated from: {}'.format(epoch, ', '.join(estimates)))
+
+    if len(set(stop_epochs)) > 1:
+        print('Note: training stopped at epochs {}'.format(stop_epochs))
+
+    # final performance of each model: its last epoch, or the restored best weights if it was monitored for early stopping
+    final_train = last_assessed(train_performance)
+    final_test = last_assessed(test_performance)
+    final_test = np.asarray([final if restored is None else restored for final, restored in zip(final_test, final_test_performance)], dtype=float)
+    print('Final training performance across {} models: {:.3f} +- {:.3f}'.format(n_models, np.mean(final_train), np.std(final_train)/np.sqrt(n_models)))  # mean +- sem
+    print('Final test performance across {} models: {:.3f} +- {:.3f}'.format(n_models, np.mean(final_test), np.std(final_test)/np.sqrt(n_models)))  # mean +- sem
     plt.figure()
-    h1 = plt.errorbar(range(11), mean_train_performance, std_train_performance, color='dodgerblue')
-    h2 = plt.errorbar(range(11), mean_test_performance, std_test_performance, color='green')
+    assessed = n_assessed > 0
+    h1 = plt.errorbar(epochs, mean_train_performance, std_train_performance, color='dodgerblue')
+    h2 = plt.errorbar(epochs[assessed], mean_test_performance[assessed], std_test_performance[assessed], color='green')
     plt.legend((h1,h2), ['train','test'])
 
     plt.savefig(os.path.join(const.FIGURE_DIRECTORY, record_name + '.pdf'), bbox_inches='tight')
@@ -13,7 +13,9 @@ import numpy as np
 
 # Save/load directories
 DATASET_DIRECTORY = 'datasets/'
+DATASET_CACHE_DIRECTORY = 'datasets/cache/'              # datasets keyed by a hash of their generation parameters
 MODEL_DIRECTORY = 'models/'
+CHECKPOINT_DIRECTORY = 'models/checkpoints/'                # mid-training checkpoints (see --resume)
 FIGURE_DIRECTORY = 'figures/'
 ANIMATION_DIRECTORY = 'animations/'
 TRAININGRECORDS_DIRECTORY = 'trainingrecords/'
@@ -61,5 +63,8 @@ GLOBAL_MEAN = 8.5 #np.mean([list(range(FULLR_LLIM, FULLR_ULIM+1)), list(range(LO
 CONTEXT_COLOURS = [[253/256, 176/256, 4/256], 'dodgerblue', 'orangered', 'black']  # low, high, full
 MODEL_COLOURS = ['darkkhaki', 'olivedrab','darkolivegreen']  # change to show both local and global on same plot easily and keep main colours for data
 
+# Version of the dataset generation code: change this whenever the same parameters and seed would generate a different dataset
+DATASET_CODE_VERSION = 1
+
 # Single dataset for retraining decoders under blocked, VI conditions
 RETRAINING_DATASET = 'dataset_truecontextlabel_numrangeblocked_bpl120_id9999'#'dataset_truecontextlabel_numrangeblocked_bpl120_id9999'
@@ -26,8 +26,23 @@ import random
 from sklearn.manifold import MDS
 from sklearn.utils import shuffle
 import copy
-
-from torch.utils.data import Dataset, DataLoader
+import time
+import os
+import json
+import hashlib
+import argparse
+import queue
+import threading
+import multiprocessing
+import tempfile
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None      # (Windows: see manifest_lock())
+    import msvcrt
+
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Subset
 from torch.utils.tensorboard import SummaryWriter
 from datetime import datetime
 
@@ -66,6 +81,118 @@ def flatten_first_dim(array):
         print('Error: the array you are trying to partially flatten is not the correct shape.')
 
 
+class CodedArray():
+    """A read-only, array-like view of an integer-coded (uint8) dataset field.
+    Codes are only expanded into their values (e.g. one-hot rows) through the lookup table when indexed,
+    so a compact dataset can be passed to anything that indexes the usual one-hot arrays.
+    """
+
+    def __init__(self, codes, table):
+        self.codes = codes
+        self.table = table
+        self.shape = codes.shape + table.shape[1:]
+        self.ndim = len(self.shape)
+        self.dtype = table.dtype
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, idx):
+        return self.table[self.codes[idx]]
+
+    def __array__(self, dtype=None, copy=None):
+        expanded = self.table[np.asarray(self.codes)]
+        return expanded if dtype is None else expanded.astype(dtype)
+
+
+def onehot_to_codes(onehot):
+    """Turn one-hot rows (last dim) into integer codes, with 0 for an all-zero row."""
+    onehot = np.asarray(onehot)
+    return np.where(onehot.any(axis=-1), onehot.argmax(axis=-1)+1, 0).astype(np.uint8)
+
+
+def label_to_codes(label):
+    """Turn labels into integer codes: 0 = no label (nan), 1 = label 0, 2 = label 1."""
+    label = np.asarray(label)
+    return np.where(label==1, 2, np.where(label==0, 1, 0)).astype(np.uint8)
+
+
+def is_compact_dataset(dataset):
+    """Return True if the dataset dict holds integer codes (N, BPTT_len) rather than one-hot arrays (N, BPTT_len, TOTALMAXNUM)."""
+    return np.ndim(dataset['input']) == 2
+
+
+def compress_dataset(dataset):
+    """Return a compact (integer-coded, uint8) copy of a one-hot dataset dict, e.g. for saving to disk."""
+    compact = {'input':onehot_to_codes(dataset['input']), 'judgementValue':onehot_to_codes(dataset['judgementValue']),\
+               'refValue':onehot_to_codes(dataset['refValue']), 'label':label_to_codes(dataset['label']),\
+               'context':onehot_to_codes(dataset['context']), 'contextdigits':np.asarray(dataset['contextdigits'], dtype=np.uint8),\
+               'contextinputs':onehot_to_codes(dataset['contextinputs']), 'trialtypeinputs':np.asarray(dataset['trialtypeinputs'], dtype=np.uint8),\
+               'index':np.asarray(dataset['index'], dtype=np.int32)}
+    if 'randomcontextinputs' in dataset:
+        compact['randomcontextinputs'] = np.asarray(dataset['randomcontextinputs'], dtype=np.uint8)
+    return compact
+
+
+def expand_compact_dataset(compact):
+    """Return a dataset dict with the usual one-hot/float fields, as CodedArray views over a compact dataset (nothing is expanded yet)."""
+    numbertable = one_hot_table(const.TOTALMAXNUM)
+    contexttable = one_hot_table(const.NCONTEXTS)
+    dataset = {'input':CodedArray(compact['input'], numbertable), 'judgementValue':CodedArray(compact['judgementValue'], numbertable),\
+               'refValue':CodedArray(compact['refValue'], numbertable), 'label':CodedArray(compact['label'], np.asarray([np.nan, 0., 1.])),\
+               'context':CodedArray(compact['context'], contexttable), 'contextdigits':CodedArray(compact['contextdigits'], np.arange(const.NCONTEXTS+1, dtype=float)),\
+               'contextinputs':CodedArray(compact['contextinputs'], contexttable), 'trialtypeinputs':CodedArray(compact['trialtypeinputs'], np.asarray([0., 1.]))}
+    if 'index' in compact:
+        dataset['index'] = np.asarray(compact['index'])
+    if 'randomcontextinputs' in compact:
+        dataset['randomcontextinputs'] = compact['randomcontextinputs']
+    return dataset
+
+
+def prepare_dataset(dataset):
+    """Return a dataset dict ready for analysis: compact datasets are wrapped in CodedArray views, one-hot datasets are returned as they are."""
+    if is_compact_dataset(dataset):
+        return expand_compact_dataset(dataset)
+    return dataset
+
+
+def derive_label_context_view(base, label_context):
+    """Return a view of a base dataset split (generated with label_context='base') under one context labelling scheme.
+    - every array is shared with the base dataset; only the context input is swapped in: the true context itself,
+     the random labels stored alongside it, or a constant label 1 (a broadcast, so it takes no memory).
+    - views are read-only: writing into an array of a view writes into the base dataset (and its other views).
+    """
+    view = {key:value for key, value in base.items() if key != 'randomcontextinputs'}
+    if label_context=='true':
+        view['contextinputs'] = base['context']
+    else:
+        randomcodes = base['randomcontextinputs']
+        codes = randomcodes if label_context=='random' else np.broadcast_to(np.uint8(1), np.shape(randomcodes))
+        view['contextinputs'] = codes if is_compact_dataset(base) else CodedArray(codes, one_hot_table(const.NCONTEXTS))
+    return view
+
+
+def get_base_dataset_name(datasetname):
+    """Return the name of the base dataset a dataset can be derived from (see get_dataset_name()), and its context labelling scheme.
+    Returns (None, None) if datasetname does not name a context labelling scheme."""
+    for label_context in ['true', 'random', 'constant']:
+        labeltext = '_'+label_context+'contextlabel'
+        if labeltext in datasetname:
+            return datasetname.replace(labeltext, '_basecontextlabel'), label_context
+    return None, None
+
+
+def load_label_context_views(datasetname, fileloc=const.DATASET_DIRECTORY, label_contexts=['true', 'random', 'constant']):
+    """Load a base dataset once and return its views under several context labelling schemes,
+    as a dict {label_context: {split: dataset dict}}, e.g. for cross-condition analyses.
+    - datasetname can be the name of the base dataset or of any of its derived datasets.
+    """
+    basename, _ = get_base_dataset_name(datasetname)
+    _, _, _, numpy_trainset, numpy_testset, numpy_crossvalset = load_input_data(fileloc, datasetname if basename is None else basename)
+    base = {"trainset":numpy_trainset, "testset":numpy_testset, "crossval_testset":numpy_crossvalset}
+    return {label_context:{split:(derive_label_context_view(dataset, label_context) if dataset is not None else None) for split, dataset in base.items()} for label_context in label_contexts}
+
+
 class CreateDataset(Dataset):
     """A class to hold a dataset.
     - judgementValue i.e. input2
@@ -74,13 +201,16 @@ class CreateDataset(Dataset):
     - label
     """
 
-    def __init__(self, dataset, transform=None):
+    def __init__(self, dataset, transform=None, precompose=False):
         """
         Args:
             datafile (string): name of numpy datafile
             transform (callable, optional): Optional transform to be applied on a sample.
+            precompose (bool, optional): also hold the ready-made network inputs (see precompose()).
         """
         # load all original images too - yes memory intensive but useful. Note that this also removes the efficiency point of using dataloaders
+        # (compact datasets are kept as integer codes, and only expanded to one-hot when a sample is retrieved)
+        dataset = prepare_dataset(dataset)
         self.index = dataset['index']
         self.label = dataset['label']
         self.refValue = dataset['refValue']
@@ -92,48 +222,479 @@ class CreateDataset(Dataset):
         self.trialtypeinput = dataset['trialtypeinputs']
         self.data = {'index':self.index, 'label':self.label, 'refValue':self.refValue, 'judgementValue':self.judgementValue, 'input':self.input, 'context':self.context, 'contextinput':self.contextinput, "trialtypeinput":self.trialtypeinput}
         self.transform = transform
+        self.networkinput = None
+        if precompose:
+            self.precompose()
 
     def __len__(self):
         return len(self.index)
 
+    def precompose(self):
+        """Build the network input for every trial once, as contiguous float32 tensors (see compose_network_inputs()),
+        along with float32 label and trial type tensors, so the train/test loops dont have to rebuild them every epoch."""
+        if self.networkinput is None:
+            self.networkinput = compose_network_inputs(self.data)
+            self.labeltensor = torch.from_numpy(np.asarray(self.label, dtype=np.float32))
+            self.trialtypetensor = torch.from_numpy(np.asarray(self.trialtypeinput, dtype=np.float32))
+
     def __getitem__(self, idx):
         # for retrieving either a single sample of data, or a subset of data
         # lets us retrieve several items at once (HRS: may not be actually used)
         if torch.is_tensor(idx):
             idx = idx.tolist()
         sample = {'index':self.index[idx], 'label':self.label[idx], 'refValue':self.refValue[idx], 'judgementValue':self.judgementValue[idx], 'input':self.input[idx], 'context':self.context[idx], 'contextinput':self.contextinput[idx], 'trialtypeinput':self.trialtypeinput[idx] }
+        if self.networkinput is not None:
+            sample['networkinput'] = self.networkinput[idx]
         return sample
 
 
-def load_input_data(fileloc,datasetname):
-    # load an existing dataset
-    print('Loading dataset: ' + datasetname + '.npy')
-    data = np.load(fileloc+datasetname+'.npy', allow_pickle=True)
-    numpy_trainset = data.item().get("trainset")
-    numpy_testset = data.item().get("testset")
-    numpy_crossvalset = data.item().get("crossval_testset")
+def compose_network_inputs(dataset):
+    """Return the network input for every trial of every sequence in a dataset dict, as one contiguous float32 tensor
+    of shape (N, BPTT_len, TOTALMAXNUM+NCONTEXTS+NTYPEBITS): [number, context label, trial type bit],
+    with the context label zeroed on filler trials (as the train/test loops do step by step).
+    """
+    numbers = np.asarray(dataset['input'], dtype=np.float32)
+    trialtypes = np.asarray(dataset['trialtypeinput'], dtype=np.float32)[:, :, np.newaxis]
+    contexts = np.asarray(dataset['contextinput'], dtype=np.float32) * trialtypes    # remove context indicator on the filler trials
+    return torch.from_numpy(np.ascontiguousarray(np.concatenate((numbers, contexts, trialtypes), axis=2)))
+
+
+class SequenceBatchLoader():
+    """A lightweight replacement for DataLoader over a precomposed CreateDataset (see CreateDataset.precompose()).
+    Yields batches of consecutive sequences (no shuffling by default) as slices of the precomposed tensors,
+    without the per-sample dict collation of a DataLoader.
+    - indices (optional) restricts the loader to those sequences, in that order (e.g. stratified_subsample()).
+    - shuffle=True serves the sequences in a new random order every epoch, across blocks. The order depends only on seed and the
+      epoch given to set_epoch(), so that a run resumed part way through an epoch sees the same order.
+      (Only sensible when the hidden state is reset between sequences.)
+    """
 
-    # turn out datasets into pytorch Datasets
-    trainset = CreateDataset(numpy_trainset)
+    def __init__(self, dataset, batch_size=1, indices=None, shuffle=False, seed=0):
+        dataset.precompose()
+        self.source = dataset
+        self.dataset = dataset if indices is None else Subset(dataset, indices)
+        self.indices = None if indices is None else torch.as_tensor(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return int(np.ceil(len(self.dataset) / self.batch_size))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed * 100003 + self.epoch)
+            order = torch.randperm(len(self.dataset), generator=generator)
+            indices = order if indices is None else indices[order]
+        for start in range(0, len(self.dataset), self.batch_size):
+            idx = slice(start, start + self.batch_size) if indices is None else indices[start:start + self.batch_size]
+            yield {'networkinput':self.source.networkinput[idx], 'label':self.source.labeltensor[idx],\
+                   'trialtypeinput':self.source.trialtypetensor[idx], 'index':self.source.index[np.asarray(idx) if indices is not None else idx]}
+
+
+def stratified_subsample(dataset, n, seed=0):
+    """Return the (sorted) indices of a fixed subsample of n sequences of a CreateDataset, stratified by context
+    (the context of the first trial of each sequence), so that each context keeps its share of the subsample.
+    - the same seed always gives the same subsample, so estimates from it are comparable across epochs and models.
+    """
+    contexts = np.argmax(np.asarray(dataset.context[:, 0]), axis=1)
+    rng = np.random.default_rng(seed)
+    indices = []
+    for context in np.unique(contexts):
+        members = np.nonzero(contexts == context)[0]
+        n_context = int(round(n * len(members) / len(contexts)))
+        indices.extend(rng.choice(members, size=min(n_context, len(members)), replace=False))
+    return np.sort(np.asarray(indices, dtype=int))
+
+
+class ParallelStreamLoader():
+    """Split a (precomposed) CreateDataset into n_streams contiguous sub-streams of sequences, and yield them in lockstep:
+    batch t holds sequence t of every sub-stream, so a hidden state carried from one batch to the next carries each
+    sub-stream on to its own next sequence (as retaining the hidden state does at batch size 1).
+    - any sequences left over when the dataset does not split evenly into n_streams are not used.
+    """
+
+    def __init__(self, dataset, n_streams):
+        dataset.precompose()
+        self.dataset = dataset
+        self.n_streams = n_streams
+        self.stream_length = len(dataset) // n_streams
+        if self.stream_length == 0:
+            raise ValueError('Cannot split {} sequences into {} training streams'.format(len(dataset), n_streams))
+        self.streamstarts = torch.arange(n_streams) * self.stream_length
+
+    def __len__(self):
+        return self.stream_length
+
+    def __iter__(self):
+        for step in range(self.stream_length):
+            idx = self.streamstarts + step
+            yield {'networkinput':self.dataset.networkinput[idx], 'label':self.dataset.labeltensor[idx],\
+                   'trialtypeinput':self.dataset.trialtypetensor[idx], 'index':self.dataset.index[idx.numpy()]}
+
+
+def save_columnar_dataset(fileloc, datasetname, dat):
+    """Save a dataset (dict of train/test/crossval splits) as a directory with one .npy file per split and field,
+    e.g. datasets/<datasetname>/testset_input.npy, so that each field can be memory-mapped on its own.
+    """
+    directory = os.path.join(fileloc, datasetname)
+    os.makedirs(directory, exist_ok=True)
+    for split, dataset in dat.items():
+        if dataset is None:
+            continue
+        for field, array in dataset.items():
+            np.save(os.path.join(directory, split+'_'+field+'.npy'), np.ascontiguousarray(array))
+
+
+def load_columnar_split(directory, split):
+    """Memory-map every field of one split of a columnar dataset (read-only). Returns None if the split was not stored."""
+    files = [f for f in os.listdir(directory) if f.startswith(split+'_') and f.endswith('.npy')]
+    if len(files)==0:
+        return None
+    return {f[len(split)+1:-4]:np.load(os.path.join(directory, f), mmap_mode='r') for f in files}
+
+
+def save_dataset(fileloc, datasetname, dat, args, seed=None):
+    """Save a dataset dict of splits in the format chosen by args.dataset_format ('pickle': one np.save'd dict,
+    'columnar': see save_columnar_dataset(), 'spec': only the seed and generation args, see save_dataset_spec())."""
+    if args.dataset_format == 'columnar':
+        save_columnar_dataset(fileloc, datasetname, dat)
+    elif args.dataset_format == 'spec':
+        save_dataset_spec(datasetname, dat, args, seed)
+    else:
+        np.save(fileloc+datasetname+'.npy', dat)
+
+
+def dataset_checksum(dat):
+    """Return a sha256 checksum of the arrays in a dataset dict of splits (every field of every stored split, in a fixed order)."""
+    checksum = hashlib.sha256()
+    for split in sorted(dat):
+        if dat[split] is None:
+            continue
+        for field in sorted(dat[split]):
+            array = np.ascontiguousarray(dat[split][field])
+            checksum.update('{}/{}/{}/{}'.format(split, field, array.dtype.str, array.shape).encode())
+            checksum.update(array.tobytes())
+    return checksum.hexdigest()
+
+
+def get_dataset_spec_path(datasetname):
+    """Return where the spec of a dataset is saved: next to the models trained on it."""
+    return os.path.join(const.MODEL_DIRECTORY, datasetname+'_spec.json')
+
+
+def save_dataset_spec(datasetname, dat, args, seed):
+    """Save a dataset as a small spec instead of its arrays: the generation args, seed and dataset code version
+    (see get_dataset_cache_key()), plus a checksum of the arrays so that load_input_data() can check the regenerated dataset.
+    - the dataset must have been generated from a seed (seed=None datasets cannot be regenerated).
+    """
+    if seed is None:
+        raise ValueError('Cannot save a spec for dataset {}: it was not generated from a seed'.format(datasetname))
+    specargs = copy.copy(args)
+    specargs.dataset_seed = seed
+    _, params = get_dataset_cache_key(specargs)
+    spec = {'name':datasetname, 'params':params, 'checksum':dataset_checksum(dat), 'created':datetime.now().strftime("%d-%m-%y_%H-%M-%S")}
+    os.makedirs(const.MODEL_DIRECTORY, exist_ok=True)
+    with open(get_dataset_spec_path(datasetname), 'w') as spec_file:
+        json.dump(spec, spec_file, indent=2, sort_keys=True)
+
+
+def load_dataset_spec(datasetname):
+    """Load the spec of a dataset saved with save_dataset_spec()."""
+    with open(get_dataset_spec_path(datasetname)) as spec_file:
+        return json.load(spec_file)
+
+
+def regenerate_dataset_from_spec(datasetname):
+    """Regenerate a dataset (dict of splits) from its saved spec, and check it against the checksum of the original.
+    - raises a ValueError if the spec was written by a different version of the dataset code, or if the checksums differ.
+    """
+    spec = load_dataset_spec(datasetname)
+    params = spec['params']
+    if params['code_version'] != const.DATASET_CODE_VERSION:
+        raise ValueError('Dataset {} was generated by dataset code version {} (now version {}), so cannot be regenerated'.format(datasetname, params['code_version'], const.DATASET_CODE_VERSION))
+
+    specargs = argparse.Namespace(**{field:value for field, value in params.items() if field not in ['seed', 'code_version']})
+    specargs.dataset_seed = params['seed']
+    dat = generate_dataset_splits(specargs, params['seed'])
+
+    if dataset_checksum(dat) != spec['checksum']:
+        raise ValueError('Regenerated dataset {} does not match the checksum of the original'.format(datasetname))
+    return dat
+
+
+def compare_regenerate_vs_load(datasetname, fileloc=const.DATASET_DIRECTORY, nrepeats=3):
+    """Time regenerating a dataset from its spec against loading the stored copy (pickled or columnar) of the same dataset,
+    and check that the two are identical.
+    """
+    tic = time.time()
+    for i in range(nrepeats):
+        regenerated = regenerate_dataset_from_spec(datasetname)
+    regeneratetime = (time.time() - tic) / nrepeats
+
+    tic = time.time()
+    for i in range(nrepeats):
+        directory = os.path.join(fileloc, datasetname)
+        if os.path.isdir(directory):
+            stored = {split:load_columnar_split(directory, split) for split in ['trainset', 'testset', 'crossval_testset']}
+            stored = {split:{field:np.array(array) for field, array in data.items()} for split, data in stored.items() if data is not None}
+        else:
+            stored = np.load(fileloc+datasetname+'.npy', allow_pickle=True).item()
+    loadtime = (time.time() - tic) / nrepeats
+
+    print('{}: regenerated in {:.3f}s, loaded in {:.3f}s'.format(datasetname, regeneratetime, loadtime))
+    print('- regenerated dataset matches the stored one: {}'.format(dataset_checksum(regenerated) == dataset_checksum(stored)))
+
+
+def convert_dataset_to_columnar(fileloc, datasetname):
+    """Convert an existing pickled dataset (fileloc/datasetname.npy) into the columnar format (fileloc/datasetname/).
+    The original .npy file is left where it is; load_input_data() will prefer the columnar copy."""
+    data = np.load(fileloc+datasetname+'.npy', allow_pickle=True).item()
+    save_columnar_dataset(fileloc, datasetname, data)
+
+
+def convert_all_datasets_to_columnar(fileloc=const.DATASET_DIRECTORY):
+    """Convert every pickled dataset in fileloc (e.g. datasets/*.npy) into the columnar format, skipping other .npy files
+    (e.g. EEG data) and datasets that have already been converted."""
+    for file in sorted(os.listdir(fileloc)):
+        datasetname = file[:-4]
+        if (not file.endswith('.npy')) or os.path.isdir(os.path.join(fileloc, datasetname)):
+            continue
+        try:
+            data = np.load(os.path.join(fileloc, file), allow_pickle=True).item()
+        except (ValueError, AttributeError):
+            continue   # not a dict, so not one of our datasets
+        if isinstance(data, dict) and ('testset' in data):
+            print('Converting dataset: ' + file)
+            save_columnar_dataset(fileloc, datasetname, data)
+
+
+def load_input_data(fileloc,datasetname):
+    # load an existing dataset (memory-mapped if it is stored in the columnar format)
+    fileloc, datasetname = resolve_dataset_location(fileloc, datasetname)
+    label_context = None
+    if not dataset_exists(fileloc, datasetname):
+        # datasets that differ only in their context labelling can all be derived from one base dataset
+        basename, basefileloc = get_base_dataset_name(datasetname)[0], fileloc
+        if basename is not None:
+            basefileloc, basename = resolve_dataset_location(fileloc, basename)
+        if (basename is not None) and dataset_exists(basefileloc, basename):
+            label_context = get_base_dataset_name(datasetname)[1]
+            print('Deriving dataset: ' + datasetname + ' (' + label_context + ' context labels, from base dataset ' + basename + ')')
+            fileloc, datasetname = basefileloc, basename
+    directory = os.path.join(fileloc, datasetname)
+    if (not os.path.isdir(directory)) and (not os.path.isfile(fileloc+datasetname+'.npy')) and os.path.isfile(get_dataset_spec_path(datasetname)):
+        print('Regenerating dataset: ' + datasetname + ' (from spec)')
+        data = regenerate_dataset_from_spec(datasetname)
+        numpy_trainset = data["trainset"]
+        numpy_testset = data["testset"]
+        numpy_crossvalset = data["crossval_testset"]
+    elif os.path.isdir(directory):
+        print('Loading dataset: ' + datasetname + '/ (memory-mapped)')
+        numpy_trainset = load_columnar_split(directory, "trainset")
+        numpy_testset = load_columnar_split(directory, "testset")
+        numpy_crossvalset = load_columnar_split(directory, "crossval_testset")
+    else:
+        print('Loading dataset: ' + datasetname + '.npy')
+        data = np.load(fileloc+datasetname+'.npy', allow_pickle=True)
+        numpy_trainset = data.item().get("trainset")
+        numpy_testset = data.item().get("testset")
+        numpy_crossvalset = data.item().get("crossval_testset")
+
+    # compact datasets are expanded lazily
+    numpy_trainset = prepare_dataset(numpy_trainset) if numpy_trainset is not None else None
+    numpy_testset = prepare_dataset(numpy_testset)
+    numpy_crossvalset = prepare_dataset(numpy_crossvalset)
+    if label_context is not None:
+        numpy_trainset = derive_label_context_view(numpy_trainset, label_context) if numpy_trainset is not None else None
+        numpy_testset = derive_label_context_view(numpy_testset, label_context)
+        numpy_crossvalset = derive_label_context_view(numpy_crossvalset, label_context)
+
+    # turn out datasets into pytorch Datasets (streamed training sets are not stored)
+    trainset = CreateDataset(numpy_trainset) if numpy_trainset is not None else None
     testset = CreateDataset(numpy_testset)
     crossvalset = CreateDataset(numpy_crossvalset)
 
     return trainset, testset, crossvalset, numpy_trainset, numpy_testset, numpy_crossvalset
 
 
-def generate_trial_sequence(include_fillers=True):
+def get_dataset_seed(args):
+    """Return the seed a cached dataset is generated from: args.dataset_seed if given, otherwise the model id
+    (so that each model id still gets its own dataset, as when datasets are named by model id)."""
+    return args.dataset_seed if args.dataset_seed is not None else args.model_id
+
+
+def get_dataset_cache_key(args):
+    """Return a hash of every argument that affects dataset generation (plus the dataset code version),
+    and the dict of parameters it was computed from."""
+    params = {'which_context':args.which_context, 'label_context':args.label_context, 'all_fullrange':bool(args.all_fullrange),\
+              'BPTT_len':args.BPTT_len, 'include_fillers':bool(args.include_fillers), 'seed':get_dataset_seed(args),\
+              'dataset_engine':args.dataset_engine, 'compact_dataset':bool(args.compact_dataset), 'code_version':const.DATASET_CODE_VERSION}
+    datasetsizes = get_dataset_sizes(args)
+    if datasetsizes != (2880, 480, 2, 24):   # (only recorded when not the defaults, so existing cache keys still match)
+        params.update(dict(zip(['Ntrain', 'Ntest', 'Mtestsets', 'Mblocks'], datasetsizes)))
+    if getattr(args, 'dataset_chunk_size', None):
+        params['dataset_chunk_size'] = args.dataset_chunk_size
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return key, params
+
+
+def load_dataset_manifest(cachedir=const.DATASET_CACHE_DIRECTORY):
+    """Load the manifest of cached datasets (a dict keyed by cache key).
+    - a broken manifest (e.g. left by an older version that wrote it unsafely) is treated as empty, with a warning:
+      the cached datasets are still there, and are recorded again as runs use them.
+    """
+    try:
+        with open(os.path.join(cachedir, 'manifest.json')) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print('Warning: the dataset cache manifest {} is broken, starting a new one'.format(os.path.join(cachedir, 'manifest.json')))
+        return {}
+
+
+def save_dataset_manifest(manifest, cachedir=const.DATASET_CACHE_DIRECTORY):
+    """Write the manifest of cached datasets (atomically, through a temporary file of its own, so an interrupted or concurrent
+    write never leaves a broken manifest). Hold manifest_lock() around reading, updating and saving it."""
+    os.makedirs(cachedir, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=cachedir, prefix='manifest.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(tmpname, os.path.join(cachedir, 'manifest.json'))
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+
+@contextlib.contextmanager
+def manifest_lock(cachedir=const.DATASET_CACHE_DIRECTORY):
+    """Hold an exclusive lock on the dataset cache manifest (a lock file next to it), so that processes updating it at the same time
+    (e.g. the workers of a sweep) take turns instead of overwriting each other's entries."""
+    os.makedirs(cachedir, exist_ok=True)
+    with open(os.path.join(cachedir, 'manifest.lock'), 'a+') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(lockfile.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue   # (LK_LOCK gives up after 10s)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+            else:
+                lockfile.seek(0)
+                msvcrt.locking(lockfile.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def get_dataset_size(fileloc, datasetname):
+    """Return the size on disk (bytes) of a dataset in either the pickled or the columnar format."""
+    directory = os.path.join(fileloc, datasetname)
+    if os.path.isdir(directory):
+        return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+    if os.path.isfile(fileloc+datasetname+'.npy'):
+        return os.path.getsize(fileloc+datasetname+'.npy')
+    return os.path.getsize(get_dataset_spec_path(datasetname))
+
+
+def dataset_exists(fileloc, datasetname):
+    """Return True if the dataset is stored at fileloc in either the pickled or the columnar format, or can be regenerated from a spec."""
+    return os.path.isdir(os.path.join(fileloc, datasetname)) or os.path.isfile(fileloc+datasetname+'.npy') or os.path.isfile(get_dataset_spec_path(datasetname))
+
+
+def resolve_dataset_location(fileloc, datasetname):
+    """Return where a dataset is actually stored: fileloc itself, or the dataset cache if datasetname was generated through it."""
+    if (not dataset_exists(fileloc, datasetname)) and (fileloc == const.DATASET_DIRECTORY):
+        for key, entry in load_dataset_manifest().items():
+            if datasetname in entry['datasetnames']:
+                return const.DATASET_CACHE_DIRECTORY, key
+    return fileloc, datasetname
+
+
+def is_dataset_cached(args, cachedir=const.DATASET_CACHE_DIRECTORY):
+    """Return True if the dataset for args is in the dataset cache (recorded in the manifest, and stored)."""
+    key, _ = get_dataset_cache_key(args)
+    return (key in load_dataset_manifest(cachedir)) and dataset_exists(cachedir, key)
+
+
+def load_cached_dataset(args, datasetname=None, record=True):
+    """Return (trainset, testset) for args from the dataset cache, generating (and caching) the dataset only on a miss.
+    - datasets are keyed by get_dataset_cache_key(), so runs whose generation parameters and seed match share one dataset.
+    - datasetname (e.g. from get_dataset_name()) is recorded in the manifest so load_input_data() can find the dataset by that name too.
+    - record=False only loads a dataset that is already cached (and recorded), without writing to the manifest, e.g. in the workers
+      of a sweep whose parent process has cached and recorded their datasets (see mnet.run_sweep()).
+    """
+    key, params = get_dataset_cache_key(args)
+    cachedir = const.DATASET_CACHE_DIRECTORY
+
+    if is_dataset_cached(args, cachedir):
+        print('Dataset cache hit: {}'.format(key))
+        trainset, testset, _, _, _, _ = load_input_data(cachedir, key)
+    elif not record:
+        raise ValueError('Dataset {} is not in the dataset cache (and record=False cannot add it)'.format(key))
+    else:
+        print('Dataset cache miss: {}'.format(key))
+        os.makedirs(cachedir, exist_ok=True)
+        trainset, testset = create_separate_input_data(key, args, seed=params['seed'], fileloc=cachedir)
+
+    if record:
+        record_cached_dataset(key, params, datasetname, args)
+    return trainset, testset
+
+
+def record_cached_dataset(key, params, datasetname, args):
+    """Add or update the manifest entry of a cached dataset, recording who used it and when.
+    - the manifest is re-read, updated and saved under manifest_lock(), so concurrent runs dont lose each other's entries."""
+    cachedir = const.DATASET_CACHE_DIRECTORY
+    with manifest_lock(cachedir):
+        manifest = load_dataset_manifest(cachedir)
+        entry = manifest.get(key)
+        if entry is None:
+            entry = {'params':params, 'datasetnames':[], 'created':datetime.now().strftime("%d-%m-%y_%H-%M-%S"),\
+                     'size_bytes':get_dataset_size(cachedir, key), 'format':args.dataset_format}
+        entry['last_used'] = datetime.now().strftime("%d-%m-%y_%H-%M-%S")
+        if (datasetname is not None) and (datasetname not in entry['datasetnames']):
+            entry['datasetnames'].append(datasetname)
+        manifest[key] = entry
+        save_dataset_manifest(manifest, cachedir)
+
+
+def print_dataset_cache(cachedir=const.DATASET_CACHE_DIRECTORY):
+    """Print what is in the dataset cache: the parameters, size and users of each cached dataset."""
+    manifest = load_dataset_manifest(cachedir)
+    totalsize = 0
+    for key, entry in sorted(manifest.items()):
+        totalsize += entry['size_bytes']
+        print('{}  {:.1f} MB  created {}  last used {}'.format(key, entry['size_bytes']/1e6, entry['created'], entry['last_used']))
+        print('    params: {}'.format(entry['params']))
+        print('    used as: {}'.format(', '.join(entry['datasetnames'])))
+    print('{} cached datasets, {:.1f} MB in total'.format(len(manifest), totalsize/1e6))
+
+
+def generate_trial_sequence(include_fillers=True, sequence_length=120):
     """
     For generating a sequence of trials combining both the filler task and the compare task, as in Fabrice's experiment
     This will be used in create_separate_input_data()
-     - this sequence will always be 120 trials long
+     - this sequence will be 120 trials long (or a multiple of 120 trials, at least sequence_length long)
      - compare trials are separated by between 2 and 4 filler trials (same as Fabrice's trial scheduling)
      - include_fillers flag determines whether our dataset will contain some filler
     trials like Fabrice used, or whether we have trials solely of the type 'compare'.
      """
     L3_trialtype, L4_trialtype, L5_trialtype= [ [] for i in range(3)]
 
-    # generate 30 sequences, each will different numbers of full range filler trials
-    for i in range(10):
+    # generate 30 sequences (per 120 trials), each will different numbers of full range filler trials
+    for i in range(10 * int(np.ceil(sequence_length / 120.))):
         # the type of trials in the sequence
         if include_fillers:
             L3_trialtype.append([ 'compare','filler','filler'])
@@ -167,12 +728,435 @@ def turn_index_to_context(randind):
     return context
 
 
-def create_separate_input_data(filename, args):
+def get_block_context(block, Mblocks, args):
+    """Return the (context, minNumerosity, maxNumerosity) used for compare trials in a given block of the dataset.
+    - if args.which_context==0 the blocks are divided evenly across the 3 contexts, otherwise every block uses the single chosen context.
+    """
+    if args.which_context==0:
+        # divide the blocks evenly across the 3 contexts
+        if block < Mblocks/const.NCONTEXTS:        # 0-7     # context A
+            context = 1
+        elif block < 2*(Mblocks/const.NCONTEXTS):  # 8-15    # context B
+            context = 2
+        else:                                # 16-23   # context C
+            context = 3
+    else:
+        context = args.which_context         # single context options
+
+    contextranges = [[const.FULLR_LLIM, const.FULLR_ULIM], [const.LOWR_LLIM, const.LOWR_ULIM], [const.HIGHR_LLIM, const.HIGHR_ULIM]]
+    minNumerosity, maxNumerosity = contextranges[context-1]
+    return context, minNumerosity, maxNumerosity
+
+
+def get_number_distribution(minNumerosity, maxNumerosity, args):
+    """Return the list of numbers that compare trials are uniformly sampled from (by index).
+    - when contexts are intermingled this is the (non-uniform) concatenation of all 3 context ranges,
+     and the sampled index tells us which context the number was drawn from (see turn_index_to_context()).
+    """
+    if args.all_fullrange:
+        tmpDistribution = [[i for i in range(const.FULLR_LLIM, const.FULLR_ULIM+1)],[j for j in range(const.LOWR_LLIM, const.LOWR_ULIM+1)], [k for k in range(const.HIGHR_LLIM, const.HIGHR_ULIM+1)] ]
+        randNumDistribution = [i for sublist in tmpDistribution for i in sublist]  # non-uniform distr. over all 3 context ranges together
+    else:
+        randNumDistribution = [i for i in range(minNumerosity, maxNumerosity+1)]  # uniform between min and max
+    return randNumDistribution
+
+
+def get_dataset_sizes(args):
+    """Return (Ntrain, Ntest, Mtestsets, Mblocks): the number of sequences in the training set and in each test set,
+    the number of test sets (for cross-validation of activations) and the number of blocks each set is divided into.
+    - the defaults (2880, 480, 2, 24) match Fabrice's experiment: 24 blocks across 3 different contexts.
+    """
+    Ntrain = getattr(args, 'Ntrain', 2880)     # how many examples we want to use (each of these is a sequence on numbers)
+    Ntest = getattr(args, 'Ntest', 480)        # needs to be big enough to almost guarantee that we will get instances of all 460 comparisons (you get 29 comparisons per sequence)
+    Mtestsets = getattr(args, 'Mtestsets', 2)
+    Mblocks = getattr(args, 'Mblocks', 24)
+    if (Ntrain % Mblocks) or (Ntest % Mblocks):
+        raise ValueError('Ntrain ({}) and Ntest ({}) must be multiples of Mblocks ({})'.format(Ntrain, Ntest, Mblocks))
+    if Mtestsets < 2:
+        raise ValueError('Mtestsets must be at least 2 (a test set and a cross-validation test set)')
+    return Ntrain, Ntest, Mtestsets, Mblocks
+
+
+def get_split_names(Mtestsets):
+    """Return the names of the splits of a dataset: the training set, then Mtestsets test sets."""
+    return ['trainset', 'testset', 'crossval_testset'] + ['crossval_testset{}'.format(i) for i in range(2, Mtestsets)]
+
+
+def get_chunk_seed(blockseed, chunk):
+    """Return the random stream for one chunk of a block (see write_dataset_chunked()).
+    Chunk 0 is the block's own stream, so a block generated in one chunk is the same as a block generated whole."""
+    if chunk == 0:
+        return blockseed
+    # children 0 and 1 of the block stream are used inside generate_block_vectorised()
+    return np.random.SeedSequence(blockseed.entropy, spawn_key=blockseed.spawn_key+(chunk+1,), pool_size=blockseed.pool_size)
+
+
+def get_block_seeds(seed, nphases, Mblocks):
+    """Return an independent random stream (np.random.SeedSequence) for every block of every phase (train, test, crossval...).
+    - seed=None draws fresh entropy, so the dataset is different each time (as it always used to be).
+    - every block gets its own stream so a block can be generated without generating the blocks before it.
+    """
+    root = np.random.SeedSequence(seed)
+    return [phase.spawn(Mblocks) for phase in root.spawn(nphases)]
+
+
+def one_hot_table(maxSize):
+    """Lookup table for turning integer codes into one-hot rows: row 0 is all zeros (e.g. no reference number yet),
+    row i is turn_one_hot(i, maxSize).
+    """
+    return np.vstack((np.zeros((1, maxSize)), np.eye(maxSize)))
+
+
+def generate_trial_types_vectorised(n_sequences, args, rng):
+    """Vectorised version of generate_trial_sequence() for a whole block of sequences.
+    - returns a (n_sequences, BPTT_len) uint8 array with 1=compare, 0=filler.
+    - each sequence is a random permutation of compare trials followed by 2, 3 or 4 fillers (10 of each per 120 trials).
+    """
+    nrepeats = 10 * int(np.ceil(args.BPTT_len / 120.))
+    chunklengths = np.repeat([3, 4, 5], nrepeats)
+    permorder = np.argsort(rng.random((n_sequences, len(chunklengths))), axis=1)
+    lengths = chunklengths[permorder]
+    starts = np.cumsum(lengths, axis=1) - lengths   # every chunk starts with a compare trial
+
+    trialtypes = np.zeros((n_sequences, chunklengths.sum()), dtype=np.uint8)
+    np.put_along_axis(trialtypes, starts, const.TRIAL_COMPARE, axis=1)
+    if not args.include_fillers:
+        trialtypes[:] = const.TRIAL_COMPARE
+    return trialtypes[:, :args.BPTT_len]
+
+
+def sample_compare_indices(n_samples, numbers, startvalue, rng, override=None):
+    """Sample a chain of indices into numbers (uniformly), such that no two adjacent numbers in the chain are the same.
+    - this is exactly the sequential rejection sampling in generate_phase_loop(), but done with array operations:
+     every element is drawn iid, and any element equal to its predecessor is replaced by a draw from
+     the remaining indices. Replacements can create new repeats further down the chain, so we repeat until nothing changes
+     (each pass fixes at least one more element, in practice only a couple of passes are needed).
+    - startvalue is the number the first element must differ from.
+    - override (optional) gives, for each element, a different number it must differ from (-1 means use the predecessor).
+    """
+    nvalues = len(numbers)
+    # for each possible previous number (0 = none), the indices we are allowed to draw next
+    allowed = np.zeros((const.TOTALMAXNUM+1, nvalues), dtype=int)
+    counts = np.zeros((const.TOTALMAXNUM+1,), dtype=int)
+    for value in range(const.TOTALMAXNUM+1):
+        valid = np.nonzero(numbers != value)[0]
+        counts[value] = len(valid)
+        allowed[value, :len(valid)] = valid
+
+    candidates = rng.integers(nvalues, size=n_samples)
+    redraws = rng.random(n_samples)
+    indices = candidates.copy()
+    for _ in range(n_samples+1):
+        previous = np.concatenate(([startvalue], numbers[indices[:-1]]))
+        if override is not None:
+            previous = np.where(override >= 0, override, previous)
+        replacements = allowed[previous, (redraws * counts[previous]).astype(int)]
+        newindices = np.where(numbers[candidates] != previous, candidates, replacements)
+        if np.array_equal(newindices, indices):
+            break
+        indices = newindices
+    return indices
+
+
+def generate_block_vectorised(block, Mblocks, n_sequences, args, seed, carry=None):
+    """Generate all the sequences in one block of the dataset with array operations.
+    Follows the same trial scheduling rules as generate_phase_loop():
+    - compare numbers are drawn from the block's context range (or all ranges if intermingled) and never repeat
+     the previous compare number, including across sequence boundaries within the block.
+    - filler numbers are drawn from the full range, and the first filler after a compare trial never repeats the previous filler.
+    Returns a dict of integer-coded (n_sequences, BPTT_len) arrays: 'number', 'refnumber' (0 = none yet), 'label' (nan = no label),
+    'context', 'contextinput' and 'trialtype'. Use expand_block_codes() to turn these into the one-hot dataset format.
+    - a block can be generated in chunks of sequences (see write_dataset_chunked()): carry is the 'carry' returned for
+     the previous chunk of the block (the number the next compare trial must differ from), None for the first chunk.
+    """
+    samplerng, labelrng = [np.random.default_rng(s) for s in seed.spawn(2)]
+    L = args.BPTT_len
+    blockcontext, minNumerosity, maxNumerosity = get_block_context(block, Mblocks, args)
+    numbers = np.asarray(get_number_distribution(minNumerosity, maxNumerosity, args))
+
+    trialtypes = generate_trial_types_vectorised(n_sequences, args, samplerng)
+    iscompare = trialtypes == const.TRIAL_COMPARE
+
+    # filler trials (note fillers are always from uniform 1:15 range)
+    fillers = samplerng.integers(const.FULLR_LLIM, const.FULLR_ULIM+1, size=(n_sequences, L))
+    # like Fabrice, the first filler after a compare trial isnt the same as the previous filler in that sequence
+    constrained = np.zeros((n_sequences, L), dtype=bool)
+    constrained[:, 2:] = (~iscompare[:, 2:]) & iscompare[:, 1:-1] & (~iscompare[:, :-2])
+    offsets = samplerng.integers(1, const.FULLR_SPAN, size=(n_sequences, L))
+    previousfiller = np.roll(fillers, 2, axis=1)
+    repeated = constrained & (fillers == previousfiller)
+    fillers[repeated] = (previousfiller[repeated] - const.FULLR_LLIM + offsets[repeated]) % const.FULLR_SPAN + const.FULLR_LLIM
+
+    # compare trials, as one chain across all sequences in the block
+    ncompare = iscompare.sum()
+    startvalue = numbers[samplerng.integers(len(numbers))] if carry is None else carry
+    override = np.full((ncompare,), -1)
+    if (carry is None) and (n_sequences > 1) and not iscompare[0, -1]:
+        # the first sequence of a block hands over its last input (here a filler) rather than its last compare number
+        override[iscompare[0].sum()] = fillers[0, -1]
+    compareindices = sample_compare_indices(ncompare, numbers, startvalue, samplerng, override)
+
+    sequencenumbers = fillers.copy()
+    sequencenumbers[iscompare] = numbers[compareindices]
+    if (carry is None) and (n_sequences == 1) and not iscompare[0, -1]:
+        nextcarry = fillers[0, -1]     # (the same hand-over, when the first sequence is a chunk of its own)
+    else:
+        nextcarry = sequencenumbers[iscompare][-1]
+
+    # contexts: the block context, or when intermingled the range each compare number was drawn from (fillers get random contexts,
+    # NOTE this doesnt actually matter because context is later zeroed on fillers)
+    if args.all_fullrange:
+        contexts = samplerng.integers(1, const.NCONTEXTS+1, size=(n_sequences, L))
+        contexts[iscompare] = np.where(compareindices < const.FULLR_ULIM, 1, np.where(compareindices < const.FULLR_ULIM + const.LOWR_ULIM, 2, 3))
+    else:
+        contexts = np.full((n_sequences, L), blockcontext)
+
+    # the previous compare number in the same sequence, and whether the current number is larger than it
+    positions = np.where(iscompare, np.arange(L), -1)
+    lastcompare = np.maximum.accumulate(positions, axis=1)
+    previouscompare = np.concatenate((np.full((n_sequences, 1), -1), lastcompare[:, :-1]), axis=1)
+    refnumbers = np.where(previouscompare >= 0, np.take_along_axis(sequencenumbers, np.maximum(previouscompare, 0), axis=1), 0)
+    labels = np.where(iscompare & (refnumbers > 0), (sequencenumbers > refnumbers).astype(float), np.nan)
+
+    # Define the context input to the network
+    codes = {'number':sequencenumbers.astype(np.uint8), 'refnumber':refnumbers.astype(np.uint8), 'label':labels, 'context':contexts.astype(np.uint8), 'trialtype':trialtypes, 'carry':int(nextcarry)}
+    if args.label_context=='base':
+        # a base dataset keeps the true context input, plus the random one so that every labelling scheme can be derived from it
+        codes['contextinput'] = get_context_input_codes(contexts, 'true', labelrng)
+        codes['randomcontextinput'] = get_context_input_codes(contexts, 'random', labelrng)
+    else:
+        codes['contextinput'] = get_context_input_codes(contexts, args.label_context, labelrng)
+    return codes
+
+
+def get_context_input_codes(contexts, label_context, rng):
+    """Return the context label fed into the network for each trial, as integer codes (1-3), under each labelling scheme."""
+    if label_context=='true':
+        contextinputs = contexts
+    elif label_context=='random':
+        # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
+        contextinputs = rng.integers(1, const.NCONTEXTS+1, size=contexts.shape)  # randomly assign each example to a context
+    elif label_context=='constant':
+        contextinputs = np.ones(contexts.shape)  # just keep this constant across all contexts, so the input doesnt contain an explicit context indicator
+    return np.asarray(contextinputs, dtype=np.uint8)
+
+
+def compact_block_codes(codes):
+    """Arrange the integer-coded arrays from generate_block_vectorised() into the compact dataset format (see compress_dataset())."""
+    block = {'input':codes['number'], 'judgementValue':codes['number'], 'refValue':codes['refnumber'], 'label':label_to_codes(codes['label']),\
+             'context':codes['context'], 'contextdigits':codes['context'], 'contextinputs':codes['contextinput'], 'trialtypeinputs':codes['trialtype']}
+    if 'randomcontextinput' in codes:
+        block['randomcontextinputs'] = codes['randomcontextinput']
+    return block
+
+
+def expand_block_codes(codes):
+    """Turn the integer-coded arrays from generate_block_vectorised() into the one-hot (float) arrays stored in the dataset."""
+    numbertable = one_hot_table(const.TOTALMAXNUM)
+    contexttable = one_hot_table(const.NCONTEXTS)
+    block = {'input':numbertable[codes['number']], 'judgementValue':numbertable[codes['number']], 'refValue':numbertable[codes['refnumber']],\
+             'label':codes['label'], 'context':contexttable[codes['context']], 'contextdigits':codes['context'].astype(float),\
+             'contextinputs':contexttable[codes['contextinput']], 'trialtypeinputs':codes['trialtype'].astype(float)}
+    if 'randomcontextinput' in codes:
+        block['randomcontextinputs'] = codes['randomcontextinput']    # (always kept as integer codes)
+    return block
+
+
+def generate_phase_vectorised(N, Mblocks, args, blockseeds):
+    """Generate all the blocks of one phase (train or test) with generate_block_vectorised().
+    Returns a dict of arrays of shape (Mblocks, N/Mblocks, BPTT_len, ...), the same as generate_phase_loop(),
+    or of integer codes of shape (Mblocks, N/Mblocks, BPTT_len) if args.compact_dataset.
+    """
+    blockcodes = [generate_block_vectorised(block, Mblocks, int(N/Mblocks), args, blockseeds[block]) for block in range(Mblocks)]
+    return assemble_phase(blockcodes, args)
+
+
+def assemble_phase(blockcodes, args):
+    """Stack the integer-coded blocks of one phase (in block order) into arrays of shape (Mblocks, N/Mblocks, BPTT_len, ...),
+    in the one-hot or (if args.compact_dataset) compact dataset format."""
+    arrange_block = compact_block_codes if args.compact_dataset else expand_block_codes
+    blocks = [arrange_block(codes) for codes in blockcodes]
+    phasedata = {key:np.stack([b[key] for b in blocks]) for key in blocks[0].keys()}
+    Mblocks, sequences_per_block = phasedata['input'].shape[:2]
+    phasedata['block'] = np.repeat(np.arange(Mblocks), sequences_per_block).reshape((Mblocks, sequences_per_block, 1)).astype(float)
+    return phasedata
+
+
+def generate_phase_loop(N, Mblocks, args):
+    """Generate all the blocks of one phase (train or test) one trial at a time (the original dataset generator).
+    Returns a dict of arrays of shape (Mblocks, N/Mblocks, BPTT_len, ...).
+    - kept as the reference implementation for generate_phase_vectorised(), see compare_dataset_engines().
+    """
+    # perhaps set temporary N to N/24, then generate the data under each context and then shuffle order at the end?
+    refValues = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
+    judgementValues = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
+    input = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
+    contextinputs = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len, const.NCONTEXTS ))
+    target = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len))
+    contexts = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len, const.NCONTEXTS))
+    contextdigits = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len))
+    blocks = np.empty((Mblocks, int(N/Mblocks),1))
+    trialTypes = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len), dtype='str')  # 0='filler, 1='compare'; pytorch doesnt like string numpy arrays
+    trialTypeInputs = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len))
+
+    fillerRange = [const.FULLR_LLIM,const.FULLR_ULIM]        # the range of numbers spanned by all filler trials
+
+    for block in range(Mblocks):
+
+        context, minNumerosity, maxNumerosity = get_block_context(block, Mblocks, args)
+        randNumDistribution = get_number_distribution(minNumerosity, maxNumerosity, args)
+        indexDistribution = [i for i in range(len(randNumDistribution))]  # this is going to allow us to know which context a sample which have been drawn from if intermingled
+
+        # generate some random numerosity data and label whether the random judgement integers are larger than the refValue
+        firstTrialInContext = True              # reset the sequentialAB structure for each new context
+        for sample in range(int(N/Mblocks)):    # each sequence
+            input_sequence = []
+            type_sequence  = generate_trial_sequence(args.include_fillers, args.BPTT_len) # the order of filler trial and compare trials
+            trialtypeinput = [0 for i in range(len(type_sequence))]
+            contextsequence = []
+            contextinputsequence = []
+            previousFillerNum = None
+            previousTrialtype = None
+
+            # generate adjacent sequences of inputs, where no two adjacent elements within (or between) a sequence are the same
+            for item in range(args.BPTT_len):
+                trial_type = type_sequence[item]
+                trialtypeinput[item] = 1 if trial_type=='compare' else 0    # provide a bit-flip input to say whether its a filler or compare trial
+
+                if trial_type == 'compare':
+                    if (firstTrialInContext and (item==0)):
+                        randind = random.choice(indexDistribution)
+                        refValue = randNumDistribution[randind]
+                        if trial_type == 'filler':
+                            print('Warning: sequence starting with a filler trial. This should not happen and will cause a bug in sequence generation.')
+                    else:
+                        refValue = copy.deepcopy(judgementValue)  # use the previous number and make sure its a copy not a reference to same piece of memory
+
+                    randind = random.choice(indexDistribution)
+                    judgementValue = randNumDistribution[randind]
+
+                    while refValue==judgementValue:    # make sure we dont do inputA==inputB for two adjacent inputs
+                        randind = random.choice(indexDistribution)
+                        judgementValue = randNumDistribution[randind]
+
+                    input2 = turn_one_hot(judgementValue, const.TOTALMAXNUM)
+                    if args.all_fullrange:  # if intermingling contexts, then we need to know which context this number was sampled from
+                        context = turn_index_to_context(randind)
+
+                else:  # filler trial (note fillers are always from uniform 1:15 range)
+                    input2 = turn_one_hot(random.randint(*fillerRange), const.TOTALMAXNUM)
+                    # make sure (like Fabrice) that after a compare trial the subsequent filler isnt the same as the previous filler
+                    if previousFillerNum is not None and previousTrialtype=='compare':
+                        while all(input2 == previousFillerNum):
+                            input2 = turn_one_hot(random.randint(*fillerRange), const.TOTALMAXNUM) # leave the filler numbers unconstrained just spanning the full range
+
+                    previousFillerNum = copy.copy(input2)
+                    # when the trials are interleaved, set filler trials to have random contets
+                    # (NOTE this doesnt actually matter because context is later zeroed on fillers)
+                    if args.all_fullrange:
+                        context = random.randint(1,3)
+
+                previousTrialtype = copy.copy(trial_type)
+
+                # Define the context input to the network
+                if args.label_context=='true':
+                    contextinput = turn_one_hot(context, const.NCONTEXTS)  # there are 3 different contexts
+                elif args.label_context=='random':
+                    # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
+                    contextinput = turn_one_hot(random.randint(1,3), const.NCONTEXTS)  # randomly assign each example to a context, (shuffling examples across context markers in training)
+                elif args.label_context=='constant':
+                    # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
+                    contextinput = turn_one_hot(1, const.NCONTEXTS) # just keep this constant across all contexts, so the input doesnt contain an explicit context indicator
+
+                # add our new inputs to our sequence
+                input_sequence.append(input2)
+                contextsequence.append(context)
+                contextinputsequence.append(contextinput)
+
+            if firstTrialInContext:
+                judgementValue = turn_one_hot_to_integer(input_sequence[-1])  # and then make sure that the next sequence starts where this one left off (bit of a hack)
+                firstTrialInContext = False
+
+            # determine the correct rel. magnitude judgement for each pair of adjacent numbers in the sequence
+            rValue = None
+            judgeValue = None
+            allJValues = np.zeros((args.BPTT_len, const.TOTALMAXNUM))
+            allRValues = np.zeros((args.BPTT_len, const.TOTALMAXNUM))
+            for i in range(args.BPTT_len):
+                trialtype = trialtypeinput[i]
+                if trialtype==1:  # compare
+                    judgeValue = turn_one_hot_to_integer(input_sequence[i])
+                    if rValue is not None:
+                        if judgeValue==rValue:
+                            print('Warning: something gone wrong at index {}.'.format(i))
+
+                        if judgeValue > rValue:
+                            target[block, sample, i] = 1
+                        else:
+                            target[block, sample, i] = 0
+                    else:
+                        target[block, sample, i] = None  # default dont do anything
+
+                allJValues[i] = np.squeeze(turn_one_hot(turn_one_hot_to_integer(input_sequence[i]), const.TOTALMAXNUM))
+                if rValue is None:
+                    allRValues[i] = np.zeros((const.TOTALMAXNUM,))
+                else:
+                    allRValues[i] = np.squeeze(turn_one_hot(rValue, const.TOTALMAXNUM))
+
+                if trialtype==1:
+                    rValue = turn_one_hot_to_integer(input_sequence[i])  # set the previous state to be the current state
+
+            if firstTrialInContext:
+                judgementValue = copy.deepcopy(judgeValue)    # and then make sure that the next sequence starts with judgement where this one left off
+
+            contextdigits[block, sample] = contextsequence
+            judgementValues[block, sample] = np.squeeze(np.asarray(allJValues))
+            refValues[block, sample] = np.squeeze(np.asarray(allRValues))
+            contexts[block, sample] = np.squeeze([turn_one_hot(contextsequence[i], const.NCONTEXTS) for i in range(len(contextsequence))])  # still captures context here even if we dont feed context label into network
+            contextinputs[block, sample] = np.squeeze(contextinputsequence)
+            #input[block, sample] = np.squeeze(np.concatenate((input2,input1,contextinput)))  # for the MLP
+            input[block, sample] = np.squeeze(np.asarray(input_sequence))             # for the RNN with BPTT
+            blocks[block, sample] = block
+            trialTypes[block, sample] = type_sequence[:args.BPTT_len]
+            trialTypeInputs[block, sample] = trialtypeinput[:args.BPTT_len]
+
+    phasedata = {'refValue':refValues, 'judgementValue':judgementValues, 'input':input, 'label':target, 'context':contexts, 'contextdigits':contextdigits, 'contextinputs':contextinputs, 'trialtypeinputs':trialTypeInputs, 'block':blocks}
+    return phasedata
+
+
+def generate_phase(N, Mblocks, args, blockseeds):
+    """Generate the block-structured arrays for one phase with the dataset engine chosen in args.dataset_engine ('vectorised' or 'loop')."""
+    if args.dataset_engine == 'loop':
+        return generate_phase_loop(N, Mblocks, args)
+    else:
+        return generate_phase_vectorised(N, Mblocks, args, blockseeds)
+
+
+def shuffle_and_flatten_phase(phasedata, indices, args):
+    """Shuffle the block order of a phase (the same block order every time, random_state=0) and flatten the blocks
+    into one long sequence of sequences, in the dataset dict layout.
+    - if args.compact_dataset the dataset is stored as integer codes (see compress_dataset()).
+    """
+    Mblocks = indices.shape[0]
+    # now shuffle the block order so that we temporally separate contexts a bit but still blocked
+    blockorder = shuffle(np.arange(Mblocks), random_state=0)
+
+    # now flatten across the first dim of the structure
+    dataset = {key:flatten_first_dim(phasedata[key][blockorder]) for key in ['refValue', 'judgementValue', 'input', 'label', 'context', 'contextdigits', 'contextinputs', 'trialtypeinputs', 'randomcontextinputs'] if key in phasedata}
+    dataset['index'] = flatten_first_dim(indices[blockorder])
+    if args.compact_dataset and not is_compact_dataset(dataset):
+        dataset = compress_dataset(dataset)
+    return dataset
+
+
+def create_separate_input_data(filename, args, seed=None, fileloc=const.DATASET_DIRECTORY):
     """This function will create a dataset of inputs for training/testing a network on a relational magnitude task.
     - There are 3 contexts if whichContext==0 (default), or just one range for any other value of whichContext (1-3).
     - the inputs to this function determine the structure in the training and test sets e.g. are they blocked by context.
-    - BPTT_len specifies how long to back the sequences we backprop through. So far only works for BPTT_len <= block length
-    - messy but functional. To be modularised.
+    - BPTT_len specifies how long the sequences are (and how long we backprop through, unless args.bptt_window is set).
+    - args.dataset_engine selects the vectorised block generator (default) or the original trial-by-trial generator ('loop').
+    - args.compact_dataset stores numbers, contexts and trial types as uint8 codes instead of float64 one-hot arrays.
+    - seed makes the dataset reproducible (default None: a different dataset every time).
     """
     print('Generating dataset...')
     if args.which_context==0:
@@ -189,6 +1173,10 @@ def create_separate_input_data(filename, args):
         print('- network has randomly assigned context labelling')
     elif args.label_context=='constant':
         print('- network has constant (1) context labelling')
+    elif args.label_context=='base':
+        print('- base dataset: true context labelling, plus random labels to derive the other labelling schemes from')
+        if args.dataset_engine == 'loop':
+            raise ValueError('Base datasets (label_context="base") can only be generated by the vectorised dataset engine')
     if args.all_fullrange:
         print('- compare numbers are all drawn from the full 1:15 range')
     else:
@@ -196,236 +1184,295 @@ def create_separate_input_data(filename, args):
     print('- training is blocked by context')
     print('- training orders A and B relative to each other in trial sequence (B @ trial t+1 == A @ trial t)')
 
-    Mtestsets = 2                          # have multiple test sets for cross-validation of activations
-    print('- {} test sets generated for cross-validation'.format(Mtestsets))
+    Ntrain, Ntest, Mtestsets, Mblocks = get_dataset_sizes(args)    # have multiple test sets for cross-validation of activations
+    print('- {} training sequences, {} test sets of {} sequences generated for cross-validation, in {} blocks'.format(Ntrain, Mtestsets, Ntest, Mblocks))
+
+    if getattr(args, 'dataset_chunk_size', None):
+        # write the dataset to disk chunk by chunk, without the whole dataset ever being in memory
+        write_dataset_chunked(fileloc, filename, args, seed, args.dataset_chunk_size)
+        trainset, testset, _, _, _, _ = load_input_data(fileloc, filename)
+        return trainset, testset
+
+    if (seed is None) and (args.dataset_format == 'spec'):
+        seed = get_dataset_seed(args)      # a spec only makes sense for a reproducible dataset
+    dat = generate_dataset_splits(args, seed)
 
-    Ntrain = 2880                          # how many examples we want to use (each of these is a sequence on numbers)
-    Ntest = 480                            # needs to be big enough to almost guarantee that we will get instances of all 460 comparisons (you get 29 comparisons per sequence)
-    totalN = Ntrain + Mtestsets*Ntest        # how many sequences across training and test sets
-    Mblocks = 24          # same as fabrices experiment - there are 24 blocks across 3 different contexts
+    # save the dataset so we can use it again
+    save_dataset(fileloc, filename, dat, args, seed)
+
+    # turn out datasets into pytorch Datasets
+    trainset = CreateDataset(dat["trainset"])
+    testset = CreateDataset(dat["testset"])
+
+    return trainset, testset
+
+
+def generate_dataset_splits(args, seed=None):
+    """Generate the train, test and cross-validation sets for args (see create_separate_input_data()),
+    returned as a dict of splits without saving anything.
+    """
+    Ntrain, Ntest, Mtestsets, Mblocks = get_dataset_sizes(args)
     phases = ['train'  if i==0 else 'test' for i in range(Mtestsets+1)]
+    blockseeds = get_block_seeds(seed, len(phases), Mblocks)
+    if (seed is not None) and (args.dataset_engine == 'loop'):
+        random.seed(seed)
+        np.random.seed(seed)
     testsets = [[] for i in range(Mtestsets)]
     whichtestset = 0                         # a counter
 
-    for phase in phases:   # this method should balance context instances in train and test phases
-        if phase == 'train':
-            N = copy.copy(Ntrain)
+    for phaseidx, phase in enumerate(phases):   # this method should balance context instances in train and test phases
+        N = Ntrain if phase == 'train' else Ntest
+        indices = (np.asarray([i for i in range(N)])).reshape((Mblocks, int(N/Mblocks),1))
+        phasedata = generate_phase(N, Mblocks, args, blockseeds[phaseidx])
+
+        if phase=='train':
+            trainset = shuffle_and_flatten_phase(phasedata, indices, args)
         else:
-            N = copy.copy(Ntest)
-
-        # perhaps set temporary N to N/24, then generate the data under each context and then shuffle order at the end?
-        refValues = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
-        judgementValues = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
-        input = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len, const.TOTALMAXNUM))
-        contextinputs = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len, const.NCONTEXTS ))
-        target = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len))
-        contexts = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len, const.NCONTEXTS))
-        contextdigits = np.empty((Mblocks, int(N/Mblocks),args.BPTT_len))
-        blocks = np.empty((Mblocks, int(N/Mblocks),1))
-        trialTypes = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len), dtype='str')  # 0='filler, 1='compare'; pytorch doesnt like string numpy arrays
-        trialTypeInputs = np.empty((Mblocks, int(N/Mblocks), args.BPTT_len))
-        trainindices = (np.asarray([i for i in range(Ntrain)])).reshape((Mblocks, int(Ntrain/Mblocks),1))
-        testindices = (np.asarray([i for i in range(Ntest)])).reshape((Mblocks, int(Ntest/Mblocks),1))
-
-        fillerRange = [const.FULLR_LLIM,const.FULLR_ULIM]        # the range of numbers spanned by all filler trials
-
-        for block in range(Mblocks):
-
-            if args.which_context==0:
-                # divide the blocks evenly across the 3 contexts
-                if block < Mblocks/const.NCONTEXTS:        # 0-7     # context A
-                    context = 1
-                    minNumerosity = const.FULLR_LLIM
-                    maxNumerosity = const.FULLR_ULIM
-
-                elif block < 2*(Mblocks/const.NCONTEXTS):  # 8-15    # context B
-                    context = 2
-                    minNumerosity = const.LOWR_LLIM
-                    maxNumerosity = const.LOWR_ULIM
-                else:                                # 16-23   # context C
-                    context = 3
-                    minNumerosity = const.HIGHR_LLIM
-                    maxNumerosity = const.HIGHR_ULIM
-            # single context options
-            elif args.which_context==1:     # context A
-                context = 1
-                minNumerosity = const.FULLR_LLIM
-                maxNumerosity = const.FULLR_ULIM
-            elif args.which_context==2:     # context B
-                context = 2
-                minNumerosity = const.LOWR_LLIM
-                maxNumerosity = const.LOWR_ULIM
-            elif args.which_context==3:     # context C
-                context = 3
-                minNumerosity = const.HIGHR_LLIM
-                maxNumerosity = const.HIGHR_ULIM
-
-            if args.all_fullrange:
-                tmpDistribution = [[i for i in range(const.FULLR_LLIM, const.FULLR_ULIM+1)],[j for j in range(const.LOWR_LLIM, const.LOWR_ULIM+1)], [k for k in range(const.HIGHR_LLIM, const.HIGHR_ULIM+1)] ]
-                randNumDistribution = [i for sublist in tmpDistribution for i in sublist]  # non-uniform distr. over all 3 context ranges together
-            else:
-                randNumDistribution = [i for i in range(minNumerosity, maxNumerosity+1)]  # uniform between min and max
-            indexDistribution = [i for i in range(len(randNumDistribution))]  # this is going to allow us to know which context a sample which have been drawn from if intermingled
-
-            # generate some random numerosity data and label whether the random judgement integers are larger than the refValue
-            firstTrialInContext = True              # reset the sequentialAB structure for each new context
-            for sample in range(int(N/Mblocks)):    # each sequence
-                input_sequence = []
-                type_sequence  = generate_trial_sequence(args.include_fillers) # the order of filler trial and compare trials
-                trialtypeinput = [0 for i in range(len(type_sequence))]
-                contextsequence = []
-                contextinputsequence = []
-                previousFillerNum = None
-                previousTrialtype = None
-
-                # generate adjacent sequences of inputs, where no two adjacent elements within (or between) a sequence are the same
-                for item in range(args.BPTT_len):
-                    trial_type = type_sequence[item]
-                    trialtypeinput[item] = 1 if trial_type=='compare' else 0    # provide a bit-flip input to say whether its a filler or compare trial
-
-                    if trial_type == 'compare':
-                        if (firstTrialInContext and (item==0)):
-                            randind = random.choice(indexDistribution)
-                            refValue = randNumDistribution[randind]
-                            if trial_type == 'filler':
-                                print('Warning: sequence starting with a filler trial. This should not happen and will cause a bug in sequence generation.')
-                        else:
-                            refValue = copy.deepcopy(judgementValue)  # use the previous number and make sure its a copy not a reference to same piece of memory
+            testsets[whichtestset] = shuffle_and_flatten_phase(phasedata, indices, args)
+            whichtestset += 1
 
-                        randind = random.choice(indexDistribution)
-                        judgementValue = randNumDistribution[randind]
+    return dict(zip(get_split_names(Mtestsets), [trainset]+testsets))
 
-                        while refValue==judgementValue:    # make sure we dont do inputA==inputB for two adjacent inputs
-                            randind = random.choice(indexDistribution)
-                            judgementValue = randNumDistribution[randind]
-
-                        input2 = turn_one_hot(judgementValue, const.TOTALMAXNUM)
-                        if args.all_fullrange:  # if intermingling contexts, then we need to know which context this number was sampled from
-                            context = turn_index_to_context(randind)
-
-                    else:  # filler trial (note fillers are always from uniform 1:15 range)
-                        input2 = turn_one_hot(random.randint(*fillerRange), const.TOTALMAXNUM)
-                        # make sure (like Fabrice) that after a compare trial the subsequent filler isnt the same as the previous filler
-                        if previousFillerNum is not None and previousTrialtype=='compare':
-                            while all(input2 == previousFillerNum):
-                                input2 = turn_one_hot(random.randint(*fillerRange), const.TOTALMAXNUM) # leave the filler numbers unconstrained just spanning the full range
-
-                        previousFillerNum = copy.copy(input2)
-                        # when the trials are interleaved, set filler trials to have random contets
-                        # (NOTE this doesnt actually matter because context is later zeroed on fillers)
-                        if args.all_fullrange:
-                            context = random.randint(1,3)
-
-                    previousTrialtype = copy.copy(trial_type)
-
-                    # Define the context input to the network
-                    if args.label_context=='true':
-                        contextinput = turn_one_hot(context, const.NCONTEXTS)  # there are 3 different contexts
-                    elif args.label_context=='random':
-                        # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
-                        contextinput = turn_one_hot(random.randint(1,3), const.NCONTEXTS)  # randomly assign each example to a context, (shuffling examples across context markers in training)
-                    elif args.label_context=='constant':
-                        # Note that NOT changing 'context' means that we should be able to see the correct range label in the RDM
-                        contextinput = turn_one_hot(1, const.NCONTEXTS) # just keep this constant across all contexts, so the input doesnt contain an explicit context indicator
-
-                    # add our new inputs to our sequence
-                    input_sequence.append(input2)
-                    contextsequence.append(context)
-                    contextinputsequence.append(contextinput)
-
-                if firstTrialInContext:
-                    judgementValue = turn_one_hot_to_integer(input_sequence[-1])  # and then make sure that the next sequence starts where this one left off (bit of a hack)
-                    firstTrialInContext = False
-
-                # determine the correct rel. magnitude judgement for each pair of adjacent numbers in the sequence
-                rValue = None
-                judgeValue = None
-                allJValues = np.zeros((args.BPTT_len, const.TOTALMAXNUM))
-                allRValues = np.zeros((args.BPTT_len, const.TOTALMAXNUM))
-                for i in range(args.BPTT_len):
-                    trialtype = trialtypeinput[i]
-                    if trialtype==1:  # compare
-                        judgeValue = turn_one_hot_to_integer(input_sequence[i])
-                        if rValue is not None:
-                            if judgeValue==rValue:
-                                print('Warning: something gone wrong at index {}.'.format(i))
-
-                            if judgeValue > rValue:
-                                target[block, sample, i] = 1
-                            else:
-                                target[block, sample, i] = 0
-                        else:
-                            target[block, sample, i] = None  # default dont do anything
 
-                    allJValues[i] = np.squeeze(turn_one_hot(turn_one_hot_to_integer(input_sequence[i]), const.TOTALMAXNUM))
-                    if rValue is None:
-                        allRValues[i] = np.zeros((const.TOTALMAXNUM,))
-                    else:
-                        allRValues[i] = np.squeeze(turn_one_hot(rValue, const.TOTALMAXNUM))
+def write_dataset_chunked(fileloc, datasetname, args, seed=None, sequences_per_chunk=1200):
+    """Generate a dataset chunk by chunk straight into the columnar format on disk (see save_columnar_dataset()),
+    so that only one chunk of sequences is ever in memory, e.g. for training sets of millions of sequences.
+    - each block is generated in chunks of up to sequences_per_chunk sequences, carrying the compare number chain from one chunk
+     to the next, and each chunk is written to its place in the (shuffled) block order of memory-mapped arrays.
+    - the dataset is determined by the seed and sequences_per_chunk; when sequences_per_chunk >= the block size it is the same
+     as create_separate_input_data() with that seed. Always uses the vectorised engine and the columnar format.
+    """
+    if args.dataset_engine != 'vectorised':
+        raise ValueError('Chunked dataset generation needs the vectorised dataset engine')
+    Ntrain, Ntest, Mtestsets, Mblocks = get_dataset_sizes(args)
+    phasesizes = [Ntrain] + [Ntest for i in range(Mtestsets)]
+    blockseeds = get_block_seeds(seed, len(phasesizes), Mblocks)
+    blockorder = shuffle(np.arange(Mblocks), random_state=0)   # the same block order as shuffle_and_flatten_phase()
+    arrange_block = compact_block_codes if args.compact_dataset else expand_block_codes
+    directory = os.path.join(fileloc, datasetname)
+    os.makedirs(directory, exist_ok=True)
+    print('Writing dataset {}/ in chunks of {} sequences...'.format(datasetname, sequences_per_chunk))
+
+    for split, N, phaseseeds in zip(get_split_names(Mtestsets), phasesizes, blockseeds):
+        sequences_per_block = N // Mblocks
+        arrays = None
+        for position, block in enumerate(blockorder):
+            carry = None
+            for chunk, start in enumerate(range(0, sequences_per_block, sequences_per_chunk)):
+                n_sequences = min(sequences_per_chunk, sequences_per_block - start)
+                codes = generate_block_vectorised(block, Mblocks, n_sequences, args, get_chunk_seed(phaseseeds[block], chunk), carry)
+                carry = codes['carry']
+                chunkdata = arrange_block(codes)
+                chunkdata['index'] = (block*sequences_per_block + start + np.arange(n_sequences)).reshape((n_sequences, 1))
+                if arrays is None:
+                    arrays = {field:np.lib.format.open_memmap(os.path.join(directory, split+'_'+field+'.npy'), mode='w+', dtype=array.dtype, shape=(N,)+array.shape[1:]) for field, array in chunkdata.items()}
+                first = position*sequences_per_block + start
+                for field, array in chunkdata.items():
+                    arrays[field][first:first+n_sequences] = array
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+
+def compare_dataset_engines(args, N=480, Mblocks=24, nrepeats=3):
+    """Time the original (loop) and the vectorised dataset generators on the same phase size,
+    and print the throughput of each (sequences generated per second).
+    """
+    originalengine = args.dataset_engine
+    throughput = {}
+    for engine in ['loop', 'vectorised']:
+        args.dataset_engine = engine
+        times = []
+        for repeat in range(nrepeats):
+            blockseeds = get_block_seeds(repeat, 1, Mblocks)[0]
+            tic = time.time()
+            generate_phase(N, Mblocks, args, blockseeds)
+            times.append(time.time() - tic)
+        throughput[engine] = N / np.min(times)
+        print('{} engine: {} sequences in {:.3f}s (best of {}), {:.1f} sequences/s'.format(engine, N, np.min(times), nrepeats, throughput[engine]))
+    args.dataset_engine = originalengine
+    print('Speedup of vectorised over loop engine: {:.1f}x'.format(throughput['vectorised'] / throughput['loop']))
+    return throughput
+
+
+class StreamingDataset(IterableDataset):
+    """A training set that is generated on the fly, for training on an unbounded number of sequences.
+    - sequences follow the same trial scheduling as create_separate_input_data(): Mblocks blocks split evenly across the contexts,
+     in the same shuffled block order, each generated with generate_block_vectorised(). Once all blocks are used, a new round
+     of Mblocks blocks (with new random streams) is generated.
+    - blocks are generated by a background thread into a bounded queue (prefetch blocks deep), so memory stays flat
+     however many sequences are consumed.
+    - each pass over the dataset (e.g. one training epoch) yields sequences_per_epoch sequences, continuing the stream
+     where the previous pass stopped. Use with a DataLoader with num_workers=0 (the background thread does the generating).
+    - if the background thread fails, its error is raised by the next read of the stream (instead of the read waiting forever).
+    - assessmentset (optional) is a fixed, stored CreateDataset from the same schedule, to assess the training performance on
+     without drawing sequences from the stream (see create_streaming_input_data()).
+    """
 
-                    if trialtype==1:
-                        rValue = turn_one_hot_to_integer(input_sequence[i])  # set the previous state to be the current state
+    def __init__(self, args, Mblocks=24, sequences_per_block=120, sequences_per_epoch=2880, seed=None, prefetch=4, assessmentset=None):
+        self.args = args
+        self.Mblocks = Mblocks
+        self.sequences_per_block = sequences_per_block
+        self.sequences_per_epoch = sequences_per_epoch
+        self.seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.prefetch = prefetch
+        self.assessmentset = assessmentset
+        self.n_consumed = 0          # how many sequences have been yielded so far
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._thread = None
+        self._block = None
+        self._position = 0
 
-                if firstTrialInContext:
-                    judgementValue = copy.deepcopy(judgeValue)    # and then make sure that the next sequence starts with judgement where this one left off
+    def __len__(self):
+        return self.sequences_per_epoch
+
+    def _put(self, item):
+        """Put an item into the queue, waiting for room unless close() is called. Returns False if it was."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _generate_blocks(self):
+        """Keep generating blocks into the queue until close() is called (runs in the background thread).
+        An error is put into the queue in place of the next block, for the reader to raise."""
+        blockorder = shuffle(np.arange(self.Mblocks), random_state=0)
+        arrange_block = compact_block_codes if self.args.compact_dataset else expand_block_codes
+        try:
+            while not self._stop.is_set():
+                blockseeds = self.seed.spawn(self.Mblocks)
+                for block in blockorder:
+                    blockdata = arrange_block(generate_block_vectorised(block, self.Mblocks, self.sequences_per_block, self.args, blockseeds[block]))
+                    if not self._put(blockdata):
+                        return
+        except Exception as error:
+            self._put(error)
+
+    def _next_sample(self):
+        if (self._block is None) or (self._position >= self.sequences_per_block):
+            blockdata = self._queue.get()
+            if isinstance(blockdata, Exception):
+                raise RuntimeError('Generating the streamed training set failed') from blockdata
+            self._block = prepare_dataset(blockdata)
+            self._position = 0
+        block, i = self._block, self._position
+        sample = {'index':np.asarray([self.n_consumed]), 'label':block['label'][i], 'refValue':block['refValue'][i], 'judgementValue':block['judgementValue'][i],\
+                  'input':block['input'][i], 'context':block['context'][i], 'contextinput':block['contextinputs'][i], 'trialtypeinput':block['trialtypeinputs'][i]}
+        self._position += 1
+        self.n_consumed += 1
+        return sample
 
-                contextdigits[block, sample] = contextsequence
-                judgementValues[block, sample] = np.squeeze(np.asarray(allJValues))
-                refValues[block, sample] = np.squeeze(np.asarray(allRValues))
-                contexts[block, sample] = np.squeeze([turn_one_hot(contextsequence[i], const.NCONTEXTS) for i in range(len(contextsequence))])  # still captures context here even if we dont feed context label into network
-                contextinputs[block, sample] = np.squeeze(contextinputsequence)
-                #input[block, sample] = np.squeeze(np.concatenate((input2,input1,contextinput)))  # for the MLP
-                input[block, sample] = np.squeeze(np.asarray(input_sequence))             # for the RNN with BPTT
-                blocks[block, sample] = block
-                trialTypes[block, sample] = type_sequence
-                trialTypeInputs[block, sample] = trialtypeinput
+    def __iter__(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._generate_blocks, daemon=True)
+            self._thread.start()
+        for _ in range(self.sequences_per_epoch):
+            yield self._next_sample()
+
+    def close(self):
+        """Stop the background generator thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def create_streaming_input_data(filename, args):
+    """Set up a streamed training set (see StreamingDataset) instead of generating and storing the whole training set.
+    - the test and cross-validation sets are still generated up front and saved (without a training set) for later analysis.
+    - args.sequences_per_epoch sets how many streamed sequences make up one training epoch; the blocks are the size of the training
+     set's blocks (Ntrain/Mblocks sequences, see get_dataset_sizes()).
+    - the training performance is assessed on a fixed sample of Ntest sequences from the training schedule, generated from its own
+     random stream (the stream after the test sets'), so assessing it neither uses up nor shifts the training sequences.
+    - the test sets, assessment sample and training stream are generated from the dataset seed (get_dataset_seed()), so a streamed run is reproducible.
+    - the spec format cannot be used: regenerating from a spec would generate (and store) the whole training set.
+    """
+    if args.dataset_format == 'spec':
+        raise ValueError('--stream-train cannot save its test sets in the spec format (--dataset-format spec), use pickle or columnar')
+    print('Generating test sets and streaming the training set...')
+    Ntrain, Ntest, Mtestsets, Mblocks = get_dataset_sizes(args)
+    seed = get_dataset_seed(args)
+    phaseseeds = np.random.SeedSequence(seed).spawn(Mtestsets+2)   # phase 0 is the (streamed) training set, as in get_block_seeds(), and the last the assessment sample
+    indices = (np.asarray([i for i in range(Ntest)])).reshape((Mblocks, int(Ntest/Mblocks),1))
+    testsets = [shuffle_and_flatten_phase(generate_phase(Ntest, Mblocks, args, phaseseeds[i+1].spawn(Mblocks)), indices, args) for i in range(Mtestsets)]
+    assessmentset = shuffle_and_flatten_phase(generate_phase(Ntest, Mblocks, args, phaseseeds[Mtestsets+1].spawn(Mblocks)), indices, args)
+
+    dat = dict(zip(get_split_names(Mtestsets), [None]+testsets))
+    save_dataset(const.DATASET_DIRECTORY, filename, dat, args, seed)
+
+    trainset = StreamingDataset(args, Mblocks=Mblocks, sequences_per_block=Ntrain//Mblocks, sequences_per_epoch=args.sequences_per_epoch,\
+                                seed=phaseseeds[0], assessmentset=CreateDataset(assessmentset))
+    testset = CreateDataset(testsets[0])
+    return trainset, testset
 
-        if phase=='train':
 
-            # now shuffle the training block order so that we temporally separate contexts a bit but still blocked
-            input, refValues, judgementValues, target, contexts, contextdigits, trainindices, blocks, contextinputs, trialTypeInputs = shuffle(input, refValues, judgementValues, target, contexts, contextdigits, trainindices, blocks, contextinputs, trialTypeInputs, random_state=0)
-
-            # now flatten across the first dim of the structure
-            input = flatten_first_dim(input)
-            refValues = flatten_first_dim(refValues)
-            judgementValues = flatten_first_dim(judgementValues)
-            target = flatten_first_dim(target)
-            contexts = flatten_first_dim(contexts)
-            contextdigits = flatten_first_dim(contextdigits)
-            trainindices = flatten_first_dim(trainindices)
-            blocks = flatten_first_dim(blocks)
-            contextinputs = flatten_first_dim(contextinputs)
-            trialTypeInputs  = flatten_first_dim(trialTypeInputs)
-
-            trainset = { 'refValue':refValues, 'judgementValue':judgementValues, 'input':input, 'label':target, 'index':trainindices, 'context':contexts, 'contextdigits':contextdigits, 'contextinputs':contextinputs, "trialtypeinputs":trialTypeInputs }
-        else:
+def generate_block_task(task):
+    """Generate one block of one phase of one dataset for generate_datasets_parallel() (runs in a worker process)."""
+    specidx, phaseidx, block, N, Mblocks, args, seed = task
+    tic = time.time()
+    codes = generate_block_vectorised(block, Mblocks, int(N/Mblocks), args, seed)
+    return specidx, phaseidx, block, codes, time.time()-tic
 
-            # now shuffle the training block order so that we temporally separate contexts a bit but still blocked
-            input, refValues, judgementValues, target, contexts, contextdigits, testindices, blocks, contextinputs, trialTypeInputs = shuffle(input, refValues, judgementValues, target, contexts, contextdigits, testindices, blocks, contextinputs, trialTypeInputs,  random_state=0)
-
-            # now flatten across the first dim of the structure
-            input = flatten_first_dim(input)
-            refValues = flatten_first_dim(refValues)
-            judgementValues = flatten_first_dim(judgementValues)
-            target = flatten_first_dim(target)
-            contexts = flatten_first_dim(contexts)
-            contextdigits = flatten_first_dim(contextdigits)
-            testindices = flatten_first_dim(testindices)
-            blocks = flatten_first_dim(blocks)
-            contextinputs = flatten_first_dim(contextinputs)
-            trialTypeInputs  = flatten_first_dim(trialTypeInputs)
-
-            testsets[whichtestset] = { 'refValue':refValues, 'judgementValue':judgementValues, 'input':input, 'label':target, 'index':testindices, 'context':contexts, 'contextdigits':contextdigits, 'contextinputs':contextinputs, "trialtypeinputs":trialTypeInputs }
-            whichtestset += 1
 
-    # save the dataset so we can use it again
-    testset = testsets[0]
-    crossvalset = testsets[1]
-    dat = {"trainset":trainset, "testset":testset, "crossval_testset":crossvalset}
-    np.save(const.DATASET_DIRECTORY+filename+'.npy', dat)
+def generate_datasets_parallel(specs, n_workers=None):
+    """Generate and save a dataset for each (args, model_id) in specs, with the blocks of all datasets spread across a process pool.
+    - every block has its own random stream, derived from the dataset seed (get_dataset_seed()) with get_block_seeds(),
+     so each dataset is the same whatever the number of workers, and the same as create_separate_input_data() with that seed.
+    - datasets are saved under their usual name (get_dataset_name()), or through the dataset cache if args.dataset_cache.
+    - blocks are always generated with the vectorised engine.
+    """
+    import magnitude_network as mnet   # (imported here as magnitude_network imports this module)
+
+    n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+
+    # one task per block of each phase of each dataset
+    datasets, tasks = [], []
+    for specidx, (args, model_id) in enumerate(specs):
+        specargs = copy.copy(args)
+        specargs.model_id = model_id
+        specargs.dataset_engine = 'vectorised'
+        seed = get_dataset_seed(specargs)
+        datasetname, _, _, _ = mnet.get_dataset_name(specargs)
+        Ntrain, Ntest, Mtestsets, Mblocks = get_dataset_sizes(specargs)
+        phasesizes = [Ntrain] + [Ntest for i in range(Mtestsets)]
+        datasets.append({'args':specargs, 'name':datasetname, 'seed':seed, 'phasesizes':phasesizes, 'blocks':[[None for b in range(Mblocks)] for N in phasesizes], 'n_done':0, 'worker_time':0.})
+        blockseeds = get_block_seeds(seed, len(phasesizes), Mblocks)
+        for phaseidx, N in enumerate(phasesizes):
+            for block in range(Mblocks):
+                tasks.append((specidx, phaseidx, block, N, Mblocks, specargs, blockseeds[phaseidx][block]))
+
+    print('Generating {} datasets ({} blocks) with {} workers...'.format(len(specs), len(tasks), n_workers))
+    tic = time.time()
+    n_complete = 0
+    with multiprocessing.Pool(n_workers) as pool:
+        for specidx, phaseidx, block, codes, blocktime in pool.imap_unordered(generate_block_task, tasks):
+            dataset = datasets[specidx]
+            dataset['blocks'][phaseidx][block] = codes
+            dataset['n_done'] += 1
+            dataset['worker_time'] += blocktime
+            phasesizes, Mblocks = dataset['phasesizes'], len(dataset['blocks'][0])
+            if dataset['n_done'] < len(phasesizes)*Mblocks:
+                continue
+
+            # all blocks of this dataset are done: assemble it in the usual block order, save it and free the blocks
+            specargs = dataset['args']
+            splits = []
+            for phaseidx, N in enumerate(phasesizes):
+                indices = (np.asarray([i for i in range(N)])).reshape((Mblocks, int(N/Mblocks),1))
+                splits.append(shuffle_and_flatten_phase(assemble_phase(dataset['blocks'][phaseidx], specargs), indices, specargs))
+            dat = dict(zip(get_split_names(len(phasesizes)-1), splits))
+            dataset['blocks'] = None
+            if specargs.dataset_cache:
+                key, params = get_dataset_cache_key(specargs)
+                save_dataset(const.DATASET_CACHE_DIRECTORY, key, dat, specargs, dataset['seed'])
+                record_cached_dataset(key, params, dataset['name'], specargs)
+            else:
+                save_dataset(const.DATASET_DIRECTORY, dataset['name'], dat, specargs, dataset['seed'])
 
-    # turn out datasets into pytorch Datasets
-    trainset = CreateDataset(trainset)
-    testset = CreateDataset(testset)
+            n_complete += 1
+            print('[{}/{}] {} (seed {}): {:.2f}s of worker time, done after {:.2f}s'.format(n_complete, len(specs), dataset['name'], dataset['seed'], dataset['worker_time'], time.time()-tic))
 
-    return trainset, testset
+    print('Generated {} datasets in {:.2f}s'.format(len(specs), time.time()-tic))
@@ -23,6 +23,12 @@ import sys
 import random
 import json
 import math
+import time
+import os
+import multiprocessing
+import queue
+import contextlib
+import hashlib
 
 import torch
 import torch.nn as nn
@@ -31,8 +37,9 @@ import torch.nn.functional as F
 import torchvision
 from sklearn.manifold import MDS
 from sklearn.utils import shuffle
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Subset
 from torch.utils.tensorboard import SummaryWriter
+from torch.utils.checkpoint import checkpoint
 
 # for training I/O
 from datetime import datetime
@@ -93,13 +100,210 @@ def plot_grad_flow(args, layers, ave_grads, max_grads, batch_number):
     #mplt.save_figure('figures/gradients/gradflow_{}_'.format(batch_number), args, 'recurrent', blockTrain, seqTrain, True, givenContext, False, noise_std, retainHiddenState, False, 'compare', True)
 
 
-def recurrent_train(args, model, device, train_loader, optimizer, criterion, epoch, printOutput=True):
+def get_recurrent_inputs(data):
+    """Return the network input at each step of a batch of sequences (a list of (batch, D) tensors: [number, context label, trial type]),
+    along with the labels and trial types. Works on a precomposed batch (see dset.SequenceBatchLoader), where the inputs are
+    just slices of the stored tensor, and on a regular DataLoader batch, where they are built step by step.
+    """
+    labels = data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1)
+    trialtype = batch_to_torch(data['trialtypeinput']).unsqueeze(2)
+
+    if 'networkinput' in data:
+        networkinput = data['networkinput']
+        recurrentinputs = [networkinput[:, i] for i in range(networkinput.shape[1])]
+    else:
+        inputs, contextsequence = batch_to_torch(data['input']), batch_to_torch(data['contextinput'])
+        recurrentinputs = []
+        for i in range(inputs.shape[1]):
+            context = contextsequence[:,i]
+            if trialtype[0,i]==0:  # remove context indicator on the filler trials
+                context_in = torch.full_like(context, 0)
+            else:
+                context_in = copy.deepcopy(context)
+            inputX = torch.cat((inputs[:, i], context_in, trialtype[:,i]),1)
+            recurrentinputs.append(inputX)
+
+    return recurrentinputs, labels, trialtype
+
+
+def get_compare_mask(trialtype):
+    """Return the (batch, seq_len) bool mask of the trials the loss is taken on: every compare trial except the first trial of a sequence."""
+    comparemask = trialtype.reshape(trialtype.shape[0], -1) == 1
+    comparemask[:, 0] = False
+    return comparemask
+
+
+def masked_compare_loss(outputs, labels, comparemask):
+    """Return the summed binary cross entropy loss, the number of correct responses and the number of trials assessed,
+    over the comparemask trials of a batch of sequences, in one go rather than trial by trial.
+    - outputs (batch, seq_len, 1), labels and comparemask (batch, seq_len).
+    - the loss is the same as summing criterion(output, label) (nn.BCELoss) over the trials, and the count the same as answer_correct().
+    - the loss is always taken in float32 (also on reduced precision outputs, see precision_context()).
+    """
+    compareoutputs = outputs[comparemask].float()
+    comparelabels = labels[comparemask].unsqueeze(1)
+    loss = F.binary_cross_entropy(compareoutputs, comparelabels, reduction='sum')
+    n_correct = ((compareoutputs > 0.5).float() == comparelabels).sum().item()
+    return loss, n_correct, compareoutputs.shape[0]
+
+
+def lesion_number_input(inputX):
+    """Return a copy of the network input for one step with the number input zeroed (lesioned)."""
+    lesionedinput = inputX.clone()
+    lesionedinput[:, :const.TOTALMAXNUM] = 0
+    return lesionedinput
+
+
+def rnn_step_kernel(x, hidden, w_hidden, b_hidden, w_fc1, b_fc1, w_out, b_out):
+    """One step of OneStepRNN as a plain function of its weights, for TorchScript (see get_scripted_kernels()).
+    Returns the output, the new hidden state and the fc1 activations."""
+    combined = torch.cat((x, hidden), 1)
+    newhidden = torch.relu(F.linear(combined, w_hidden, b_hidden))
+    fc1_activations = torch.relu(F.linear(combined, w_fc1, b_fc1))
+    output = torch.sigmoid(F.linear(fc1_activations, w_out, b_out))
+    return output, newhidden, fc1_activations
+
+
+def rnn_sequence_kernel(inputs, h0, noise, w_hidden, b_hidden, w_fc1, b_fc1, w_out, b_out):
+    """The time loop of OneStepRNN over a batch of whole sequences (inputs (batch, seq_len, D_in)), for TorchScript,
+    adding noise[step] to the hidden state before each step. Returns the outputs, hidden states and fc1 activations at every step."""
+    hidden = h0
+    outputs = []
+    hiddens = []
+    fc1s = []
+    for step in range(inputs.shape[1]):
+        hidden = hidden + noise[step]
+        output, hidden, fc1_activations = rnn_step_kernel(inputs[:, step], hidden, w_hidden, b_hidden, w_fc1, b_fc1, w_out, b_out)
+        outputs.append(output)
+        hiddens.append(hidden)
+        fc1s.append(fc1_activations)
+    return torch.stack(outputs, 1), torch.stack(hiddens, 1), torch.stack(fc1s, 1)
+
+
+scripted_kernels = {}
+def get_scripted_kernels():
+    """Return the TorchScript-compiled rnn_step_kernel() and rnn_sequence_kernel(), compiling them on first use (so that there is no
+    cost unless --scripted is used)."""
+    if not scripted_kernels:
+        scripted_kernels['step'] = torch.jit.script(rnn_step_kernel)
+        scripted_kernels['sequence'] = torch.jit.script(rnn_sequence_kernel)
+    return scripted_kernels
+
+
+def precision_context(args):
+    """Return the context to run the network in: with args.bf16, CPU autocast to bfloat16 (the weights stay float32, and each
+    matmul runs in bfloat16), otherwise a context that does nothing. The loss is taken outside it, in float32."""
+    if not getattr(args, 'bf16', False):
+        return contextlib.nullcontext()
+    if getattr(args, 'scripted', False):
+        raise ValueError('--bf16 runs the network eagerly under autocast, and cannot be combined with --scripted')
+    return torch.autocast('cpu', dtype=torch.bfloat16)
+
+
+def recurrent_step(args, model, x, hidden):
+    """One step of the network, model(x, hidden), or the same step with the TorchScript kernel if args.scripted."""
+    if getattr(args, 'scripted', False):
+        return model.forward_scripted(x, hidden)
+    return model(x, hidden)
+
+
+def forward_window(args, model, stepinputs, hidden, start, stop):
+    """Run the recurrence from the hidden state hidden over steps start:stop of a batch of sequences (stepinputs is the (batch, D)
+    network input at each step). Returns the outputs (batch, stop-start, 1), the hidden state after the last step and the (detached)
+    hidden state just before the last input in the sequence is presented (None if that step is not in the window).
+    - with args.activation_checkpointing, only the hidden state at the start of each segment of args.activation_segment steps
+       (0: about sqrt(stop-start) steps) is kept for backprop, and each segment is recomputed during the backwards pass
+       (torch.utils.checkpoint), giving the same gradients in O(sqrt(L)) rather than O(L) activation memory.
+    - with args.scripted, the whole window is run by the TorchScript time loop (or, with checkpointing, each step by the TorchScript step).
+    """
+    sequenceLength = len(stepinputs)
+    checkpointed = getattr(args, 'activation_checkpointing', False) and torch.is_grad_enabled()
+    # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0). Drawn up front, so a recomputed segment sees the same noise
+    noise = [torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape))) for item_idx in range(start, stop)]
+
+    if getattr(args, 'scripted', False) and not checkpointed:
+        outputs, hiddens, _ = model.forward_scripted_sequence(torch.stack(stepinputs[start:stop], 1), hidden, torch.stack(noise).to(hidden.dtype))
+        latentstate = hiddens[:, sequenceLength-2-start].detach() if (start <= sequenceLength-2 < stop) else None
+        return outputs, hiddens[:, -1], latentstate
+
+    def run_steps(hidden, first, last):
+        outputs, latentstate = [], None
+        for item_idx in range(first, last):
+            if not checkpointed:
+                hidden.add_(noise[item_idx-start])
+            elif model.hidden_noise:
+                hidden = hidden + noise[item_idx-start].to(hidden.dtype)
+            output, hidden = recurrent_step(args, model, stepinputs[item_idx], hidden)
+            outputs.append(output)
+            if item_idx==(sequenceLength-2):                  # extract the hidden state just before the last input in the sequence is presented
+                latentstate = hidden.detach()
+        return torch.stack(outputs, 1), hidden, latentstate
+
+    if not checkpointed:
+        return run_steps(hidden, start, stop)
+
+    segment = args.activation_segment if args.activation_segment > 0 else int(math.ceil(math.sqrt(stop - start)))
+    outputs, latentstate = [], None
+    for first in range(start, stop, segment):
+        segmentoutputs, hidden, segmentlatent = checkpoint(run_steps, hidden, first, min(first + segment, stop), use_reentrant=False)
+        outputs.append(segmentoutputs)
+        latentstate = segmentlatent if segmentlatent is not None else latentstate
+    return torch.cat(outputs, 1), hidden, latentstate
+
+
+def train_bptt_windows(args, model, optimizer, stepinputs, hidden, labels, comparemask, gradrecorder=None, scale=1.):
+    """Run the recurrence over a batch of sequences from the hidden state hidden, and train the network on their compare trials,
+    with one weight update per truncated backprop-through-time window:
+    - with args.bptt_window=k (>0) the hidden state is detached every k steps, and the weights are updated on the loss of each window of
+       k steps, so autograd only holds k steps at a time. With k=0 the whole sequence is one window (one update per sequence).
+    - each window is run with forward_window() (optionally with activation checkpointing).
+    - stepinputs is the (batch, D) network input at each step, labels and comparemask are (batch, seq_len);
+       the loss minimised in each window is masked_compare_loss() x scale.
+    - returns the loss summed over the sequence (a float), the number of correct responses and of trials assessed,
+       and the (detached) hidden state just before the last input in the sequence is presented.
+    """
+    sequenceLength = len(stepinputs)
+    window = args.bptt_window if args.bptt_window > 0 else sequenceLength
+    total_loss, correct, n_evaluated, latentstate = 0., 0, 0, None
+
+    for start in range(0, sequenceLength, window):
+        stop = min(start + window, sequenceLength)
+        optimizer.zero_grad()   # zero the parameter gradients
+        with precision_context(args):
+            outputs, hidden, windowlatent = forward_window(args, model, stepinputs, hidden, start, stop)
+        latentstate = windowlatent if windowlatent is not None else latentstate
+
+        # for 'compare' trials only, evaluate performance at every comparison between the current input and previous 'compare' input
+        loss, n_correct, n_assessed = masked_compare_loss(outputs, labels[:, start:stop], comparemask[:, start:stop])
+        correct += n_correct
+        n_evaluated += n_assessed
+        total_loss += loss.item()
+
+        if n_assessed > 0:        # (a short window can hold no compare trials)
+            (loss * scale).backward()
+
+            # record our gradients
+            if gradrecorder is not None:
+                gradrecorder.record()
+
+            optimizer.step()            # update our weights
+        hidden = hidden.detach()        # (truncate backprop at the window boundary)
+
+    return total_loss, correct, n_evaluated, latentstate
+
+
+def recurrent_train(args, model, device, train_loader, optimizer, criterion, epoch, printOutput=True, progress=None, checkpointer=None, gradrecorder=None):
     """ Train a recurrent neural network on the training set.
     This now trains whilst retaining the hidden state across all trials in the training sequence
     but being evaluated just on pairs of inputs and considering each input pair as a trial for minibatching.
     - we lesion the number input on compare trails with frequency args.train_lesion_freq to enhances the network's use of local context
     - we will include in our total cost function the performance when assessed on a trial that is lesioned
        AND on the compare trial after a lesion
+    - progress (optional) resumes the epoch part way through, from a checkpoint (see save_training_checkpoint()),
+       and checkpointer (optional) is called with the progress so far every args.checkpoint_interval batches.
+    - gradrecorder (optional, see GradientRecorder) records the gradient statistics after each backwards pass.
+    - the weights are updated once per sequence, or once per truncated BPTT window of args.bptt_window steps (see train_bptt_windows()).
+    - with args.bf16 the network runs in bfloat16 autocast, with float32 weights and loss (see precision_context()).
      """
     model.train()
     train_loss = 0
@@ -108,88 +312,558 @@ def recurrent_train(args, model, device, train_loader, optimizer, criterion, epo
     # On the very first trial on training, reset the hidden weights to zeros
     hidden = torch.zeros(args.batch_size, model.recurrent_size)
     latentstate = torch.zeros(args.batch_size, model.recurrent_size)
+    if progress is not None:
+        train_loss, correct, latentstate = progress['train_loss'], progress['correct'], progress['latentstate']
 
     for batch_idx, data in enumerate(train_loader):
-        optimizer.zero_grad()   # zero the parameter gradients
-        inputs, labels, contextsequence, trialtype = batch_to_torch(data['input']), data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1), batch_to_torch(data['contextinput']), batch_to_torch(data['trialtypeinput']).unsqueeze(2)
+        if (progress is not None) and (batch_idx < progress['batch']):
+            continue   # (already trained on before the checkpoint)
+        if gradrecorder is not None:
+            gradrecorder.start_batch()
+        recurrentinputs, labels, trialtype = get_recurrent_inputs(data)
 
         # initialise everything for our recurrent model
-        recurrentinputs = []
-        sequenceLength = inputs.shape[1]
+        sequenceLength = len(recurrentinputs)
         n_comparetrials = np.nansum(np.nansum(trialtype))
-        layers, ave_grads, max_grads = [[] for i in range(3)]
         lesionRecord = np.zeros((sequenceLength,))
-        loss = 0
         alternate_lesion_trial = True  # for retraining decoder, lesion alternate trials
 
         for i in range(sequenceLength):
-            context = contextsequence[:,i]
-            lesionedinput = inputs[:,i]
-            if trialtype[0,i]==0:  # remove context indicator on the filler trials
-                context_in = torch.full_like(context, 0)
-            else:
-                context_in = copy.deepcopy(context)
+            if trialtype[0,i]==1:
                 if args.retrain_decoder:
                     if alternate_lesion_trial: # alternately lesion the number input on compare trials
                         lesionRecord[i] = 1
-                        lesionedinput = torch.full_like(inputs[:,i],0)
+                        recurrentinputs[i] = lesion_number_input(recurrentinputs[i])
                 else:
                     if (random.random() < args.train_lesion_freq): # occasionally lesion the number input on compare trials
                         lesionRecord[i] = 1
-                        lesionedinput = torch.full_like(inputs[:,i],0)
+                        recurrentinputs[i] = lesion_number_input(recurrentinputs[i])
 
             alternate_lesion_trial = False if alternate_lesion_trial else True
-            inputX = torch.cat((lesionedinput, context_in, trialtype[:,i]),1)
-            recurrentinputs.append(inputX)
 
         if not args.retain_hidden_state:
             hidden = torch.zeros(args.batch_size, model.recurrent_size)  # only if you want to reset hidden recurrent weights
         else:
             hidden = latentstate # keep hidden state to reflect recent statistics of previous inputs
 
-        # perform N-steps of recurrence
-        for item_idx in range(sequenceLength):
-            # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
-            noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape)))
-            hidden.add_(noise)
-            output, hidden = model(recurrentinputs[item_idx], hidden)
-            if item_idx==(sequenceLength-2):                  # extract the hidden state just before the last input in the sequence is presented
-                latentstate = hidden.detach()
+        # perform N-steps of recurrence, training on the 'compare' trials
+        loss, n_correct, _, latentstate = train_bptt_windows(args, model, optimizer, recurrentinputs, hidden, labels.reshape(1, -1), get_compare_mask(trialtype), gradrecorder)
+        correct += n_correct
+        train_loss += loss
+
+        if batch_idx % args.log_interval == 0:
+            if printOutput:
+                print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(epoch, batch_idx * recurrentinputs[0].shape[0], len(train_loader.dataset),
+                    100. * batch_idx / len(train_loader), loss))
+
+        if is_checkpoint_batch(args, checkpointer, batch_idx, train_loader):
+            checkpointer({'batch':batch_idx+1, 'train_loss':train_loss, 'correct':correct, 'latentstate':latentstate})
+
+    train_loss /= len(train_loader.dataset)*(n_comparetrials-1)
+    accuracy = 100. * correct / (len(train_loader.dataset)*(n_comparetrials-1))
+    return train_loss, accuracy
+
+
+def is_checkpoint_batch(args, checkpointer, batch_idx, train_loader):
+    """Return True if a mid-epoch checkpoint is due after this batch (every args.checkpoint_interval batches, but not after the last batch:
+    the end of the epoch is checkpointed once the network has been assessed)."""
+    if (checkpointer is None) or (not args.checkpoint_interval):
+        return False
+    return ((batch_idx+1) % args.checkpoint_interval == 0) and (batch_idx+1 < len(train_loader))
+
+
+def get_checkpoint_name(trainingrecord_name, batch_size, lr):
+    """Return the file the training checkpoint of a run is saved to."""
+    return const.CHECKPOINT_DIRECTORY + 'checkpoint' + trainingrecord_name + '_bs{}_lr{}.pth'.format(batch_size, lr)
+
+
+def save_training_checkpoint(checkpointname, model, optimizer, epoch, trainingPerformance, testPerformance, progress=None, testPerformanceMethod=None, convergence=None, datachecksum=None):
+    """Save everything needed to continue a training run exactly where it stopped (see --resume):
+    the model and optimizer (SGD momentum) state, the epoch (and with progress, the position within it, the carried latentstate and
+    the running loss/accuracy of the epoch so far), the python/numpy/torch random states, the performance so far,
+    and the state of the early stopping monitor (convergence, see ConvergenceMonitor.state_dict()).
+    - epoch is the epoch to continue from: part way through if progress is given, otherwise from its start.
+    - datachecksum identifies the data the run is trained on (see get_training_data_checksum()), so it is only resumed on the same data.
+    - written to a temporary file first, so that a run killed while saving still has its previous checkpoint.
+    """
+    checkpoint = {'model':model.state_dict(), 'optimizer':optimizer.state_dict(), 'epoch':epoch, 'progress':progress,\
+                  'trainingPerformance':trainingPerformance, 'testPerformance':testPerformance, 'testPerformanceMethod':testPerformanceMethod,\
+                  'convergence':convergence, 'datachecksum':datachecksum, 'rng':{'python':random.getstate(), 'numpy':np.random.get_state(), 'torch':torch.get_rng_state()}}
+    os.makedirs(os.path.dirname(checkpointname), exist_ok=True)
+    torch.save(checkpoint, checkpointname+'.tmp')
+    os.replace(checkpointname+'.tmp', checkpointname)
+
+
+def load_training_checkpoint(checkpointname, model, optimizer, monitor=None, datachecksum=None):
+    """Restore the model, optimizer and random states (and the early stopping monitor, if given) from a checkpoint saved by
+    save_training_checkpoint(), and return (epoch, progress, trainingPerformance, testPerformance, testPerformanceMethod) to continue training from.
+    - raises a ValueError if the checkpoint was not trained on the data with checksum datachecksum (see get_training_data_checksum())."""
+    checkpoint = torch.load(checkpointname, weights_only=False)   # (our own checkpoint, which pickles the numpy RNG state and performance values)
+    if checkpoint.get('datachecksum') != datachecksum:
+        raise ValueError('Cannot resume from checkpoint {}: it was trained on different data (or saved without a dataset checksum)'.format(checkpointname))
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    if (monitor is not None) and (checkpoint.get('convergence') is not None):
+        monitor.load_state_dict(checkpoint['convergence'])
+    random.setstate(checkpoint['rng']['python'])
+    np.random.set_state(checkpoint['rng']['numpy'])
+    torch.set_rng_state(checkpoint['rng']['torch'])
+    return checkpoint['epoch'], checkpoint['progress'], checkpoint['trainingPerformance'], checkpoint['testPerformance'], checkpoint['testPerformanceMethod']
+
+
+def is_evaluation_epoch(args, epoch, n_epochs):
+    """Return True if the network should be assessed after this epoch: every args.eval_every epochs
+    (args.eval_every=0: only after the final epoch), and always after the final epoch."""
+    return (epoch == n_epochs) or (args.eval_every > 0 and epoch % args.eval_every == 0)
+
+
+def evaluation_worker(args, evaltrainloaders, testloaders, log_dir, jobs, results):
+    """Run the per-epoch assessments of a training run in a background process (see AsyncEvaluator):
+    for each (epoch, weights, standard train performance, final) job, assess a copy of the network with those weights on the train and
+    test sets exactly as the synchronous path does, write the scalars to TensorBoard and send back the test accuracy."""
+    torch.set_num_threads(args.eval_threads)
+    model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, args.noise_std, args.recurrent_size, args.hidden_size)
+    criterion = nn.BCELoss()
+    writer = SummaryWriter(log_dir=log_dir)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, weights, standard_train_loss, standard_train_accuracy, final = job
+        model.load_state_dict(weights)
+        fair_train_loss, fair_train_accuracy = recurrent_test(args, model, None, evaltrainloaders[final], criterion, False)
+        test_loss, test_accuracy = recurrent_test(args, model, None, testloaders[final], criterion, False)
+        log_performance(writer, epoch, [standard_train_loss, standard_train_accuracy, fair_train_loss, fair_train_accuracy], [test_loss, test_accuracy])
+        results.put((epoch, test_accuracy))
+    writer.close()
+
+
+class AsyncEvaluator():
+    """Hand the per-epoch assessment of the network to a background process, so that training can go straight on to the next epoch.
+    - submit() snapshots the weights at the end of an epoch; results() waits for the remaining assessments and returns {epoch: test accuracy}.
+    - the assessments are the same recurrent_test() calls as the synchronous path, on the same data, so the results are identical
+      (with hidden noise off, model.hidden_noise=0, as it is in use); they are just delivered later.
+    - the worker has its own torch thread budget (args.eval_threads), and writes the TensorBoard scalars itself.
+    - on Linux the worker is forked, sharing the datasets and loaders with the training process; elsewhere (no fork on Windows,
+      fork is unsafe with torch threads on macOS) it is spawned, and they are pickled over to it once.
+      Either way the loaders must be over stored datasets: a streamed training set (dset.StreamingDataset) is generated by a thread
+      of the training process, which the worker does not have.
+    - poll() collects the assessments finished so far, and settled_methods() marks the epochs still pending as not assessed,
+      so that a checkpoint never claims an assessment it doesnt have the result of.
+    """
+
+    def __init__(self, args, evaltrainloaders, testloaders, log_dir):
+        context = multiprocessing.get_context('fork' if sys.platform.startswith('linux') else 'spawn')
+        self.jobs = context.Queue()
+        self.resultqueue = context.Queue()
+        self.pending = set()
+        self.worker = context.Process(target=evaluation_worker, args=(args, evaltrainloaders, testloaders, log_dir, self.jobs, self.resultqueue), daemon=True)
+        self.worker.start()
+
+    def submit(self, epoch, model, standard_train_loss, standard_train_accuracy, final):
+        weights = {name:value.detach().clone() for name, value in model.state_dict().items()}
+        self.jobs.put((epoch, weights, standard_train_loss, standard_train_accuracy, final))
+        self.pending.add(epoch)
+
+    def poll(self):
+        """Return {epoch: test accuracy} for the assessments that have finished since the last poll(), without waiting."""
+        performance = {}
+        while True:
+            try:
+                epoch, test_accuracy = self.resultqueue.get_nowait()
+            except queue.Empty:
+                break
+            performance[epoch] = test_accuracy
+            self.pending.discard(epoch)
+        return performance
+
+    def settled_methods(self, testPerformanceMethod):
+        """Return a copy of testPerformanceMethod with the epochs still being assessed marked as not assessed (None)."""
+        return [None if epoch in self.pending else method for epoch, method in enumerate(testPerformanceMethod)]
+
+    def results(self):
+        """Wait for the remaining assessments, stop the worker and return {epoch: test accuracy} for them."""
+        performance = dict(self.resultqueue.get() for i in range(len(self.pending)))
+        self.pending.clear()
+        self.jobs.put(None)
+        self.worker.join()
+        return performance
+
+
+class ConvergenceMonitor():
+    """Decide when to stop training early (see --early-stop-patience): track the test accuracy smoothed over the assessed epochs
+    (an exponential moving average, smoothed = smoothing*smoothed + (1-smoothing)*accuracy), and stop once it has not improved on
+    its best by more than min_delta (% accuracy) for patience assessments in a row.
+    - the weights at the best smoothed accuracy are kept, and restore() puts them back into the model at the end of training.
+    - epochs that were not assessed (None, see --eval-every) are skipped, so patience counts assessments rather than epochs.
+    - with patience=0 it is disabled: update() never stops training and restore() leaves the model as it is.
+    """
+
+    def __init__(self, patience=0, min_delta=0., smoothing=0.):
+        self.enabled = patience > 0
+        self.patience = patience
+        self.min_delta = min_delta
+        self.smoothing = smoothing
+        self.smoothed = None
+        self.best = None
+        self.best_epoch = None
+        self.best_weights = None
+        self.n_stale = 0
+
+    def update(self, epoch, accuracy, model):
+        """Take the test accuracy after an epoch, and return True if training should stop."""
+        if (not self.enabled) or (accuracy is None):
+            return False
+        self.smoothed = accuracy if self.smoothed is None else self.smoothing*self.smoothed + (1-self.smoothing)*accuracy
+        if (self.best is None) or (self.smoothed > self.best + self.min_delta):
+            self.best, self.best_epoch, self.n_stale = self.smoothed, epoch, 0
+            self.best_weights = {name:value.detach().clone() for name, value in model.state_dict().items()}
+        else:
+            self.n_stale += 1
+        return self.n_stale >= self.patience
+
+    def restore(self, model):
+        """Load the best weights back into the model (if there are any)."""
+        if self.enabled and (self.best_weights is not None):
+            model.load_state_dict(self.best_weights)
+
+    def state_dict(self):
+        return {'smoothed':self.smoothed, 'best':self.best, 'best_epoch':self.best_epoch, 'best_weights':self.best_weights, 'n_stale':self.n_stale}
+
+    def load_state_dict(self, state):
+        self.smoothed, self.best, self.best_epoch, self.best_weights, self.n_stale = state['smoothed'], state['best'], state['best_epoch'], state['best_weights'], state['n_stale']
+
+
+def get_subsample_loader(args, dataset, loader):
+    """Return a loader over a fixed stratified subsample of args.eval_subsample sequences of dataset (see dset.stratified_subsample()),
+    or the full loader if args.eval_subsample is 0 or the dataset cannot be subsampled (a streamed training set).
+    - the hidden state is still carried from one subsampled sequence to the next, so this estimates the full assessment.
+    """
+    if (not args.eval_subsample) or (not isinstance(dataset, dset.CreateDataset)) or (args.eval_subsample >= len(dataset)):
+        return loader, 'full'
+    indices = dset.stratified_subsample(dataset, args.eval_subsample)
+    if args.precompose_inputs:
+        subsampleloader = dset.SequenceBatchLoader(dataset, batch_size=args.test_batch_size, indices=indices)
+    else:
+        subsampleloader = DataLoader(Subset(dataset, indices), batch_size=args.test_batch_size, shuffle=False)
+    return subsampleloader, 'subsample{}'.format(len(indices))
+
+
+class GradientRecorder():
+    """Record gradient statistics during training, to check that gradients are flowing well through our RNN
+    (replaces calling plot_grad_flow() from the training loop).
+    - call start_batch() at the start of each training batch and record() just after each backwards pass: every interval batches,
+      the norm, mean abs and max abs gradient of each parameter are written into preallocated tensors (no python-side lists, no plotting).
+      Batches are counted over the whole run (n_batches, the TensorBoard step). A batch with several weight updates (see --bptt-window)
+      is recorded at its first one.
+    - every flush_every records they are written to TensorBoard: a scalar per parameter and statistic, and a histogram of each
+      parameter's gradient norms over the records since the last flush.
+    - when disabled (interval=0 or no writer) record() returns straight away.
+    """
+
+    def __init__(self, model, writer=None, interval=0, flush_every=10, n_batches=0):
+        self.enabled = (writer is not None) and (interval > 0)
+        self.writer = writer
+        self.interval = interval
+        self.n_batches = n_batches    # (the batches trained on so far, e.g. before a checkpoint we resume from)
+        self.batch_recorded = False
+        if not self.enabled:
+            return
+        named = [(name, p) for name, p in model.named_parameters() if p.requires_grad]
+        self.names = [name for name, _ in named]
+        self.params = [p for _, p in named]
+        self.norms, self.means, self.maxes = [torch.zeros(flush_every, len(self.params)) for i in range(3)]
+        self.batches = torch.zeros(flush_every, dtype=torch.long)
+        self.n_recorded = 0
+
+    def start_batch(self):
+        self.n_batches += 1
+        self.batch_recorded = False
+
+    def record(self):
+        if (not self.enabled) or self.batch_recorded or (self.n_batches % self.interval):
+            return
+        self.batch_recorded = True
+        with torch.no_grad():
+            grads = [p.grad if p.grad is not None else torch.full_like(p, float('nan')) for p in self.params]
+            torch.stack([g.norm() for g in grads], out=self.norms[self.n_recorded])
+            torch.stack([g.abs().mean() for g in grads], out=self.means[self.n_recorded])
+            torch.stack([g.abs().max() for g in grads], out=self.maxes[self.n_recorded])
+        self.batches[self.n_recorded] = self.n_batches
+        self.n_recorded += 1
+        if self.n_recorded == self.batches.shape[0]:
+            self.flush()
+
+    def flush(self):
+        """Write the records since the last flush to TensorBoard."""
+        if (not self.enabled) or (self.n_recorded == 0):
+            return
+        norms, means, maxes = [x[:self.n_recorded].tolist() for x in [self.norms, self.means, self.maxes]]
+        batches = self.batches[:self.n_recorded].tolist()
+        for i, batch in enumerate(batches):
+            for j, name in enumerate(self.names):
+                self.writer.add_scalar('GradientNorm/'+name, norms[i][j], batch)
+                self.writer.add_scalar('GradientMeanAbs/'+name, means[i][j], batch)
+                self.writer.add_scalar('GradientMaxAbs/'+name, maxes[i][j], batch)
+        for j, name in enumerate(self.names):
+            self.writer.add_histogram('GradientNormHistogram/'+name, self.norms[:self.n_recorded, j], batches[-1])
+        self.n_recorded = 0
+
+
+def recurrent_train_streams(args, model, device, train_loader, optimizer, criterion, epoch, printOutput=True, progress=None, checkpointer=None, gradrecorder=None):
+    """ Train a recurrent neural network on B parallel sub-streams of the training set (see dset.ParallelStreamLoader), as one batch.
+    The same as recurrent_train(), but for every sub-stream at once:
+    - each sub-stream carries its own hidden state from one of its sequences to the next (if args.retain_hidden_state),
+    - compare trials fall at different steps in different sub-streams, so the loss at each step is summed over the
+       sub-streams on a compare trial (the loss of each sequence is summed over its compare trials, as at batch size 1),
+       and the loss minimised is averaged over the sub-streams, so the size of each update doesnt grow with their number
+       (as in recurrent_train_reset()),
+    - the number input on compare trials is lesioned with frequency args.train_lesion_freq, independently in every sub-stream.
+    - progress and checkpointer resume from and save checkpoints, gradrecorder records gradients, and args.bptt_window truncates
+       backprop, as in recurrent_train().
+     """
+    model.train()
+    train_loss = 0
+    correct = 0
+    n_evaluated = 0
+    n_streams = train_loader.n_streams
+
+    # On the very first trial on training, reset the hidden weights to zeros
+    latentstate = torch.zeros(n_streams, model.recurrent_size)
+    if progress is not None:
+        train_loss, correct, n_evaluated, latentstate = progress['train_loss'], progress['correct'], progress['n_evaluated'], progress['latentstate']
+
+    for batch_idx, data in enumerate(train_loader):
+        if (progress is not None) and (batch_idx < progress['batch']):
+            continue   # (already trained on before the checkpoint)
+        if gradrecorder is not None:
+            gradrecorder.start_batch()
+        networkinput, labels = data['networkinput'].clone(), data['label']
+        iscompare = data['trialtypeinput'] == 1
+        sequenceLength = networkinput.shape[1]
+
+        # lesion the number input on compare trials
+        if args.retrain_decoder:
+            lesions = iscompare & (torch.arange(sequenceLength) % 2 == 0).unsqueeze(0)   # alternate trials
+        else:
+            lesions = iscompare & (torch.rand(iscompare.shape) < args.train_lesion_freq)
+        networkinput[:, :, :const.TOTALMAXNUM][lesions] = 0
+
+        if not args.retain_hidden_state:
+            hidden = torch.zeros(n_streams, model.recurrent_size)  # only if you want to reset hidden recurrent weights
+        else:
+            hidden = latentstate # keep hidden state to reflect recent statistics of previous inputs
+
+        # perform N-steps of recurrence for all sub-streams in lockstep, training on the 'compare' trials
+        loss, n_correct, n_assessed, latentstate = train_bptt_windows(args, model, optimizer, networkinput.unbind(1), hidden, labels, get_compare_mask(data['trialtypeinput']), gradrecorder, 1./n_streams)
+        correct += n_correct
+        n_evaluated += n_assessed
+        train_loss += loss
+
+        if batch_idx % args.log_interval == 0:
+            if printOutput:
+                print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(epoch, batch_idx * n_streams, len(train_loader.dataset),
+                    100. * batch_idx / len(train_loader), loss))
+
+        if is_checkpoint_batch(args, checkpointer, batch_idx, train_loader):
+            checkpointer({'batch':batch_idx+1, 'train_loss':train_loss, 'correct':correct, 'n_evaluated':n_evaluated, 'latentstate':latentstate})
+
+    train_loss /= n_evaluated
+    accuracy = 100. * correct / n_evaluated
+    return train_loss, accuracy
+
+
+def recurrent_train_reset(args, model, device, train_loader, optimizer, criterion, epoch, printOutput=True, progress=None, checkpointer=None, gradrecorder=None):
+    """ Train a recurrent neural network whose hidden state is reset between sequences (--reset-state) on true minibatches of sequences.
+    With the hidden state reset, the training sequences are independent of each other, so a minibatch of them
+    (a dset.SequenceBatchLoader, optionally shuffled across blocks) can be run through the network at once:
+    - the loss of each sequence is summed over its compare trials (as in recurrent_train()) and averaged over the sequences of the
+       minibatch, so at a minibatch of 1 sequence the gradient of each update is the same as that of recurrent_train().
+    - the number input on compare trials is lesioned with frequency args.train_lesion_freq, independently in every sequence.
+    - the whole sequence is run with model.forward_sequence(), or step by step (train_bptt_windows()) when hidden noise is injected
+       or backprop is truncated or checkpointed (args.bptt_window, args.activation_checkpointing).
+    - progress and checkpointer resume from and save checkpoints, and gradrecorder records gradients, as in recurrent_train().
+     """
+    model.train()
+    train_loss = 0
+    correct = 0
+    n_evaluated = 0
+    if progress is not None:
+        train_loss, correct, n_evaluated = progress['train_loss'], progress['correct'], progress['n_evaluated']
+    train_loader.set_epoch(epoch)   # (the shuffled order of each epoch)
+
+    for batch_idx, data in enumerate(train_loader):
+        if (progress is not None) and (batch_idx < progress['batch']):
+            continue   # (already trained on before the checkpoint)
+        if gradrecorder is not None:
+            gradrecorder.start_batch()
+        networkinput, labels = data['networkinput'].clone(), data['label']
+        iscompare = data['trialtypeinput'] == 1
+        batch_size, sequenceLength = networkinput.shape[:2]
+
+        # lesion the number input on compare trials
+        if args.retrain_decoder:
+            lesions = iscompare & (torch.arange(sequenceLength) % 2 == 0).unsqueeze(0)   # alternate trials
+        else:
+            lesions = iscompare & (torch.rand(iscompare.shape) < args.train_lesion_freq)
+        networkinput[:, :, :const.TOTALMAXNUM][lesions] = 0
+
+        # perform N-steps of recurrence from a reset hidden state, for every sequence of the minibatch at once
+        comparemask = get_compare_mask(data['trialtypeinput'])
+        hidden = torch.zeros(batch_size, model.recurrent_size)
+        if model.hidden_noise or args.bptt_window or args.activation_checkpointing:
+            loss, n_correct, n_assessed, _ = train_bptt_windows(args, model, optimizer, networkinput.unbind(1), hidden, labels, comparemask, gradrecorder, 1./batch_size)
+        else:
+            optimizer.zero_grad()   # zero the parameter gradients
+            with precision_context(args):
+                outputs, _ = model.forward_sequence(networkinput, hidden, comparemask)
 
             # for 'compare' trials only, evaluate performance at every comparison between the current input and previous 'compare' input
-            if item_idx>0 and (trialtype[0,item_idx]==1):
-                loss += criterion(output, labels[item_idx])   # accumulate the loss (autograd should sort this out for us: https://pytorch.org/tutorials/intermediate/char_rnn_generation_tutorial.html)
-                correct += answer_correct(output, labels[item_idx])
+            loss, n_correct, n_assessed = masked_compare_loss(outputs, labels, comparemask)
+            (loss / batch_size).backward()
 
-        loss.backward()
+            # record our gradients
+            if gradrecorder is not None:
+                gradrecorder.record()
 
-        # record and visualise our gradients
-        if (batch_idx % 100) == 0:
-            for n, p in model.named_parameters():
-                if(p.requires_grad) and ("bias" not in n):
-                    if p.grad is not None:
-                        layers.append(n)
-                        ave_grads.append(p.grad.abs().mean())
-                        max_grads.append(p.grad.abs().max())
-                    else:
-                        print("Warning: p.grad gradient is type None at batch {} in sequence of length {}".format(batch_idx, sequenceLength) )
-            plot_grad_flow(args, layers, ave_grads, max_grads, batch_idx)
-
-        optimizer.step()            # update our weights
-        train_loss += loss.item()
+            optimizer.step()            # update our weights
+            loss = loss.item()
+        correct += n_correct
+        n_evaluated += n_assessed
+        train_loss += loss
 
         if batch_idx % args.log_interval == 0:
             if printOutput:
-                print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(epoch, batch_idx * len(inputs), len(train_loader.dataset),
-                    100. * batch_idx / len(train_loader), loss.item()))
+                print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(epoch, batch_idx * train_loader.batch_size, len(train_loader.dataset),
+                    100. * batch_idx / len(train_loader), loss / batch_size))
 
-    train_loss /= len(train_loader.dataset)*(n_comparetrials-1)
-    accuracy = 100. * correct / (len(train_loader.dataset)*(n_comparetrials-1))
+        if is_checkpoint_batch(args, checkpointer, batch_idx, train_loader):
+            checkpointer({'batch':batch_idx+1, 'train_loss':train_loss, 'correct':correct, 'n_evaluated':n_evaluated})
+
+    train_loss /= n_evaluated
+    accuracy = 100. * correct / n_evaluated
     return train_loss, accuracy
 
 
+def get_benchmark_subset(trainset, nsequences):
+    """Return the first nsequences of a stored dataset as a precomposed CreateDataset, to time training on."""
+    return dset.CreateDataset({key:np.asarray(value[:nsequences]) for key, value in trainset.data.items()}, precompose=True)
+
+
+def time_training(args, device, train, model=None, lr=None, repeats=1, warmup=0):
+    """Time a training callable for the compare_*() benchmarks: train(model, optimizer, criterion), on a new OneStepRNN (or the model
+    given) with the SGD optimizer of train_recurrent_network() at lr (default args.lr). Returns the mean seconds per call, over repeats
+    calls after warmup untimed ones."""
+    if model is None:
+        model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, args.noise_std, args.recurrent_size, args.hidden_size).to(device)
+    optimizer = optim.SGD(model.parameters(), lr=args.lr if lr is None else lr, momentum=args.momentum, weight_decay=args.weight_decay)
+    criterion = nn.BCELoss()
+    for i in range(warmup):
+        train(model, optimizer, criterion)
+    tic = time.time()
+    for i in range(repeats):
+        train(model, optimizer, criterion)
+    return (time.time() - tic) / repeats
+
+
+@contextlib.contextmanager
+def count_saved_tensors():
+    """Count the bytes autograd saves for the backwards pass inside the with block (yields a list, whose one item is the count)."""
+    savedbytes = [0]
+    def pack(tensor):
+        savedbytes[0] += tensor.numel() * tensor.element_size()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        yield savedbytes
+
+
+def compare_reset_state_throughput(args, device, trainset, batch_sizes=[1, 16, 64, 256], nsequences=960):
+    """Print the reset-state training throughput (sequences/s) over nsequences one at a time, and in minibatches of each size."""
+    subset = get_benchmark_subset(trainset, nsequences)
+    resetargs = copy.copy(args)
+    resetargs.retain_hidden_state = False
+    for batch_size in [None] + list(batch_sizes):
+        if batch_size is None:
+            train = lambda model, optimizer, criterion: recurrent_train(resetargs, model, device, dset.SequenceBatchLoader(subset, batch_size=1), optimizer, criterion, 1, printOutput=False)
+            method = 'recurrent_train, 1 sequence per batch'
+        else:
+            train = lambda model, optimizer, criterion: recurrent_train_reset(resetargs, model, device, dset.SequenceBatchLoader(subset, batch_size=batch_size, shuffle=True), optimizer, criterion, 1, printOutput=False)
+            method = 'recurrent_train_reset, {} sequences per batch'.format(batch_size)
+        print('{}: {:.1f} sequences/s'.format(method, nsequences/time_training(args, device, train)))
+
+
+def compare_bptt_windows(args, device, trainset, windows=[0, 10, 30, 60], nsequences=240):
+    """Print the training throughput (sequences/s) over nsequences for each truncated BPTT window (0: the whole sequence),
+    and the memory autograd saves for the backwards pass over one window (which grows with the window, not the sequence length)."""
+    subset = get_benchmark_subset(trainset, nsequences)
+    sequenceLength = subset.networkinput.shape[1]
+    for window in windows:
+        windowargs = copy.copy(args)
+        windowargs.bptt_window = window
+        steps = window if window > 0 else sequenceLength
+        model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, args.noise_std, args.recurrent_size, args.hidden_size).to(device)
+        with count_saved_tensors() as savedbytes:
+            hidden = torch.zeros(1, model.recurrent_size)
+            for item_idx in range(min(steps, sequenceLength)):
+                output, hidden = model(subset.networkinput[:1, item_idx], hidden)
+        train = lambda model, optimizer, criterion: recurrent_train(windowargs, model, device, dset.SequenceBatchLoader(subset, batch_size=1), optimizer, criterion, 1, printOutput=False)
+        elapsed = time_training(args, device, train, model)
+        print('BPTT window {}: {:.1f} sequences/s, {} weight updates per sequence, {:.1f} KB saved for backprop per window'.format(
+            window if window > 0 else 'whole sequence', nsequences/elapsed, int(np.ceil(sequenceLength/steps)), savedbytes[0]/1024.))
+
+
+def compare_activation_checkpointing(args, device, dataset, sequence_lengths=[120, 480, 1200], segments=[0]):
+    """Compare a forward and backward pass over sequences of each length L (the dataset's sequences joined end to end) with and without
+    activation checkpointing, for each segment length (0: about sqrt(L) steps): print the time, the memory autograd holds for the
+    backwards pass and the largest difference in the gradients (should be 0)."""
+    dataset.precompose()
+    model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, 0.0, args.recurrent_size, args.hidden_size).to(device)
+    joinedinput = dataset.networkinput.reshape(1, -1, dataset.networkinput.shape[2])
+    joinedlabels = dataset.labeltensor.reshape(1, -1)
+    joinedmask = get_compare_mask(dataset.trialtypetensor.reshape(1, -1)) & ~torch.isnan(joinedlabels)   # (no label on the first trial of each sequence)
+
+    def backprop(checkpointed, segment, L):
+        runargs = copy.copy(args)
+        runargs.activation_checkpointing, runargs.activation_segment = checkpointed, segment
+        saved = []
+        def train(model, optimizer, criterion):
+            model.zero_grad()
+            with count_saved_tensors() as savedbytes:
+                outputs, _, _ = forward_window(runargs, model, joinedinput[:, :L].unbind(1), torch.zeros(1, model.recurrent_size), 0, L)
+                loss, _, _ = masked_compare_loss(outputs, joinedlabels[:, :L], joinedmask[:, :L])
+            loss.backward()
+            saved.append(savedbytes[0])
+        elapsed = time_training(args, device, train, model)
+        return [p.grad.clone() for p in model.parameters()], elapsed, saved[0]
+
+    for L in sequence_lengths:
+        if L > joinedinput.shape[1]:
+            print('Skipping L={}: the dataset only has {} steps'.format(L, joinedinput.shape[1]))
+            continue
+        grads, elapsed, savedbytes = backprop(False, 0, L)
+        print('L={}, no checkpointing: {:.3f} s, {:.1f} KB held for backprop'.format(L, elapsed, savedbytes/1024.))
+        for segment in segments:
+            checkpointgrads, elapsed, savedbytes = backprop(True, segment, L)
+            difference = max([(g - c).abs().max().item() for g, c in zip(grads, checkpointgrads)])
+            print('L={}, checkpointed segments of {} steps: {:.3f} s, {:.1f} KB held for backprop, largest gradient difference {:.2e}'.format(
+                L, segment if segment > 0 else int(math.ceil(math.sqrt(L))), elapsed, savedbytes/1024., difference))
+
+
+def compare_training_throughput(args, device, trainset, stream_counts=[1, 4, 16, 64], nsequences=960):
+    """Print the training throughput (sequences/s) over nsequences at batch size 1 and with each number of parallel sub-streams."""
+    subset = get_benchmark_subset(trainset, nsequences)
+    for n_streams in stream_counts:
+        if n_streams == 1:
+            train = lambda model, optimizer, criterion: recurrent_train(args, model, device, dset.SequenceBatchLoader(subset, batch_size=1), optimizer, criterion, 1, printOutput=False)
+        else:
+            train = lambda model, optimizer, criterion: recurrent_train_streams(args, model, device, dset.ParallelStreamLoader(subset, n_streams), optimizer, criterion, 1, printOutput=False)
+        print('{} training stream(s): {:.1f} sequences/s'.format(n_streams, nsequences/time_training(args, device, train)))
+
+
 def recurrent_test(args, model, device, test_loader, criterion, printOutput=True):
-    """Test a recurrent neural network on the test set (without lesions)."""
+    """Test a recurrent neural network on the test set (without lesions).
+    - with args.bf16 the network runs in bfloat16 autocast (see precision_context()).
+    """
     model.eval()
     test_loss = 0
     correct = 0
@@ -200,40 +874,23 @@ def recurrent_test(args, model, device, test_loader, criterion, printOutput=True
 
     with torch.no_grad():  # dont track the gradients
         for batch_idx, data in enumerate(test_loader):
-            inputs, labels, contextsequence, trialtype = batch_to_torch(data['input']), data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1), batch_to_torch(data['contextinput']), batch_to_torch(data['trialtypeinput']).unsqueeze(2)
-
             # reformat the input sequences for our recurrent model
-            recurrentinputs = []
-            sequenceLength = inputs.shape[1]
+            recurrentinputs, labels, trialtype = get_recurrent_inputs(data)
+            sequenceLength = len(recurrentinputs)
             n_comparetrials = np.nansum(np.nansum(trialtype))
 
-            for i in range(sequenceLength):
-                context = contextsequence[:,i]
-                if trialtype[0,i]==0:  # remove context indicator on the filler trials
-                    context_in = torch.full_like(context, 0)
-                else:
-                    context_in = copy.deepcopy(context)
-                inputX = torch.cat((inputs[:, i], context_in, trialtype[:,i]),1)
-                recurrentinputs.append(inputX)
-
             if not args.retain_hidden_state:  # only if you want to reset hidden state between trials
                 hidden = torch.zeros(args.batch_size, model.recurrent_size)
             else:
                 hidden = latentstate
 
             # perform a N-step recurrence for the whole sequence of numbers in the input
-            for item_idx in range(sequenceLength):
+            with precision_context(args):
+                outputs, hidden, latentstate = forward_window(args, model, recurrentinputs, hidden, 0, sequenceLength)
 
-                # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
-                noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape)))
-                hidden.add_(noise)
-                output, hidden = model(recurrentinputs[item_idx], hidden)
-                if item_idx==(sequenceLength-2):  # extract the hidden state just before the last input in the sequence is presented
-                    latentstate = hidden.detach()
-
-                if item_idx>0 and (trialtype[0,item_idx]==1):
-                    test_loss += criterion(output, labels[item_idx]).item()
-                    correct += answer_correct(output, labels[item_idx])
+            loss, n_correct, _ = masked_compare_loss(outputs, labels.reshape(1, -1), get_compare_mask(trialtype))
+            test_loss += loss.item()
+            correct += n_correct
 
     test_loss /= len(test_loader.dataset)*(n_comparetrials-1)  # there are n_comparetrials-1 instances of feedback per sequence
     accuracy = 100. * correct / (len(test_loader.dataset)*(n_comparetrials-1))
@@ -279,22 +936,13 @@ def recurrent_lesion_test(args, model, device, test_loader, criterion, printOutp
     with torch.no_grad():  # dont track the gradients
         # for each sequence
         for batch_idx, data in enumerate(test_loader):
-            inputs, labels, contextsequence, contextinputsequence, trialtype = batch_to_torch(data['input']), data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1), batch_to_torch(data['context']), batch_to_torch(data['contextinput']), batch_to_torch(data['trialtypeinput']).unsqueeze(2)
+            inputs, contextsequence = batch_to_torch(data['input']), batch_to_torch(data['context'])
             # setup
-            recurrentinputs = []
             sequenceLength = inputs.shape[1]
             sequenceAssessment = []
 
-            # organise the inputs for each trial in our sequence
-            for i in range(sequenceLength):
-                context = contextinputsequence[:,i]
-
-                if trialtype[0,i]==0:
-                    inputcontext = torch.full_like(context, 0)  # all filler trials should have no context input to it
-                else:
-                    inputcontext = copy.deepcopy(context)
-                inputX = torch.cat((inputs[:, i], inputcontext, trialtype[:, i]),dim=1)
-                recurrentinputs.append(inputX)
+            # organise the inputs for each trial in our sequence (all filler trials have no context input)
+            recurrentinputs, labels, trialtype = get_recurrent_inputs(data)
 
             # consider each number in the sequence
             for assess_idx in range(sequenceLength):
@@ -342,8 +990,8 @@ def recurrent_lesion_test(args, model, device, test_loader, criterion, printOutp
                         # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
                         noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape)))
                         hidden.add_(noise)
-                        output, hidden = model(tmpinputs[trial], hidden)
-                        h0activations, h1activations, _ = model.get_activations(tmpinputs[trial], hidden)
+                        output, hidden = recurrent_step(args, model, tmpinputs[trial], hidden)
+                        h0activations, h1activations, _ = model.get_activations(tmpinputs[trial], hidden, getattr(args, 'scripted', False))
 
                         # assess aggregate performance on whole sequence (including all lesions)
                         if trialtype[:,trial]==1:
@@ -372,7 +1020,7 @@ def recurrent_lesion_test(args, model, device, test_loader, criterion, printOutp
                     for i in range(assess_idx+1):
                         noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.shape[0]*hidden.shape[1]), (hidden.shape)))
                         hidden.add_(noise)
-                        output, hidden = model(tmpinputs[i], hidden)  # this should be the sequence of trials that are all lesioned with probability F
+                        output, hidden = recurrent_step(args, model, tmpinputs[i], hidden)  # this should be the sequence of trials that are all lesioned with probability F
                     latentstate = hidden.detach()
 
             allLesionAssessments.append(sequenceAssessment)
@@ -563,7 +1211,7 @@ def get_activations(args, trainset,trained_model, train_loader, whichType='compa
 
                     # pass inputs through the recurrent network
                     for i in range(2):
-                        h0activations,h1activations,_ = trained_model.get_activations(recurrentinputs[i], h0activations)
+                        h0activations,h1activations,_ = trained_model.get_activations(recurrentinputs[i], h0activations, getattr(args, 'scripted', False))
 
                     activations[sample] = h1activations.detach()
 
@@ -575,28 +1223,20 @@ def get_activations(args, trainset,trained_model, train_loader, whichType='compa
         latentstate = torch.zeros(1, trained_model.recurrent_size)
 
         for batch_idx, data in enumerate(train_loader):
-            inputs, labels, contextsequence, contextinputsequence, trialtype = batch_to_torch(data['input']), data['label'].type(torch.FloatTensor)[0].unsqueeze(1).unsqueeze(1), batch_to_torch(data['context']), batch_to_torch(data['contextinput']), batch_to_torch(data['trialtypeinput']).unsqueeze(2)
-            recurrentinputs = []
-            sequenceLength = inputs.shape[1]
+            contextsequence, contextinputsequence = batch_to_torch(data['context']), batch_to_torch(data['contextinput'])
+            recurrentinputs, labels, trialtype = get_recurrent_inputs(data)   # (context indicator removed on the filler trials)
+            sequenceLength = len(recurrentinputs)
             temporal_trialtypes[batch_idx] = data['trialtypeinput']
 
             for i in range(sequenceLength):
                 temporal_context[batch_idx, i] = dset.turn_one_hot_to_integer(contextinputsequence[:,i][0])
-                contextin = contextinputsequence[:,i]
-                if trialtype[0,i]==0:  # remove context indicator on the filler trials
-                    contextinput = torch.full_like(contextin, 0)
-                else:
-                    contextinput = copy.deepcopy(contextin)
-
-                inputX = torch.cat((inputs[:, i], contextinput, trialtype[:,i]),1)
-                recurrentinputs.append(inputX)
 
             h0activations = latentstate
             inputA, inputB = [None for i in range(2)]
 
             # perform N-steps of recurrence
             for item_idx in range(sequenceLength):
-                h0activations,h1activations,_ = trained_model.get_activations(recurrentinputs[item_idx], h0activations)
+                h0activations,h1activations,_ = trained_model.get_activations(recurrentinputs[item_idx], h0activations, getattr(args, 'scripted', False))
                 if item_idx==(sequenceLength-2):  # extract the hidden state just before the last input in the sequence is presented
                     latentstate = h0activations.detach()
 
@@ -695,14 +1335,369 @@ class OneStepRNN(nn.Module):
         self.output = torch.sigmoid(self.fc1tooutput(self.fc1_activations))
         return self.output, self.hidden
 
-    def get_activations(self, x, hidden):
-        self.forward(x, hidden)  # update the activations with the particular input
+    def forward_sequence(self, inputs, h0, compare_mask=None):
+        """Run the network over whole sequences at once: the same as calling forward() at every step, carrying the hidden state.
+        - inputs is (batch, seq_len, D_in), h0 the (batch, recurrent_size) hidden state before the first step,
+          compare_mask (optional, (batch, seq_len) bool) the steps to compute the output on (default: every step).
+        - the input side of both input2hidden and input2fc1 is projected for the whole sequence in one matmul, and their hidden side
+          in one matmul per step. The readout (fc1tooutput) is only computed on the compare_mask steps.
+        - returns the outputs (batch, seq_len, 1), NaN where not computed, and the hidden states after every step (batch, seq_len, recurrent_size).
+        - no hidden noise is injected (see model.hidden_noise, no longer in use).
+        """
+        batch_size, seq_len, D_in = inputs.shape
+        weights = torch.cat((self.input2hidden.weight, self.input2fc1.weight), 0)   # (recurrent_size+hidden_size, D_in+recurrent_size)
+        bias = torch.cat((self.input2hidden.bias, self.input2fc1.bias), 0)
+        inputprojection = torch.addmm(bias, inputs.reshape(batch_size*seq_len, D_in), weights[:, :D_in].t()).reshape(batch_size, seq_len, -1)
+        hiddenweights = weights[:, D_in:].t()
+
+        hiddens = inputs.new_empty((batch_size, seq_len, self.recurrent_size))
+        fc1_activations = inputs.new_empty((batch_size, seq_len, self.hidden_size))
+        hidden = h0
+        for step in range(seq_len):
+            combined = F.relu(torch.addmm(inputprojection[:, step], hidden, hiddenweights))
+            hidden = combined[:, :self.recurrent_size]
+            hiddens[:, step] = hidden
+            fc1_activations[:, step] = combined[:, self.recurrent_size:]
+
+        outputs = inputs.new_full((batch_size, seq_len, 1), float('nan'))
+        if compare_mask is None:
+            outputs = torch.sigmoid(self.fc1tooutput(fc1_activations))
+        else:
+            outputs[compare_mask] = torch.sigmoid(self.fc1tooutput(fc1_activations[compare_mask]))
+        return outputs, hiddens
+
+    def kernel_weights(self):
+        """The weights and biases in the order rnn_step_kernel() and rnn_sequence_kernel() take them."""
+        return (self.input2hidden.weight, self.input2hidden.bias, self.input2fc1.weight, self.input2fc1.bias, self.fc1tooutput.weight, self.fc1tooutput.bias)
+
+    def forward_scripted(self, x, hidden):
+        """The same as forward(), with the TorchScript step kernel (see get_scripted_kernels())."""
+        self.output, self.hidden, self.fc1_activations = get_scripted_kernels()['step'](x, hidden, *self.kernel_weights())
+        return self.output, self.hidden
+
+    def forward_scripted_sequence(self, inputs, h0, noise):
+        """The same as calling forward() at every step of whole sequences (inputs (batch, seq_len, D_in)), carrying the hidden state
+        and adding noise[step] (seq_len, batch, recurrent_size) to it before each step, with the TorchScript time loop.
+        Returns the outputs (batch, seq_len, 1), hidden states (batch, seq_len, recurrent_size) and fc1 activations at every step."""
+        return get_scripted_kernels()['sequence'](inputs, h0, noise, *self.kernel_weights())
+
+    def get_activations(self, x, hidden, scripted=False):
+        if scripted:
+            self.forward_scripted(x, hidden)
+        else:
+            self.forward(x, hidden)  # update the activations with the particular input
         return self.hidden, self.fc1_activations, self.output
 
     def get_noise(self):
         return self.hidden_noise
 
 
+class EnsembleRNN(nn.Module):
+    """K independent OneStepRNNs with their weights stacked along a first (member) dimension, so that every step
+    of all K networks is one batched matmul (bmm) per layer. Inputs and hidden states are (K, batch, ...).
+    - members are initialised as K ordinary OneStepRNNs, and can be turned back into them with to_models().
+    - each member's loss only depends on its own weights, so training the summed loss with SGD trains each member as if on its own.
+    """
+
+    def __init__(self, K, D_in, D_out, noise_std, recurrent_size, hidden_size):
+        super(EnsembleRNN, self).__init__()
+        self.K = K
+        self.modelparams = (D_in, D_out, noise_std, recurrent_size, hidden_size)
+        self.recurrent_size = recurrent_size
+        self.hidden_size = hidden_size
+        self.hidden_noise = noise_std
+        members = [OneStepRNN(*self.modelparams) for k in range(K)]
+        # weights are stored transposed, (K, in_features, out_features), for bmm; biases as (K, 1, out_features)
+        for layer in ['input2hidden', 'input2fc1', 'fc1tooutput']:
+            setattr(self, layer+'_weight', nn.Parameter(torch.stack([getattr(m, layer).weight.detach().t() for m in members])))
+            setattr(self, layer+'_bias', nn.Parameter(torch.stack([getattr(m, layer).bias.detach().unsqueeze(0) for m in members])))
+
+    def forward(self, x, hidden):
+        combined = torch.cat((x, hidden), 2)
+        hidden = F.relu(torch.baddbmm(self.input2hidden_bias, combined, self.input2hidden_weight))
+        fc1_activations = F.relu(torch.baddbmm(self.input2fc1_bias, combined, self.input2fc1_weight))
+        output = torch.sigmoid(torch.baddbmm(self.fc1tooutput_bias, fc1_activations, self.fc1tooutput_weight))
+        return output, hidden
+
+    def to_models(self):
+        """Return the K members as ordinary (independent) OneStepRNNs."""
+        models = []
+        for k in range(self.K):
+            model = OneStepRNN(*self.modelparams)
+            with torch.no_grad():
+                for layer in ['input2hidden', 'input2fc1', 'fc1tooutput']:
+                    getattr(model, layer).weight.copy_(getattr(self, layer+'_weight')[k].t())
+                    getattr(model, layer).bias.copy_(getattr(self, layer+'_bias')[k, 0])
+            models.append(model)
+        return models
+
+
+def ensemble_pass(args, model, inputs, labels, trialtypes, optimizer=None, lesiongenerators=None):
+    """Run an ensemble over its members' datasets in lockstep, one sequence per member at a time, retaining the hidden state
+    across sequences as recurrent_train()/recurrent_test() do. Trains if an optimizer is given (with number lesions on compare trials
+    drawn from each member's own lesion generator), otherwise just assesses.
+    - inputs (K, N, seq_len, D_in), labels and trialtypes (K, N, seq_len), e.g. stacked from precomposed CreateDatasets.
+    - returns the mean loss and the accuracy (%) of each member over the compare trials, as arrays of length K.
+    """
+    K, N, sequenceLength = labels.shape
+    training = optimizer is not None
+    model.train(training)
+    totalloss, correct, n_assessed = np.zeros((K,)), np.zeros((K,)), np.zeros((K,))
+    latentstate = torch.zeros(K, 1, model.recurrent_size)
+
+    with torch.set_grad_enabled(training):
+        for seq in range(N):
+            networkinput = inputs[:, seq]
+            comparemask = get_compare_mask(trialtypes[:, seq])
+            if training:
+                optimizer.zero_grad()
+                if args.train_lesion_freq > 0:
+                    iscompare = trialtypes[:, seq] == 1
+                    lesions = torch.stack([torch.rand(sequenceLength, generator=g) < args.train_lesion_freq for g in lesiongenerators]) & iscompare
+                    networkinput = networkinput.clone()
+                    networkinput[:, :, :const.TOTALMAXNUM][lesions] = 0
+
+            hidden = latentstate if args.retain_hidden_state else torch.zeros(K, 1, model.recurrent_size)
+            outputs = []
+            for item_idx in range(sequenceLength):
+                # inject some noise (Note: no longer in use, set model.hidden_noise to 0.0)
+                noise = torch.from_numpy(np.reshape(np.random.normal(0, model.hidden_noise, hidden.numel()), (hidden.shape))).float()
+                output, hidden = model(networkinput[:, item_idx].unsqueeze(1), hidden + noise)
+                outputs.append(output[:, 0])
+                if item_idx==(sequenceLength-2):   # extract the hidden state just before the last input in the sequence is presented
+                    latentstate = hidden.detach()
+            outputs = torch.stack(outputs, 1)
+
+            # the loss of each member on its own compare trials (summed over members for training: each only trains its own weights)
+            memberlosses = []
+            for k in range(K):
+                loss, n_correct, n_trials = masked_compare_loss(outputs[k:k+1], labels[k:k+1, seq], comparemask[k:k+1])
+                memberlosses.append(loss)
+                totalloss[k] += loss.item()
+                correct[k] += n_correct
+                n_assessed[k] += n_trials
+            if training:
+                torch.stack(memberlosses).sum().backward()
+                optimizer.step()
+
+    return totalloss / n_assessed, 100. * correct / n_assessed
+
+
+def train_ensemble(args, device, model_ids):
+    """Train one model per id in model_ids as a single stacked ensemble (EnsembleRNN), in one process, and save
+    each member as an ordinary model (and training record) under the usual name for its id.
+    - every member gets its own dataset (generated or loaded as in train_and_save_network()) and its own lesion random stream.
+    - trains with the learning rate args.lr_multi[0] (which the saved models are named by) and batch size 1, which must be the only
+      args.lr_multi and args.batch_size_multi, retaining the hidden state as set in args, for all args.epochs, assessing every epoch
+      on the full sets. It does not checkpoint. Training options it does not implement raise a ValueError, rather than being ignored.
+    """
+    unsupported = {'--retrain-decoder':args.retrain_decoder, '--stream-train':args.stream_train, '--train-streams':args.train_streams > 1,\
+                   '--reset-state-batch':args.reset_state_batch, '--bptt-window':args.bptt_window, '--activation-checkpointing':args.activation_checkpointing,\
+                   '--bf16':args.bf16, '--scripted':args.scripted, '--eval-every':args.eval_every != 1, '--eval-subsample':args.eval_subsample,\
+                   '--async-eval':args.async_eval, '--resume':args.resume, '--early-stop-patience':args.early_stop_patience,\
+                   '--grad-record-interval':args.grad_record_interval}
+    used = [flag for flag, value in unsupported.items() if value]
+    if used:
+        raise ValueError('Ensemble training does not support {}'.format(', '.join(used)))
+    if (len(args.lr_multi) != 1) or (list(args.batch_size_multi) != [1]):
+        raise ValueError('Ensemble training needs a single learning rate (--lr-multi) and batch size 1 (--batch-size-multi 1), not {} and {}'.format(args.lr_multi, args.batch_size_multi))
+    lr = args.lr_multi[0]
+    memberargs, trainsets, testsets = [], [], []
+    for model_id in model_ids:
+        margs = copy.copy(args)
+        margs.model_id = model_id
+        margs.batch_size, margs.test_batch_size, margs.lr = 1, 1, lr    # (as train_recurrent_network() sets them, for the training records)
+        datasetname, _, _, _ = get_dataset_name(margs)
+        trainset, testset = get_training_data(margs, datasetname)
+        trainset.precompose()
+        testset.precompose()
+        memberargs.append(margs)
+        trainsets.append(trainset)
+        testsets.append(testset)
+
+    K = len(model_ids)
+    traindata = [torch.stack([getattr(d, field) for d in trainsets]) for field in ['networkinput', 'labeltensor', 'trialtypetensor']]
+    testdata = [torch.stack([getattr(d, field) for d in testsets]) for field in ['networkinput', 'labeltensor', 'trialtypetensor']]
+    lesiongenerators = [torch.Generator().manual_seed(int(model_id)) for model_id in model_ids]
+
+    model = EnsembleRNN(K, const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, args.noise_std, args.recurrent_size, args.hidden_size).to(device)
+    optimizer = optim.SGD(model.parameters(), lr=lr, momentum=args.momentum, weight_decay=args.weight_decay)
+
+    print('Training an ensemble of {} networks (ids {})...'.format(K, list(model_ids)))
+    _, base_train_accuracy = ensemble_pass(args, model, *traindata)
+    _, base_test_accuracy = ensemble_pass(args, model, *testdata)
+    trainingPerformance, testPerformance = [[acc] for acc in base_train_accuracy], [[acc] for acc in base_test_accuracy]
+
+    for epoch in range(1, args.epochs + 1):
+        tic = time.time()
+        _, train_accuracy = ensemble_pass(args, model, *traindata, optimizer=optimizer, lesiongenerators=lesiongenerators)
+        traintime = time.time() - tic
+        _, test_accuracy = ensemble_pass(args, model, *testdata)
+        for k in range(K):
+            trainingPerformance[k].append(train_accuracy[k])
+            testPerformance[k].append(test_accuracy[k])
+        print('Epoch {}: mean train: {:.2f}%, mean test: {:.2f}%, {:.1f} sequences/s per network'.format(epoch, np.mean(train_accuracy), np.mean(test_accuracy), traindata[1].shape[1]/traintime))
+
+    # save each member as an ordinary model, with its own training record
+    for k, member in enumerate(model.to_models()):
+        _, trained_modelname, _, trainingrecord_name = get_dataset_name(memberargs[k])
+        print('Saving trained model: ' + trained_modelname)
+        torch.save(member, trained_modelname)
+        record = {"trainingPerformance":trainingPerformance[k], "testPerformance":testPerformance[k], "args":vars(memberargs[k]),\
+                  "estimation":{"trainingPerformance":"running", "testPerformance":['full' for i in range(len(testPerformance[k]))]},\
+                  "stopEpoch":args.epochs, "earlyStopping":None}
+        randnum = str(random.randint(0,10000))
+        with open(const.TRAININGRECORDS_DIRECTORY+randnum + trainingrecord_name+".json","w") as f:
+            f.write(json.dumps(record))
+    return model
+
+
+def compare_ensemble_throughput(args, device, model_ids=range(4), nsequences=240):
+    """Print the total training throughput (sequences/s) over nsequences of each model id's training set, for the networks trained
+    one after another and as a stacked ensemble."""
+    subsets = []
+    for model_id in model_ids:
+        margs = copy.copy(args)
+        margs.model_id = model_id
+        subsets.append(get_benchmark_subset(get_training_data(margs, get_dataset_name(margs)[0])[0], nsequences))
+    K = len(subsets)
+    lr = args.lr_multi[0]    # (as in train_ensemble())
+
+    sequentialtime = sum(time_training(args, device, lambda model, optimizer, criterion: recurrent_train(args, model, device,\
+                         dset.SequenceBatchLoader(subset, batch_size=1), optimizer, criterion, 1, printOutput=False), lr=lr) for subset in subsets)
+
+    traindata = [torch.stack([getattr(d, field) for d in subsets]) for field in ['networkinput', 'labeltensor', 'trialtypetensor']]
+    lesiongenerators = [torch.Generator().manual_seed(int(model_id)) for model_id in model_ids]
+    model = EnsembleRNN(K, const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, args.noise_std, args.recurrent_size, args.hidden_size).to(device)
+    ensembletime = time_training(args, device, lambda model, optimizer, criterion: ensemble_pass(args, model, *traindata, optimizer=optimizer,\
+                                 lesiongenerators=lesiongenerators), model, lr)
+
+    print('{} networks one after another: {:.1f} sequences/s'.format(K, K*nsequences/sequentialtime))
+    print('{} networks as a stacked ensemble: {:.1f} sequences/s ({:.2f}x)'.format(K, K*nsequences/ensembletime, sequentialtime/ensembletime))
+
+
+def check_forward_sequence_parity(args, dataset, model=None, nsequences=10, tolerance=1e-5):
+    """Check that OneStepRNN.forward_sequence() matches calling forward() step by step on the first nsequences of a dataset
+    (carrying the hidden state from one sequence to the next): the outputs on compare trials, every hidden state,
+    and the gradients of the summed compare trial loss. Prints the largest absolute difference in each and returns True if all are within tolerance.
+    """
+    if model is None:
+        model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, 0.0, args.recurrent_size, args.hidden_size)
+    dataset.precompose()
+    inputs, labels = dataset.networkinput[:nsequences], dataset.labeltensor[:nsequences]
+    compare_mask = (dataset.trialtypetensor[:nsequences] == 1)
+    compare_mask[:, 0] = False   # (no loss is taken on the first trial)
+
+    maxdiff = {'outputs':0., 'hiddens':0., 'gradients':0.}
+    hidden = torch.zeros(1, model.recurrent_size)
+    for seq in range(inputs.shape[0]):
+        # step by step
+        model.zero_grad()
+        stepoutputs, stephiddens, h = [], [], hidden
+        for step in range(inputs.shape[1]):
+            output, h = model(inputs[seq:seq+1, step], h)
+            stepoutputs.append(output)
+            stephiddens.append(h)
+        stepoutputs, stephiddens = torch.stack(stepoutputs, 1), torch.stack(stephiddens, 1)
+        F.binary_cross_entropy(stepoutputs[compare_mask[seq:seq+1]], labels[seq:seq+1][compare_mask[seq:seq+1]].unsqueeze(1), reduction='sum').backward()
+        stepgrads = [p.grad.clone() for p in model.parameters()]
+
+        # whole sequence
+        model.zero_grad()
+        outputs, hiddens = model.forward_sequence(inputs[seq:seq+1], hidden, compare_mask[seq:seq+1])
+        F.binary_cross_entropy(outputs[compare_mask[seq:seq+1]], labels[seq:seq+1][compare_mask[seq:seq+1]].unsqueeze(1), reduction='sum').backward()
+
+        maxdiff['outputs'] = max(maxdiff['outputs'], (outputs[compare_mask[seq:seq+1]] - stepoutputs[compare_mask[seq:seq+1]]).abs().max().item())
+        maxdiff['hiddens'] = max(maxdiff['hiddens'], (hiddens - stephiddens).abs().max().item())
+        maxdiff['gradients'] = max([maxdiff['gradients']] + [(p.grad - g).abs().max().item() for p, g in zip(model.parameters(), stepgrads)])
+        hidden = stephiddens[:, -1].detach()
+
+    for key, diff in maxdiff.items():
+        print('forward_sequence vs forward, max abs difference in {}: {:.2e}'.format(key, diff))
+    return all(diff <= tolerance for diff in maxdiff.values())
+
+
+def check_scripted_parity(args, dataset, model=None, nsequences=10, tolerance=1e-6):
+    """Check that the TorchScript step (OneStepRNN.forward_scripted()) and time loop (OneStepRNN.forward_scripted_sequence(), used with --scripted)
+    match calling forward() step by step on the first nsequences of a dataset (carrying the hidden state from one sequence to the next):
+    the outputs on compare trials, every hidden state, and the gradients of the summed compare trial loss.
+    Prints the largest absolute difference in each and returns True if all are within tolerance.
+    """
+    if model is None:
+        model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, 0.0, args.recurrent_size, args.hidden_size)
+    dataset.precompose()
+    inputs, labels = dataset.networkinput[:nsequences], dataset.labeltensor[:nsequences]
+    compare_mask = get_compare_mask(dataset.trialtypetensor[:nsequences])
+
+    def run(seq, hidden, method):
+        model.zero_grad()
+        if method == 'sequence':
+            noise = torch.zeros(inputs.shape[1], 1, model.recurrent_size)
+            outputs, hiddens, _ = model.forward_scripted_sequence(inputs[seq:seq+1], hidden, noise)
+        else:
+            outputs, hiddens, h = [], [], hidden
+            for step in range(inputs.shape[1]):
+                output, h = model(inputs[seq:seq+1, step], h) if method == 'eager' else model.forward_scripted(inputs[seq:seq+1, step], h)
+                outputs.append(output)
+                hiddens.append(h)
+            outputs, hiddens = torch.stack(outputs, 1), torch.stack(hiddens, 1)
+        loss, _, _ = masked_compare_loss(outputs, labels[seq:seq+1], compare_mask[seq:seq+1])
+        loss.backward()
+        return outputs[compare_mask[seq:seq+1]], hiddens, [p.grad.clone() for p in model.parameters()]
+
+    maxdiff = {method:{'outputs':0., 'hiddens':0., 'gradients':0.} for method in ['step', 'sequence']}
+    hidden = torch.zeros(1, model.recurrent_size)
+    for seq in range(inputs.shape[0]):
+        eager = run(seq, hidden, 'eager')
+        for method in maxdiff:
+            outputs, hiddens, grads = run(seq, hidden, method)
+            maxdiff[method]['outputs'] = max(maxdiff[method]['outputs'], (outputs - eager[0]).abs().max().item())
+            maxdiff[method]['hiddens'] = max(maxdiff[method]['hiddens'], (hiddens - eager[1]).abs().max().item())
+            maxdiff[method]['gradients'] = max([maxdiff[method]['gradients']] + [(g - e).abs().max().item() for g, e in zip(grads, eager[2])])
+        hidden = eager[1][:, -1].detach()
+
+    for method, diffs in maxdiff.items():
+        for key, diff in diffs.items():
+            print('scripted {} vs forward, max abs difference in {}: {:.2e}'.format(method, key, diff))
+    return all(diff <= tolerance for diffs in maxdiff.values() for diff in diffs.values())
+
+
+def compare_scripted_speed(args, sequenceLength=120, repeats=50):
+    """Print the microseconds per step of the eager and TorchScript (--scripted) paths at batch size 1, for single steps and for
+    whole sequences of sequenceLength steps (with and without a backwards pass)."""
+    model = OneStepRNN(const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS, 1, 0.0, args.recurrent_size, args.hidden_size)
+    inputs = torch.rand(1, sequenceLength, const.TOTALMAXNUM + const.NCONTEXTS + const.NTYPEBITS)
+    h0 = torch.zeros(1, model.recurrent_size)
+    noise = torch.zeros(sequenceLength, 1, model.recurrent_size)
+
+    def eager_sequence():
+        outputs, h = [], h0
+        for step in range(sequenceLength):
+            output, h = model(inputs[:, step], h)
+            outputs.append(output)
+        return torch.stack(outputs, 1)
+
+    def scripted_sequence():
+        return model.forward_scripted_sequence(inputs, h0, noise)[0]
+
+    def timeit(function, backward):
+        def run(model, optimizer, criterion):
+            output = function()
+            if backward:
+                output.sum().backward()
+        # (warming up includes the TorchScript profiling runs)
+        return 1e6 * time_training(args, None, run, model, repeats=repeats, warmup=3) / sequenceLength
+
+    with torch.no_grad():
+        eagerstep = timeit(lambda: torch.stack([model(inputs[:, step], h0)[0] for step in range(sequenceLength)], 1), False)
+        scriptedstep = timeit(lambda: torch.stack([model.forward_scripted(inputs[:, step], h0)[0] for step in range(sequenceLength)], 1), False)
+        print('single step, no grad: eager {:.1f} us/step, scripted {:.1f} us/step ({:.2f}x)'.format(eagerstep, scriptedstep, eagerstep/scriptedstep))
+        eagerloop, scriptedloop = timeit(eager_sequence, False), timeit(scripted_sequence, False)
+        print('time loop, no grad: eager {:.1f} us/step, scripted {:.1f} us/step ({:.2f}x)'.format(eagerloop, scriptedloop, eagerloop/scriptedloop))
+    eagerloop, scriptedloop = timeit(eager_sequence, True), timeit(scripted_sequence, True)
+    print('time loop, forward and backward: eager {:.1f} us/step, scripted {:.1f} us/step ({:.2f}x)'.format(eagerloop, scriptedloop, eagerloop/scriptedloop))
+
+
 def define_hyperparams():
     """
     This will enable us to take different network training settings/hyperparameters in when we call main.py from the command line.
@@ -730,13 +1725,40 @@ def define_hyperparams():
         parser.add_argument('--blockrange', dest='all_fullrange', action='store_false', help='block training by contextual number range (default: True)')
         parser.add_argument('--reset-state', dest='retain_hidden_state', action='store_false', help='reset the hidden state between sequences (default: False)')
         parser.add_argument('--retain-state', dest='retain_hidden_state', action='store_true', help='retain the hidden state between sequences (default: True)')
-        parser.add_argument('--label-context', default="true", help='label the context explicitly in the input stream? (default: "true", other options: "constant (1)", "random (1-3)")')
+        parser.add_argument('--label-context', default="true", help='label the context explicitly in the input stream? (default: "true", other options: "constant (1)", "random (1-3)", "base" (a dataset the other labelling schemes are derived from))')
         parser.add_argument('--block_int_ttsplit', default="false", help='test on a different blocking/interleaving structure than training? (default: "false", train/test on same e.g. train block, test block")')
         parser.add_argument('--retrain_decoder', default="false", help='whether to retrain the final layer of a trained network, this time using VI. default: "false"')
+        parser.add_argument('--dataset-engine', default="vectorised", choices=['vectorised', 'loop'], help='generate datasets with the vectorised block generator or the original trial-by-trial loop (default: "vectorised")')
+        parser.add_argument('--compact-dataset', dest='compact_dataset', action='store_true', help='store datasets as uint8 codes and expand to one-hot on demand (default: False)')
+        parser.add_argument('--dataset-format', default="pickle", choices=['pickle', 'columnar', 'spec'], help='save datasets as one pickled dict, as a directory of memory-mappable arrays, or only as a spec to regenerate them from (default: "pickle")')
+        parser.add_argument('--dataset-cache', dest='dataset_cache', action='store_true', help='reuse/generate datasets through the cache keyed by the generation parameters and seed (default: False)')
+        parser.add_argument('--dataset-seed', type=int, default=None, metavar='N', help='seed for cached and streamed dataset generation (default: the model id)')
+        parser.add_argument('--stream-train', dest='stream_train', action='store_true', help='generate training sequences on the fly instead of storing a training set (default: False)')
+        parser.add_argument('--sequences-per-epoch', type=int, default=2880, metavar='N', help='number of streamed training sequences per epoch, with --stream-train (default: 2880)')
+        parser.add_argument('--n-train', dest='Ntrain', type=int, default=2880, metavar='N', help='number of training sequences (default: 2880)')
+        parser.add_argument('--n-test', dest='Ntest', type=int, default=480, metavar='N', help='number of sequences in each test set (default: 480)')
+        parser.add_argument('--m-testsets', dest='Mtestsets', type=int, default=2, metavar='N', help='number of test sets, for cross-validation of activations (default: 2)')
+        parser.add_argument('--m-blocks', dest='Mblocks', type=int, default=24, metavar='N', help='number of blocks each set is divided into, across the contexts (default: 24)')
+        parser.add_argument('--dataset-chunk-size', type=int, default=None, metavar='N', help='generate datasets chunk by chunk (N sequences per chunk) straight into memory-mapped arrays on disk (default: None, all in memory)')
         parser.add_argument('--original_model_name', default="", help='do not adjust manually: to be used for specifying the name of old trained networks to be retrained under new conditions.')
 
         # network training hyperparameters
         parser.add_argument('--modeltype', default="aggregate", help='input type for selecting which network to train (default: "aggregate", concatenates pixel and location information)')
+        parser.add_argument('--precompose-inputs', dest='precompose_inputs', action='store_true', help='build the network inputs for the whole dataset once and serve them in batches (default: False)')
+        parser.add_argument('--reset-state-batch', type=int, default=0, metavar='N', help='with --reset-state, train on minibatches of N independent sequences at once, 0 for off (default: 0)')
+        parser.add_argument('--shuffle-train', dest='shuffle_train', action='store_true', help='shuffle the training sequences across blocks every epoch, with --reset-state-batch (default: False)')
+        parser.add_argument('--train-streams', type=int, default=1, metavar='B', help='train on B parallel sub-streams of the training set as one batch, each retaining its own hidden state, with the loss averaged over the sub-streams (default: 1)')
+        parser.add_argument('--checkpoint-interval', type=int, default=500, metavar='N', help='also checkpoint training every N batches within an epoch, 0 for only at the end of each epoch (default: 500)')
+        parser.add_argument('--resume', dest='resume', action='store_true', help='continue an interrupted training run from its last checkpoint, on the stored dataset it was trained on (default: False)')
+        parser.add_argument('--eval-every', type=int, default=1, metavar='N', help='assess the network on the train and test sets every N epochs, 0 for only after the final epoch (default: 1)')
+        parser.add_argument('--eval-subsample', type=int, default=0, metavar='N', help='assess the network on a fixed stratified subsample of N sequences (the final assessment is always on the full sets), 0 for the full sets (default: 0)')
+        parser.add_argument('--async-eval', dest='async_eval', action='store_true', help='assess the network in a background process while training continues; needs a stored training set, not --stream-train (default: False)')
+        parser.add_argument('--eval-threads', type=int, default=1, metavar='N', help='number of torch threads for the background assessment, with --async-eval (default: 1)')
+        parser.add_argument('--early-stop-patience', type=int, default=0, metavar='N', help='stop training once the smoothed test accuracy has not improved for N assessments, and keep the best weights, 0 for off (default: 0)')
+        parser.add_argument('--early-stop-min-delta', type=float, default=0.0, metavar='D', help='smallest increase in the smoothed test accuracy (%%) that counts as an improvement (default: 0.0)')
+        parser.add_argument('--early-stop-smoothing', type=float, default=0.0, metavar='A', help='exponential smoothing of the test accuracy for early stopping, from 0 (none) to <1 (default: 0.0)')
+        parser.add_argument('--grad-record-interval', type=int, default=0, metavar='N', help='record gradient statistics to TensorBoard every N batches, 0 for off (default: 0)')
+        parser.add_argument('--grad-flush-interval', type=int, default=10, metavar='N', help='write the recorded gradient statistics to TensorBoard every N records (default: 10)')
         parser.add_argument('--train-lesion-freq', default=0.0, type=float, help='frequency of number lesions on compare trials, during training (default=0.0)')
         parser.add_argument('--batch-size-multi', nargs='*', type=int, help='input batch size (or list of batch sizes) for training (default: 48)', default=[1])
         parser.add_argument('--lr-multi', nargs='*', type=float, help='learning rate (or list of learning rates) (default: 0.001)', default=[0.0001])
@@ -752,11 +1774,16 @@ def define_hyperparams():
         parser.add_argument('--save-model', action='store_true', help='For Saving the current Model')
         parser.add_argument('--recurrent-size', type=int, default=200, metavar='N', help='number of nodes in recurrent layer (default: 33)')
         parser.add_argument('--hidden-size', type=int, default=200, metavar='N', help='number of nodes in hidden layer (default: 60)')
-        parser.add_argument('--BPTT-len', type=int, default=120, metavar='N', help='length of sequences that we backprop through (default: 120 = whole block length)')
+        parser.add_argument('--BPTT-len', type=int, default=120, metavar='N', help='length of the sequences (default: 120 = whole block length); also the length we backprop through unless --bptt-window is set')
+        parser.add_argument('--bf16', dest='bf16', action='store_true', help='train and test the network in bfloat16 CPU autocast, keeping float32 weights and loss (default: False)')
+        parser.add_argument('--scripted', dest='scripted', action='store_true', help='run the network with a TorchScript step and time loop in training, testing and analysis (default: False)')
+        parser.add_argument('--activation-checkpointing', dest='activation_checkpointing', action='store_true', help='keep only the hidden state every few steps for backprop and recompute the steps in between during the backwards pass (default: False)')
+        parser.add_argument('--activation-segment', type=int, default=0, metavar='N', help='steps between kept hidden states with --activation-checkpointing, 0 for about sqrt(sequence length) (default: 0)')
+        parser.add_argument('--bptt-window', type=int, default=0, metavar='K', help='truncate backprop every K steps, with a weight update per window, 0 for the whole sequence (default: 0)')
         parser.add_argument('--noise_std', type=float, default=0.0, metavar='N', help='standard deviation of iid noise injected into the recurrent hiden state between numerical inputs (default: 0.0).')
         parser.add_argument('--model-id', type=int, default=0, metavar='N', help='for distinguishing many iterations of training same model (default: 0).')
 
-        parser.set_defaults(create_new_dataset=True, all_fullrange=False, retain_hidden_state=True, retrain_decoder=False)
+        parser.set_defaults(create_new_dataset=True, all_fullrange=False, retain_hidden_state=True, retrain_decoder=False, compact_dataset=False, stream_train=False, dataset_cache=False, precompose_inputs=False, resume=False, async_eval=False, shuffle_train=False, activation_checkpointing=False, scripted=False, bf16=False)
         args = parser.parse_args()
 
     if args.which_context>0:
@@ -803,6 +1830,21 @@ class argsparser():
         self.train_lesion_freq = 0.0
 
 
+def get_dataset_size_text(args):
+    """Return the dataset sizes part of the dataset and model names (see dset.get_dataset_sizes()): '' for the default sizes,
+    so that their names are unchanged. It goes just before '_id<model id>', so that anh.get_id_from_name() still finds the id."""
+    Ntrain, Ntest, Mtestsets, Mblocks = dset.get_dataset_sizes(args)
+    if (Ntrain, Ntest, Mtestsets, Mblocks) == (2880, 480, 2, 24):
+        return ''
+    return '_N'+str(Ntrain)+'-'+str(Mtestsets)+'x'+str(Ntest)+'_M'+str(Mblocks)
+
+
+def get_bptt_window_text(args):
+    """Return the truncated BPTT window part of the model names (see --bptt-window), which goes just after '_bpl<BPTT_len>':
+    '' for whole-sequence backprop, so that those names are unchanged."""
+    return '_bptw'+str(args.bptt_window) if getattr(args, 'bptt_window', 0) else ''
+
+
 def get_dataset_name(args):
     """Return the (unique) name of the dataset, trained model, analysis and training record, based on args.
     """
@@ -812,7 +1854,9 @@ def get_dataset_name(args):
     else:
         ttsplit = '_traintestblockintsplit'
 
-    str_args = '_bs'+ str(args.batch_size_multi[0]) + '_lr' + str(args.lr_multi[0]) + '_ep' + str(args.epochs) + '_r' + str(args.recurrent_size) + '_h' + str(args.hidden_size) + '_bpl' + str(args.BPTT_len) + '_trlf' + str(args.train_lesion_freq) + '_id'+ str(args.model_id)
+    sizetext = get_dataset_size_text(args)   # (default dataset sizes leave names unchanged)
+    bpttwindowtext = get_bptt_window_text(args)    # (whole-sequence backprop leaves names unchanged)
+    str_args = '_bs'+ str(args.batch_size_multi[0]) + '_lr' + str(args.lr_multi[0]) + '_ep' + str(args.epochs) + '_r' + str(args.recurrent_size) + '_h' + str(args.hidden_size) + '_bpl' + str(args.BPTT_len) + bpttwindowtext + '_trlf' + str(args.train_lesion_freq) + sizetext + '_id'+ str(args.model_id)
     networkTxt = 'RNN' if args.network_style == 'recurrent' else 'MLP'
     contextlabelledtext = '_'+args.label_context+'contextlabel'
     hiddenstate = '_retainstate' if args.retain_hidden_state else '_resetstate'
@@ -828,7 +1872,7 @@ def get_dataset_name(args):
     elif args.which_context==3:
         whichcontexttext = '_highrange_6-16_only'
 
-    datasetname = 'dataset'+whichcontexttext+contextlabelledtext+rangetxt + '_bpl' + str(args.BPTT_len) + '_id'+ str(args.model_id)
+    datasetname = 'dataset'+whichcontexttext+contextlabelledtext+rangetxt + '_bpl' + str(args.BPTT_len) + sizetext + '_id'+ str(args.model_id)
     analysis_name = const.NETANALYIS_DIRECTORY +'MDSanalysis_'+networkTxt+whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+'_n'+str(args.noise_std)+str_args + ttsplit + retraindecodertxt
     trainingrecord_name = '_trainingrecord_'+ networkTxt + whichcontexttext+contextlabelledtext+rangetxt+hiddenstate+'_n'+str(args.noise_std)+str_args+retraindecodertxt
     if args.network_style=='recurrent':
@@ -839,12 +1883,13 @@ def get_dataset_name(args):
     return datasetname, trained_modelname, analysis_name, trainingrecord_name
 
 
-def train_recurrent_network(args, device, multiparams, trainset, testset):
+def train_recurrent_network(args, device, multiparams, trainset, testset, records=None):
     """
     This function performs the train/test loop for different parameter settings
      input by the user in multiparams.
      - Train/test performance is logged with a SummaryWriter
      - the trained recurrent model is returned
+     - if a records list is given, the training record of each parameter setting is also appended to it (with the file it was saved to)
      - note that the train and test set must be divisible by args.batch_size, do to the shaping of the recurrent input
      """
     _, _, _, trainingrecord_name = get_dataset_name(args)
@@ -880,9 +1925,36 @@ def train_recurrent_network(args, device, multiparams, trainset, testset):
         criterion = nn.BCELoss() #nn.CrossEntropyLoss()   # binary cross entropy loss
         optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
 
-        # Define our dataloaders
-        trainloader = DataLoader(trainset, batch_size=args.batch_size, shuffle=False)
-        testloader = DataLoader(testset, batch_size=args.test_batch_size, shuffle=False)
+        # Define our dataloaders (precomposed network inputs are served in batches straight from the stored tensors)
+        if args.precompose_inputs and isinstance(trainset, dset.CreateDataset):
+            trainloader = dset.SequenceBatchLoader(trainset, batch_size=args.batch_size)
+        else:
+            trainloader = DataLoader(trainset, batch_size=args.batch_size, shuffle=False)
+        evaltrainset, evaltrainloader = trainset, trainloader
+        if isinstance(trainset, dset.StreamingDataset):
+            # assess a streamed training set on its fixed assessment sample, rather than on (and using up) the training stream
+            evaltrainset = trainset.assessmentset
+            if args.precompose_inputs:
+                evaltrainloader = dset.SequenceBatchLoader(evaltrainset, batch_size=args.batch_size)
+            else:
+                evaltrainloader = DataLoader(evaltrainset, batch_size=args.batch_size, shuffle=False)
+        train_function = recurrent_train
+        if args.train_streams > 1:
+            # train on parallel sub-streams of the training set, but assess the training set one sequence at a time as usual
+            if not isinstance(trainset, dset.CreateDataset):
+                raise ValueError('--train-streams needs a stored training set (not --stream-train)')
+            trainloader = dset.ParallelStreamLoader(trainset, args.train_streams)
+            train_function = recurrent_train_streams
+        elif args.reset_state_batch > 0:
+            # the hidden state is reset between sequences, so train on minibatches of independent sequences (optionally shuffled)
+            if args.retain_hidden_state or not isinstance(trainset, dset.CreateDataset):
+                raise ValueError('--reset-state-batch needs --reset-state and a stored training set (not --stream-train)')
+            trainloader = dset.SequenceBatchLoader(trainset, batch_size=args.reset_state_batch, shuffle=args.shuffle_train, seed=args.model_id)
+            train_function = recurrent_train_reset
+        if args.precompose_inputs:
+            testloader = dset.SequenceBatchLoader(testset, batch_size=args.test_batch_size)
+        else:
+            testloader = DataLoader(testset, batch_size=args.test_batch_size, shuffle=False)
 
         # Log the model on TensorBoard and label it with the date/time and some other naming string
         now = datetime.now()
@@ -894,72 +1966,293 @@ def train_recurrent_network(args, device, multiparams, trainset, testset):
         # Train/test loop
         n_epochs = args.epochs
         printOutput = False
-        trainingPerformance, testPerformance = [[] for i in range(2)]
+        trainingPerformance, testPerformance, testPerformanceMethod = [[] for i in range(3)]
+        checkpointname = get_checkpoint_name(trainingrecord_name, args.batch_size, args.lr)
+        start_epoch, progress = 1, None
+        datachecksum = get_training_data_checksum(trainset, testset)
+
+        # stop early once the smoothed test accuracy stops improving (off by default), and keep the best weights
+        monitor = ConvergenceMonitor(args.early_stop_patience, args.early_stop_min_delta, args.early_stop_smoothing)
+        if monitor.enabled and args.async_eval:
+            raise ValueError('--early-stop-patience needs the test performance during training, so cannot be used with --async-eval')
+        if args.async_eval and not isinstance(trainset, dset.CreateDataset):
+            raise ValueError('--async-eval needs a stored training set (not --stream-train): the background process cannot read the training stream')
+
+        # assess the network on a schedule (args.eval_every), on the full sets or a fixed stratified subsample (args.eval_subsample)
+        subtrainloader, _ = get_subsample_loader(args, evaltrainset, evaltrainloader)
+        subtestloader, subsamplemethod = get_subsample_loader(args, testset, testloader)
 
         print("Training network...")
 
-        # Take baseline performance measures
-        optimizer.zero_grad()
-        _, base_train_accuracy = recurrent_test(args, model, device, trainloader, criterion, printOutput)
-        _, base_test_accuracy = recurrent_test(args, model, device, testloader, criterion, printOutput)
-        print('Baseline train: {:.2f}%, Baseline test: {:.2f}%'.format(base_train_accuracy, base_test_accuracy))
-        trainingPerformance.append(base_train_accuracy)
-        testPerformance.append(base_test_accuracy)
-        print_progress(0, n_epochs)
-
-        for epoch in range(1, n_epochs + 1):  # loop through the whole dataset this many times
-
-            # train network
-            standard_train_loss, standard_train_accuracy = recurrent_train(args, model, device, trainloader, optimizer, criterion, epoch, printOutput)
-
-            # assess network
-            fair_train_loss, fair_train_accuracy = recurrent_test(args, model, device, trainloader, criterion, printOutput)
-            test_loss, test_accuracy = recurrent_test(args, model, device, testloader, criterion, printOutput)
-
-            # log performance
-            train_perf = [standard_train_loss, standard_train_accuracy, fair_train_loss, fair_train_accuracy]
-            test_perf = [test_loss, test_accuracy]
+        if args.resume and os.path.isfile(checkpointname):
+            # continue an interrupted run from its last checkpoint
+            start_epoch, progress, trainingPerformance, testPerformance, testPerformanceMethod = load_training_checkpoint(checkpointname, model, optimizer, monitor, datachecksum)
+            print('Resuming from checkpoint {} at epoch {}{}'.format(checkpointname, start_epoch, '' if progress is None else ', batch {}'.format(progress['batch'])))
+        else:
+            # Take baseline performance measures
+            optimizer.zero_grad()
+            _, base_train_accuracy = recurrent_test(args, model, device, evaltrainloader, criterion, printOutput)
+            _, base_test_accuracy = recurrent_test(args, model, device, testloader, criterion, printOutput)
+            print('Baseline train: {:.2f}%, Baseline test: {:.2f}%'.format(base_train_accuracy, base_test_accuracy))
+            trainingPerformance.append(base_train_accuracy)
+            testPerformance.append(base_test_accuracy)
+            testPerformanceMethod.append('full')
+        print_progress(start_epoch-1, n_epochs)
+
+        # record gradient statistics to TensorBoard every args.grad_record_interval batches (off by default)
+        # (counting the batches trained on before the checkpoint we resume from, if any)
+        n_batches_done = (start_epoch-1)*len(trainloader) + (0 if progress is None else progress['batch'])
+        gradrecorder = GradientRecorder(model, writer, args.grad_record_interval, args.grad_flush_interval, n_batches_done)
+
+        # optionally assess the network in a background process while training goes on
+        evaluator = None
+        if args.async_eval:
+            evaluator = AsyncEvaluator(args, {False:subtrainloader, True:evaltrainloader}, {False:subtestloader, True:testloader}, writer.log_dir)
+
+        stop_epoch, stopped_early = n_epochs, False
+        # (checkpoints only record the background assessments whose results are in: the rest are lost on --resume, so are marked as not assessed)
+        checkpointmethods = lambda: testPerformanceMethod if evaluator is None else evaluator.settled_methods(testPerformanceMethod)
+
+        for epoch in range(start_epoch, n_epochs + 1):  # loop through the whole dataset this many times
+
+            # train network (checkpointing every args.checkpoint_interval batches)
+            checkpointer = lambda epochprogress: save_training_checkpoint(checkpointname, model, optimizer, epoch, trainingPerformance, testPerformance, epochprogress, checkpointmethods(), monitor.state_dict(), datachecksum)
+            standard_train_loss, standard_train_accuracy = train_function(args, model, device, trainloader, optimizer, criterion, epoch, printOutput, progress, checkpointer, gradrecorder)
+            progress = None
             trainingPerformance.append(standard_train_accuracy)
-            testPerformance.append(test_accuracy)
-            print('Train: {:.2f}%, Test: {:.2f}%'.format(standard_train_accuracy, test_accuracy))
-            log_performance(writer, epoch, train_perf, test_perf)
-            print_progress(epoch, n_epochs)
 
+            # assess network (the final assessment is always on the full train and test sets)
+            if (evaluator is not None) and is_evaluation_epoch(args, epoch, n_epochs):
+                final = (epoch == n_epochs)
+                evaluator.submit(epoch, model, standard_train_loss, standard_train_accuracy, final)
+                testPerformance.append(None)       # (filled in once the background assessment is done)
+                testPerformanceMethod.append('full' if final else subsamplemethod)
+                print('Train: {:.2f}%'.format(standard_train_accuracy))
+            elif is_evaluation_epoch(args, epoch, n_epochs):
+                final = (epoch == n_epochs)
+                fair_train_loss, fair_train_accuracy = recurrent_test(args, model, device, evaltrainloader if final else subtrainloader, criterion, printOutput)
+                test_loss, test_accuracy = recurrent_test(args, model, device, testloader if final else subtestloader, criterion, printOutput)
+
+                # log performance
+                train_perf = [standard_train_loss, standard_train_accuracy, fair_train_loss, fair_train_accuracy]
+                test_perf = [test_loss, test_accuracy]
+                testPerformance.append(test_accuracy)
+                testPerformanceMethod.append('full' if final else subsamplemethod)
+                print('Train: {:.2f}%, Test: {:.2f}%'.format(standard_train_accuracy, test_accuracy))
+                log_performance(writer, epoch, train_perf, test_perf)
+            else:
+                testPerformance.append(None)       # (not assessed this epoch)
+                testPerformanceMethod.append(None)
+                print('Train: {:.2f}%'.format(standard_train_accuracy))
+                writer.add_scalar('Loss/training_standard', standard_train_loss, epoch)
+                writer.add_scalar('Accuracy/training_standard', standard_train_accuracy, epoch)
+            stopped_early = monitor.update(epoch, testPerformance[-1], model) and (epoch < n_epochs)
+            print_progress(epoch, n_epochs)
+            if evaluator is not None:
+                for assessed_epoch, test_accuracy in evaluator.poll().items():
+                    testPerformance[assessed_epoch] = test_accuracy    # (testPerformance[0] is the baseline)
+            save_training_checkpoint(checkpointname, model, optimizer, epoch+1, trainingPerformance, testPerformance, None, checkpointmethods(), monitor.state_dict(), datachecksum)
+            if stopped_early:
+                stop_epoch = epoch
+                print('Stopping early at epoch {}: the smoothed test accuracy has not improved for {} assessments'.format(epoch, args.early_stop_patience))
+                break
+
+        gradrecorder.flush()
+        if evaluator is not None:
+            for epoch, test_accuracy in evaluator.results().items():
+                testPerformance[epoch] = test_accuracy    # (testPerformance[0] is the baseline)
+            print('Final test: {:.2f}%'.format(testPerformance[-1]))
+
+        # go back to the best weights, and assess them on the full test set (unless they are the final, fully assessed, weights)
+        earlystopping = None
+        if monitor.enabled:
+            monitor.restore(model)
+            if (monitor.best_epoch == stop_epoch) and (testPerformanceMethod[-1] == 'full'):
+                restored_test_accuracy = testPerformance[-1]
+            else:
+                _, restored_test_accuracy = recurrent_test(args, model, device, testloader, criterion, printOutput)
+            print('Restored the weights from epoch {}, test: {:.2f}%'.format(monitor.best_epoch, restored_test_accuracy))
+            earlystopping = {"patience":args.early_stop_patience, "minDelta":args.early_stop_min_delta, "smoothing":args.early_stop_smoothing,\
+                             "stoppedEarly":stopped_early, "bestEpoch":monitor.best_epoch, "restoredTestPerformance":restored_test_accuracy}
         print("Training complete.")
         # save this training curve
-        record = {"trainingPerformance":trainingPerformance, "testPerformance":testPerformance, "args":vars(args) }
+        # (how each metric was estimated: trainingPerformance is always the running accuracy over each training epoch,
+        # testPerformance was assessed on the 'full' test set, a stratified 'subsample<N>' of it, or not at all that epoch (None))
+        # (the curves end at stopEpoch, which is earlier than args.epochs if training stopped early)
+        record = {"trainingPerformance":trainingPerformance, "testPerformance":testPerformance, "args":vars(args),\
+                  "estimation":{"trainingPerformance":"running", "testPerformance":testPerformanceMethod},\
+                  "stopEpoch":stop_epoch, "earlyStopping":earlystopping}
         randnum = str(random.randint(0,10000))
         dat = json.dumps(record)
         f = open(const.TRAININGRECORDS_DIRECTORY+randnum + trainingrecord_name+".json","w")
         f.write(dat)
         f.close()
+        if os.path.isfile(checkpointname):
+            os.remove(checkpointname)   # (the run is complete, so there is nothing left to resume)
+        if records is not None:
+            records.append(dict(record, filename=const.TRAININGRECORDS_DIRECTORY+randnum + trainingrecord_name+".json"))
 
     writer.close()
     return model
 
 
-def train_and_save_network(args, device, multiparams):
+def get_training_data_checksum(trainset, testset):
+    """Return a checksum of the stored training and test sets (see dset.dataset_checksum()), to check a checkpoint is resumed on the same data.
+    (A streamed training set is not stored, so only its test set counts.)"""
+    return dset.dataset_checksum({'trainset':trainset.data if isinstance(trainset, dset.CreateDataset) else None, 'testset':testset.data})
+
+
+def has_resume_checkpoint(args, multiparams):
+    """Return True if --resume will continue from a checkpoint for any of the (batch size, learning rate) settings in multiparams."""
+    _, _, _, trainingrecord_name = get_dataset_name(args)
+    return args.resume and any(os.path.isfile(get_checkpoint_name(trainingrecord_name, batch_size, lr)) for batch_size, lr in product(*multiparams))
+
+
+def get_training_data(args, datasetname, resuming=False, record_cache=True):
+    """Return the (trainset, testset) to train on: streamed, from the dataset cache, newly generated or loaded, according to args.
+    - resuming=True (continuing from a checkpoint, see has_resume_checkpoint()) always loads the stored dataset the run was trained on,
+      rather than generating a new one over it.
+    - record_cache=False loads from the dataset cache without writing to its manifest (see dset.load_cached_dataset()).
+    """
+    if resuming:
+        if args.stream_train:
+            raise ValueError('--resume cannot continue a streamed training set (--stream-train): the stream would restart from its first sequence')
+        if args.dataset_cache:
+            return dset.load_cached_dataset(args, datasetname, record_cache)
+        trainset, testset, _, _, _, _ = dset.load_input_data(const.DATASET_DIRECTORY, datasetname)
+        return trainset, testset
+    if args.stream_train:
+        trainset, testset = dset.create_streaming_input_data(datasetname, args)
+    elif args.dataset_cache:
+        trainset, testset = dset.load_cached_dataset(args, datasetname, record_cache)
+    elif args.create_new_dataset:
+        trainset, testset = dset.create_separate_input_data(datasetname, args)
+    else:
+        trainset, testset, _, _, _, _ = dset.load_input_data(const.DATASET_DIRECTORY, datasetname)
+    return trainset, testset
+
+
+def train_and_save_network(args, device, multiparams, records=None, record_cache=True):
     """This function will:
     - create a new train/test dataset,
     - train a new RNN according to the hyperparameters in args on that dataset,
     - save the model (and training record) with an auto-generated name based on those args.
+    - (training records are also appended to records, if given; see train_recurrent_network())
+    - (record_cache=False: a cached dataset is loaded without writing to the cache manifest, see get_training_data())
     """
 
     # define the network parameters
     datasetname, trained_modelname, analysis_name, _ = get_dataset_name(args)
-
-    if args.create_new_dataset:
-        trainset, testset = dset.create_separate_input_data(datasetname, args)
-    else:
-        trainset, testset, _, _, _, _ = dset.load_input_data(const.DATASET_DIRECTORY, datasetname)
+    trainset, testset = get_training_data(args, datasetname, has_resume_checkpoint(args, multiparams), record_cache)
 
     # define and train a neural network model, log performance and output trained model
     if args.network_style == 'recurrent':
-        model = train_recurrent_network(args, device, multiparams, trainset, testset)
+        model = train_recurrent_network(args, device, multiparams, trainset, testset, records)
     else:
         model = trainMLPNetwork(args, device, multiparams, trainset, testset)
 
+    if args.stream_train:
+        trainset.close()   # stop generating training sequences
+
     # save the trained weights so we can easily look at them
     print('Saving trained model...')
     print(trained_modelname)
     torch.save(model, trained_modelname)
+
+
+def init_sweep_worker(coresets, threads_per_worker):
+    """Initialise a sweep worker process: take the next free set of cores, pin the process to it and cap torch's threads,
+    so that the workers together dont oversubscribe the machine."""
+    cores = coresets.get()
+    if hasattr(os, 'sched_setaffinity'):   # (Linux only)
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads_per_worker)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass   # (can only be set once per process)
+
+
+def get_sweep_task_seed(args):
+    """Return the seed of one training run of a sweep, from its (model id, batch size, learning rate, train lesion frequency),
+    so that the run does not depend on which worker trains it or what that worker trained before."""
+    key = '{}_{}_{}_{}'.format(args.model_id, args.batch_size_multi[0], args.lr_multi[0], args.train_lesion_freq)
+    return int(hashlib.sha256(key.encode()).hexdigest()[:8], 16)
+
+
+def sweep_task(task):
+    """Train and save one model of a sweep (see run_sweep()), returning its training records and the name of the saved model.
+    - the python, numpy and torch random states (initial weights, lesions...) are seeded from get_sweep_task_seed(), so a sweep is reproducible.
+    - cached datasets are only loaded: the parent process has already cached and recorded them (see run_sweep()).
+    """
+    args, device = task
+    seed = get_sweep_task_seed(args)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    records = []
+    train_and_save_network(args, device, [args.batch_size_multi, args.lr_multi], records, record_cache=False)
+    _, trained_modelname, _, _ = get_dataset_name(args)
+    return trained_modelname, records
+
+
+def run_sweep(args, device, batch_sizes=None, lrs=None, model_ids=None, train_lesion_freqs=None, n_workers=None, threads_per_worker=1):
+    """Train (and save) a model for every combination of batch size x learning rate x model id x train lesion frequency,
+    spread over a pool of worker processes, and return the training records of all of them.
+    - by default each parameter takes its value(s) from args (args.batch_size_multi, args.lr_multi, args.model_id, args.train_lesion_freq).
+    - each worker is pinned to its own threads_per_worker cores and torch is capped to that many threads.
+    - the datasets each model id needs are generated up front (if args.create_new_dataset) so that workers dont generate the same dataset at once.
+      With args.dataset_cache, the missing datasets are generated up front and every one is recorded in the cache manifest by this process
+      alone; the workers only load them.
+    - models and training records are saved under their usual names, as by train_and_save_network().
+    - every run is seeded from its own parameters (see get_sweep_task_seed()), so the sweep gives the same models whatever the scheduling.
+    - --async-eval cannot be used: pool workers are daemonic, and cannot start the background assessment process.
+    """
+    if args.async_eval:
+        raise ValueError('--async-eval cannot be used in a sweep: the pool workers cannot start its background process')
+    batch_sizes = args.batch_size_multi if batch_sizes is None else batch_sizes
+    lrs = args.lr_multi if lrs is None else lrs
+    model_ids = [args.model_id] if model_ids is None else model_ids
+    train_lesion_freqs = [args.train_lesion_freq] if train_lesion_freqs is None else train_lesion_freqs
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+    n_workers = max(1, n_cores // threads_per_worker) if n_workers is None else n_workers
+
+    tasks = []
+    for batch_size, lr, model_id, train_lesion_freq in product(batch_sizes, lrs, model_ids, train_lesion_freqs):
+        taskargs = copy.copy(args)
+        taskargs.batch_size_multi, taskargs.lr_multi = [batch_size], [lr]
+        taskargs.model_id, taskargs.train_lesion_freq = model_id, train_lesion_freq
+        tasks.append((taskargs, device))
+
+    if args.dataset_cache and not args.stream_train:
+        # only this process writes to the cache manifest: generate (and record) the missing datasets, record the cached ones as used
+        missing = []
+        for model_id in model_ids:
+            specargs = copy.copy(args)
+            specargs.model_id = model_id
+            if dset.is_dataset_cached(specargs):
+                key, params = dset.get_dataset_cache_key(specargs)
+                dset.record_cached_dataset(key, params, get_dataset_name(specargs)[0], specargs)
+            else:
+                missing.append((args, model_id))
+        if len(missing) > 0:
+            dset.generate_datasets_parallel(missing, n_workers)
+    elif args.create_new_dataset and not args.stream_train:
+        dset.generate_datasets_parallel([(args, model_id) for model_id in model_ids], n_workers)
+        for taskargs, _ in tasks:
+            taskargs.create_new_dataset = False
+
+    # give each worker its own set of cores
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(n_cores))
+    coresets = multiprocessing.Queue()
+    for worker in range(n_workers):
+        coresets.put(set(cores[(worker*threads_per_worker + i) % len(cores)] for i in range(threads_per_worker)))
+
+    print('Sweeping {} training runs over {} workers ({} threads each)...'.format(len(tasks), n_workers, threads_per_worker))
+    tic = time.time()
+    allrecords = []
+    with multiprocessing.Pool(n_workers, initializer=init_sweep_worker, initargs=(coresets, threads_per_worker)) as pool:
+        for n_done, (trained_modelname, records) in enumerate(pool.imap_unordered(sweep_task, tasks)):
+            allrecords.extend(records)
+            print('[{}/{}] saved {} after {:.1f}s'.format(n_done+1, len(tasks), trained_modelname, time.time()-tic))
+    return allrecords
@@ -40,12 +40,58 @@ if __name__ == '__main__':
     args.retrain_decoder = False
     #args.model_id = 9999          # for visualising or analysing a particular trained model
 
+    # Compare the speed of the vectorised and original (loop) dataset generators
+    #dset.compare_dataset_engines(args)
+
+    # Generate the datasets for several model ids in parallel
+    #dset.generate_datasets_parallel([(args, model_id) for model_id in range(10)])
+
+    # Convert the existing pickled datasets into the memory-mapped columnar format
+    #dset.convert_all_datasets_to_columnar()
+
+    # Time regenerating a dataset from its spec (--dataset-format spec) against loading a stored copy of it
+    #dset.compare_regenerate_vs_load(mnet.get_dataset_name(args)[0])
+
+    # Load the true, random and constant context label datasets as views of one base dataset (generated with --label-context base)
+    #label_context_views = dset.load_label_context_views(mnet.get_dataset_name(args)[0])
+
+    # Compare the training throughput at batch size 1 and with parallel training sub-streams (--train-streams)
+    #mnet.compare_training_throughput(args, device, dset.load_input_data(const.DATASET_DIRECTORY, mnet.get_dataset_name(args)[0])[0])
+
+    # Compare the training throughput of reset-state networks one sequence at a time and on minibatches of sequences (--reset-state-batch)
+    #mnet.compare_reset_state_throughput(args, device, dset.load_input_data(const.DATASET_DIRECTORY, mnet.get_dataset_name(args)[0])[0])
+
+    # Compare the training speed and autograd memory of truncated BPTT windows (--bptt-window), e.g. on long sequences (--BPTT-len 480)
+    #mnet.compare_bptt_windows(args, device, dset.load_input_data(const.DATASET_DIRECTORY, mnet.get_dataset_name(args)[0])[0])
+
+    # Check that activation checkpointing (--activation-checkpointing) gives the same gradients, and compare its speed and memory on long sequences
+    #mnet.compare_activation_checkpointing(args, device, dset.load_input_data(const.DATASET_DIRECTORY, mnet.get_dataset_name(args)[0])[0])
+
+    # Check that the whole-sequence forward pass matches the step-by-step one
+    #mnet.check_forward_sequence_parity(args, dset.load_input_data(const.DATASET_DIRECTORY, mnet.get_dataset_name(args)[0])[1])
+
+    # Check that the TorchScript step and time loop (--scripted) match the network, and time them
+    #mnet.check_scripted_parity(args, dset.load_input_data(const.DATASET_DIRECTORY, mnet.get_dataset_name(args)[0])[1])
+    #mnet.compare_scripted_speed(args)
+
     # Train a network from scratch and save it
     #mnet.train_and_save_network(args, device, multiparams)
 
+    # Sweep over batch sizes x learning rates x model ids x train lesion frequencies on a pool of worker processes
+    #records = mnet.run_sweep(args, device, model_ids=range(10), train_lesion_freqs=[0.0, 0.1])
+
+    # Train several models (ids) at once as a stacked ensemble and save each of them
+    #mnet.train_ensemble(args, device, range(10))
+
+    # Compare the training throughput of a stacked ensemble against training the same networks one after another
+    #mnet.compare_ensemble_throughput(args, device, range(4))
+
     # Analyse the trained network (extract and save network activations)
     #MDS_dict = anh.analyse_network(args)
 
+    # Compare the test performance of the trained models in float32 and bfloat16 autocast (--bf16)
+    #anh.bf16_parity_report(args, device)
+
     # Check the average final performance for trained models matching args
     #anh.average_perf_across_models(args)
 
@@ -58,7 +58,7 @@ def save_figure(basetitle, args, labelNumerosity, plot_diff_code, whichTrialType
     else:
         ttsplit = '_traintestblockintsplit'
     str_args = '_bs'+ str(args.batch_size_multi[0]) + '_lr' + str(args.lr_multi[0]) + '_ep' + str(args.epochs) + '_r' + str(args.recurrent_size) + '_h' +\
-                str(args.hidden_size) + '_bpl' + str(args.BPTT_len) + '_trlf' + str(args.train_lesion_freq) + '_id' + str(args.model_id) + ttsplit
+                str(args.hidden_size) + '_bpl' + str(args.BPTT_len) + mnet.get_bptt_window_text(args) + '_trlf' + str(args.train_lesion_freq) + mnet.get_dataset_size_text(args) + '_id' + str(args.model_id) + ttsplit
 
     # automatic save file title details
     if args.which_context==0: